@@ -0,0 +1,100 @@
+"""Convergence smoke test of Trainer in fp32 and mixed precision
+
+Fits YOLACT to a few synthetic images in every precision and checks that the
+loss on them drops by at least `--min-drop`. On a GPU, `fp16` uses a
+GradScaler; on CPUs, compare `fp32` with `bf16`.
+
+    $ python benchmarks/amp_smoke_test.py --precisions fp32 fp16 --device cuda
+"""
+import sys
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from boda.models import YolactConfig, YolactModel, YolactLoss
+from boda.models.backbone_resnet import resnet50
+from boda.utils.trainer import Trainer
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--precisions', nargs='+', default=['fp32', 'bf16'])
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--num-images', default=2, type=int)
+parser.add_argument('--num-steps', default=30, type=int)
+parser.add_argument('--lr', default=1e-3, type=float)
+parser.add_argument('--min-drop', default=0.3, type=float,
+                    help='required relative decrease of the loss')
+args = parser.parse_args()
+
+
+class SyntheticDataset(Dataset):
+    """Rectangles of a few classes on noise, at 550 x 550"""
+    def __init__(self, num_images, length):
+        rng = np.random.default_rng(0)
+        self.samples = []
+        for _ in range(num_images):
+            image = torch.as_tensor(rng.uniform(0, 255, (3, 550, 550)), dtype=torch.float32)
+            boxes, masks = [], []
+            for _ in range(3):
+                x1, y1 = rng.integers(0, 350, 2)
+                x2, y2 = x1 + rng.integers(60, 200), y1 + rng.integers(60, 200)
+                mask = torch.zeros(550, 550, dtype=torch.uint8)
+                mask[y1:y2, x1:x2] = 1
+                image[:, y1:y2, x1:x2] = torch.as_tensor(rng.uniform(0, 255, (3, 1, 1)), dtype=torch.float32)
+                boxes.append([x1, y1, x2, y2])
+                masks.append(mask)
+            self.samples.append((image, {
+                'boxes': torch.as_tensor(boxes, dtype=torch.float32),
+                'masks': torch.stack(masks),
+                'labels': torch.as_tensor(rng.integers(0, 3, 3), dtype=torch.int64),
+                'crowds': torch.zeros(3, dtype=torch.int64),
+            }))
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        image, targets = self.samples[index % len(self.samples)]
+        return image.clone(), {k: v.clone() for k, v in targets.items()}
+
+
+def collate(batch):
+    return [sample[0] for sample in batch], [sample[1] for sample in batch]
+
+
+def evaluate(model, criterion, dataset):
+    images, targets = collate([dataset[i] for i in range(len(dataset.samples))])
+    with torch.no_grad():
+        outputs = model([image.to(args.device) for image in images])
+        losses = criterion(outputs, [{k: v.to(args.device) for k, v in t.items()} for t in targets])
+
+    return sum(value.float() for value in losses.values()).item()
+
+
+if __name__ == '__main__':
+    failed = False
+    for precision in args.precisions:
+        torch.manual_seed(0)
+        dataset = SyntheticDataset(args.num_images, args.num_steps * args.num_images)
+        model = YolactModel(YolactConfig(num_classes=3), backbone=resnet50()).to(args.device).train()
+        criterion = YolactLoss()
+        optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, momentum=0.9)
+
+        initial_loss = evaluate(model, criterion, dataset)
+        trainer = Trainer(
+            DataLoader(dataset, batch_size=args.num_images, collate_fn=collate),
+            model, optimizer, criterion, num_epochs=1, device=args.device,
+            verbose=max(args.num_steps // 5, 1), precision=precision)
+        trainer.train()
+        final_loss = evaluate(model, criterion, dataset)
+
+        drop = 1 - final_loss / initial_loss
+        passed = np.isfinite(final_loss) and drop >= args.min_drop
+        failed |= not passed
+        print(f'{precision}: loss {initial_loss:.4f} -> {final_loss:.4f} '
+              f'({drop:.1%} lower) {"ok" if passed else "FAILED"}')
+
+    sys.exit(1 if failed else 0)
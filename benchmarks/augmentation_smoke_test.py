@@ -0,0 +1,135 @@
+"""Smoke test of Trainer with batched augmentation
+
+Trains YOLACT for a few steps on synthetic images with `BatchCompose`,
+once from a `DetectionCollate` loader, which yields images of mixed sizes
+as one padded tensor, and once from a loader of image lists of one size.
+Checks that the model and the loss get the augmented batch and that the
+loss is finite.
+
+    $ python benchmarks/augmentation_smoke_test.py --device cuda
+"""
+import sys
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+from torch import Tensor
+from torch.utils.data import Dataset, DataLoader
+
+from boda.models import YolactConfig, YolactModel, YolactLoss
+from boda.models.backbone_resnet import resnet50
+from boda.utils.batch_transforms import (
+    BatchCompose, BatchRandomBrightness, BatchRandomContrast, BatchRandomFlip, BatchResize)
+from boda.utils.checkpoint import CheckpointManager
+from boda.utils.dataset import DetectionCollate
+from boda.utils.trainer import Trainer
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--batch-size', default=2, type=int)
+parser.add_argument('--num-steps', default=2, type=int)
+parser.add_argument('--size', default=550, type=int)
+args = parser.parse_args()
+
+
+class SyntheticDataset(Dataset):
+    """Rectangles of a few classes on noise, of random sizes unless `size` is given"""
+    def __init__(self, num_images, size=None):
+        rng = np.random.default_rng(0)
+        self.samples = []
+        for _ in range(num_images):
+            h, w = rng.integers(300, 500, 2) if size is None else size
+            image = torch.as_tensor(rng.uniform(0, 255, (3, h, w)), dtype=torch.float32)
+            boxes, masks = [], []
+            for _ in range(3):
+                x1, y1 = rng.integers(0, w - 100), rng.integers(0, h - 100)
+                x2, y2 = x1 + rng.integers(40, 100), y1 + rng.integers(40, 100)
+                mask = torch.zeros(h, w, dtype=torch.uint8)
+                mask[y1:y2, x1:x2] = 1
+                boxes.append([x1, y1, x2, y2])
+                masks.append(mask)
+            self.samples.append((image, {
+                'boxes': torch.as_tensor(boxes, dtype=torch.float32),
+                'masks': torch.stack(masks),
+                'labels': torch.as_tensor(rng.integers(0, 3, 3), dtype=torch.int64),
+                'crowds': torch.zeros(3, dtype=torch.int64),
+            }))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        image, targets = self.samples[index]
+        return image.clone(), {k: v.clone() for k, v in targets.items()}
+
+
+def collate(batch):
+    return [sample[0] for sample in batch], [sample[1] for sample in batch]
+
+
+class RecordedLoss(YolactLoss):
+    """Records the targets the loss gets after augmentation"""
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def forward(self, inputs, targets):
+        losses = super().forward(inputs, targets)
+        self.records.append({
+            'mask_sizes': {tuple(t['masks'].shape[-2:]) for t in targets},
+            'max_box': max(float(t['boxes'].max()) for t in targets),
+            'loss': sum(float(value.detach()) for value in losses.values()),
+        })
+
+        return losses
+
+
+def run(collate_fn, image_size=None):
+    torch.manual_seed(0)
+    dataset = SyntheticDataset(args.num_steps * args.batch_size, image_size)
+    model = YolactModel(YolactConfig(num_classes=3), backbone=resnet50()).to(args.device).train()
+    criterion = RecordedLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4, momentum=0.9)
+
+    inputs = []
+    model.register_forward_pre_hook(lambda module, args: inputs.append(args[0]))
+
+    augmentation = BatchCompose([
+        BatchRandomBrightness(), BatchRandomContrast(),
+        BatchRandomFlip(p=0.5, horizontal=True), BatchResize(args.size, args.size)])
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        trainer = Trainer(
+            DataLoader(dataset, batch_size=args.batch_size, collate_fn=collate_fn),
+            model, optimizer, criterion, num_epochs=1, device=args.device,
+            augmentation=augmentation, checkpoint=CheckpointManager(checkpoint_dir))
+        trainer.train()
+
+    errors = []
+    if len(criterion.records) != args.num_steps:
+        errors.append(f'{len(criterion.records)} steps instead of {args.num_steps}')
+    for images in inputs:
+        if not isinstance(images, Tensor) or \
+                tuple(images.shape[1:]) != (3, args.size, args.size):
+            errors.append(f'the model got {type(images).__name__} instead of the resized batch')
+    for record in criterion.records:
+        if record['mask_sizes'] != {(args.size, args.size)}:
+            errors.append(f'masks of sizes {record["mask_sizes"]} reached the loss')
+        if record['max_box'] > args.size:
+            errors.append(f'a box ends at {record["max_box"]:.1f}, out of the resized image')
+        if not np.isfinite(record['loss']):
+            errors.append(f'loss {record["loss"]}')
+
+    return errors
+
+
+if __name__ == '__main__':
+    failed = False
+    loaders = [('DetectionCollate', DetectionCollate(), None), ('list', collate, (420, 380))]
+    for name, collate_fn, image_size in loaders:
+        errors = run(collate_fn, image_size)
+        failed |= len(errors) > 0
+        print(f'{name:>16}: {"ok" if not errors else "FAILED, " + "; ".join(errors)}')
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,87 @@
+"""Per-sample numpy augmentation against batched tensor augmentation
+
+    $ python benchmarks/benchmark_batch_transforms.py --batch-size 8 --device cuda
+"""
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from boda.utils import transforms as T
+from boda.utils import batch_transforms as BT
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--height', default=480, type=int)
+parser.add_argument('--width', default=640, type=int)
+parser.add_argument('--num-masks', default=20, type=int)
+parser.add_argument('--batch-size', default=8, type=int)
+parser.add_argument('--num-runs', default=10, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+args = parser.parse_args()
+
+
+def make_sample(rng):
+    h, w = args.height, args.width
+    image = rng.uniform(0, 255, (h, w, 3)).astype(np.float32)
+    x1 = rng.uniform(0, w - 50, args.num_masks)
+    y1 = rng.uniform(0, h - 50, args.num_masks)
+    boxes = np.stack([x1, y1, x1 + 40, y1 + 40], axis=1).astype(np.float32)
+    masks = np.zeros((args.num_masks, h, w), dtype=np.uint8)
+    for mask, box in zip(masks, boxes.astype(np.int64)):
+        mask[box[1]:box[3], box[0]:box[2]] = 1
+
+    return image, {'boxes': boxes, 'masks': masks}
+
+
+def synchronize():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    samples = [make_sample(rng) for _ in range(args.batch_size)]
+
+    per_sample = T.Compose([
+        T.RandomBrightness(p=1.0),
+        T.RandomContrast(p=1.0),
+        T.ConvertColor('RGB', 'HSV'),
+        T.RandomSaturation(p=1.0),
+        T.RandomHue(p=1.0),
+        T.ConvertColor('HSV', 'RGB'),
+        T.RandomFlip(p=0.5, horizontal=True),
+        T.Resize(550, 550),
+    ])
+    batched = BT.BatchCompose([
+        BT.BatchRandomBrightness(p=1.0),
+        BT.BatchRandomContrast(p=1.0),
+        BT.BatchRandomSaturation(p=1.0),
+        BT.BatchRandomHue(p=1.0),
+        BT.BatchRandomFlip(p=0.5, horizontal=True),
+        BT.BatchResize(550, 550),
+    ])
+
+    start_time = time.perf_counter()
+    for _ in range(args.num_runs):
+        for image, targets in samples:
+            per_sample(image.copy(), {k: v.copy() for k, v in targets.items()})
+    numpy_time = (time.perf_counter() - start_time) / args.num_runs
+
+    images = torch.stack([
+        torch.from_numpy(image.transpose(2, 0, 1).copy()) for image, _ in samples]).to(args.device)
+    targets = [
+        {k: torch.from_numpy(v).to(args.device) for k, v in t.items()} for _, t in samples]
+    batched(images, targets)
+    synchronize()
+
+    start_time = time.perf_counter()
+    for _ in range(args.num_runs):
+        batched(images, targets)
+    synchronize()
+    batch_time = (time.perf_counter() - start_time) / args.num_runs
+
+    print(f'{args.batch_size} x {args.height}x{args.width} images, {args.num_masks} masks each')
+    print(f'{"numpy, per sample, 1 worker":>32}: {numpy_time * 1000:>8.1f} ms/batch')
+    print(f'{"batched on " + args.device:>32}: {batch_time * 1000:>8.1f} ms/batch')
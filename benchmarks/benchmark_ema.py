@@ -0,0 +1,78 @@
+"""Per-tensor ModelEMA update against the multi-tensor update
+
+    $ python benchmarks/benchmark_ema.py --backbone resnet101 --device cuda
+"""
+import time
+import argparse
+
+import torch
+
+from boda.models.backbone_resnet import resnet50, resnet101
+from boda.utils.ema import ModelEMA
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--backbone', default='resnet101', choices=['resnet50', 'resnet101'])
+parser.add_argument('--num-runs', default=50, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+args = parser.parse_args()
+
+
+def synchronize():
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def legacy_update(ema, model):
+    """ModelEMA.update before the multi-tensor rewrite"""
+    with torch.no_grad():
+        ema.updates += 1
+        d = ema.decay(ema.updates)
+
+        msd = model.state_dict()
+        for k, v in ema.ema.state_dict().items():
+            if v.dtype.is_floating_point:
+                v *= d
+                v += (1. - d) * msd[k].detach()
+
+
+def measure(update, ema, model):
+    """Returns milliseconds per update"""
+    update(ema, model)
+    synchronize()
+    start_time = time.perf_counter()
+    for _ in range(args.num_runs):
+        update(ema, model)
+    synchronize()
+
+    return (time.perf_counter() - start_time) / args.num_runs * 1000
+
+
+if __name__ == '__main__':
+    model = {'resnet50': resnet50, 'resnet101': resnet101}[args.backbone]().to(args.device)
+    num_tensors = sum(v.dtype.is_floating_point for v in model.state_dict().values())
+    print(f'{args.backbone} on {args.device}, {num_tensors} floating point tensors')
+
+    benchmarks = [
+        ('per-tensor (legacy)', legacy_update, {}),
+        ('foreach', ModelEMA.update, {}),
+        ('foreach, update_every=4', ModelEMA.update, {'update_every': 4}),
+        ('foreach, bf16', ModelEMA.update, {'dtype': torch.bfloat16}),
+    ]
+    if args.device.startswith('cuda'):
+        benchmarks.append(('foreach, on cpu', ModelEMA.update, {'device': 'cpu'}))
+
+    for name, update, kwargs in benchmarks:
+        ema = ModelEMA(model, **kwargs)
+        print(f'{name:>24}: {measure(update, ema, model):>8.2f} ms/step')
+
+    # Both updates give the same average
+    legacy, ema = ModelEMA(model), ModelEMA(model)
+    for _ in range(3):
+        for p in model.parameters():
+            p.data.add_(torch.randn_like(p), alpha=0.01)
+        legacy_update(legacy, model)
+        ema.update(model)
+    error = max((a - b).abs().max().item() for a, b in zip(
+        legacy.ema.state_dict().values(), ema.ema.state_dict().values()) if a.dtype.is_floating_point)
+    print(f'max difference to the legacy update: {error:.2e}')
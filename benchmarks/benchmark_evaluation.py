@@ -0,0 +1,150 @@
+"""CocoEvaluator against pycocotools COCOeval on synthetic detections
+
+    $ python benchmarks/benchmark_evaluation.py --num-images 500 --num-classes 10
+
+Ground truth and predictions are random boxes with elliptic masks, with
+crowds and false positives, and both evaluators must give the same mAP.
+"""
+import time
+import argparse
+import contextlib
+import io
+
+import numpy as np
+from pycocotools import mask as mask_utils
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+
+from boda.utils.evaluation import CocoEvaluator
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--num-images', default=200, type=int)
+parser.add_argument('--num-classes', default=10, type=int)
+parser.add_argument('--num-objects', default=10, type=int)
+parser.add_argument('--height', default=240, type=int)
+parser.add_argument('--width', default=320, type=int)
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--num-workers', default=0, type=int)
+args = parser.parse_args()
+
+
+def ellipse_masks(boxes, h, w):
+    ys, xs = np.mgrid[:h, :w] + 0.5
+    cx, cy = (boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2
+    rx, ry = (boxes[:, 2] - boxes[:, 0]) / 2, (boxes[:, 3] - boxes[:, 1]) / 2
+    return (((xs[None] - cx[:, None, None]) / rx[:, None, None]) ** 2
+            + ((ys[None] - cy[:, None, None]) / ry[:, None, None]) ** 2 <= 1).astype(np.uint8)
+
+
+def random_boxes(rng, n, h, w):
+    x1 = rng.uniform(0, w - 8, n)
+    y1 = rng.uniform(0, h - 8, n)
+    bw = rng.uniform(4, w / 2, n)
+    bh = rng.uniform(4, h / 2, n)
+    return np.stack([x1, y1, np.minimum(x1 + bw, w), np.minimum(y1 + bh, h)], axis=1)
+
+
+def make_image(rng):
+    h, w = args.height, args.width
+    num_true = rng.integers(1, args.num_objects + 1)
+    true_boxes = random_boxes(rng, num_true, h, w)
+    true_labels = rng.integers(0, args.num_classes, num_true)
+    crowds = rng.random(num_true) < 0.05
+
+    # Jittered copies of the ground truth, duplicates and false positives
+    source = rng.integers(0, num_true, num_true + 5)
+    jitter = rng.normal(0, 0.08, (len(source), 4)) * np.tile(
+        true_boxes[source, 2:] - true_boxes[source, :2], 2)
+    pred_boxes = np.concatenate([true_boxes[source] + jitter, random_boxes(rng, 5, h, w)])
+    pred_boxes[:, [0, 2]] = pred_boxes[:, [0, 2]].clip(0, w)
+    pred_boxes[:, [1, 3]] = pred_boxes[:, [1, 3]].clip(0, h)
+    pred_boxes[:, 2:] = np.maximum(pred_boxes[:, 2:], pred_boxes[:, :2] + 1)
+    pred_labels = np.concatenate([true_labels[source], rng.integers(0, args.num_classes, 5)])
+    flip = rng.random(len(pred_labels)) < 0.1
+    pred_labels[flip] = rng.integers(0, args.num_classes, flip.sum())
+    pred_scores = rng.random(len(pred_labels)).round(3)
+
+    true_masks = ellipse_masks(true_boxes, h, w)
+    pred_masks = ellipse_masks(pred_boxes, h, w)
+    preds = {'boxes': pred_boxes, 'scores': pred_scores, 'labels': pred_labels, 'masks': pred_masks}
+    targets = {'boxes': true_boxes, 'labels': true_labels, 'crowds': crowds, 'masks': true_masks,
+               'areas': true_masks.sum(axis=(1, 2)).astype(np.float64)}
+
+    return preds, targets
+
+
+def to_coco(samples):
+    images, annotations = [], []
+    # Separate files as pycocotools takes the box area of results with a box
+    results = {'bbox': [], 'segm': []}
+    # Samples with the masks in RLE
+    rle_samples = []
+    for image_id, (preds, targets) in enumerate(samples, 1):
+        images.append({'id': image_id, 'height': args.height, 'width': args.width})
+        true_rles = rles = mask_utils.encode(np.asfortranarray(targets['masks'].transpose(1, 2, 0)))
+        for box, label, crowd, area, rle in zip(
+                targets['boxes'], targets['labels'], targets['crowds'], targets['areas'], rles):
+            rle['counts'] = rle['counts'].decode('ascii')
+            annotations.append({
+                'id': len(annotations) + 1, 'image_id': image_id, 'category_id': int(label) + 1,
+                'bbox': [box[0], box[1], box[2] - box[0], box[3] - box[1]],
+                'area': float(area), 'iscrowd': int(crowd), 'segmentation': rle})
+
+        rles = mask_utils.encode(np.asfortranarray(preds['masks'].transpose(1, 2, 0)))
+        for box, label, score, rle in zip(preds['boxes'], preds['labels'], preds['scores'], rles):
+            rle['counts'] = rle['counts'].decode('ascii')
+            result = {'image_id': image_id, 'category_id': int(label) + 1, 'score': float(score)}
+            results['bbox'].append({**result, 'bbox': [box[0], box[1], box[2] - box[0], box[3] - box[1]]})
+            results['segm'].append({**result, 'segmentation': rle})
+        rle_samples.append(({**preds, 'masks': rles}, {**targets, 'masks': true_rles}))
+
+    categories = [{'id': k + 1, 'name': str(k)} for k in range(args.num_classes)]
+    return {'images': images, 'annotations': annotations, 'categories': categories}, results, rle_samples
+
+
+def run_pycocotools(dataset, results):
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco = COCO()
+        coco.dataset = dataset
+        coco.createIndex()
+        stats = {}
+        for iou_type, name in (('bbox', 'box'), ('segm', 'mask')):
+            coco_eval = COCOeval(coco, coco.loadRes(results[iou_type]), iou_type)
+            coco_eval.evaluate()
+            coco_eval.accumulate()
+            coco_eval.summarize()
+            for i, suffix in enumerate(['', '50', '75', 's', 'm', 'l']):
+                stats[f'{name}/AP{suffix}'] = coco_eval.stats[i]
+
+    return stats
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(args.seed)
+    samples = [make_image(rng) for _ in range(args.num_images)]
+    dataset, results, rle_samples = to_coco(samples)
+
+    start_time = time.perf_counter()
+    expected = run_pycocotools(dataset, results)
+    reference_time = time.perf_counter() - start_time
+
+    timings = {}
+    for name, inputs in (('binary masks', samples), ('rle masks', rle_samples)):
+        start_time = time.perf_counter()
+        with CocoEvaluator(args.num_classes, num_workers=args.num_workers) as evaluator:
+            for preds, targets in inputs:
+                evaluator.add(preds, targets)
+            stats = evaluator.summarize(verbose=False)
+        timings[name] = time.perf_counter() - start_time
+
+    print(f'{args.num_images} images, {len(results["bbox"])} predictions, {args.num_classes} classes')
+    print(f'{"":>10}  {"pycocotools":>11}  {"boda":>8}')
+    for key, value in expected.items():
+        print(f'{key:>10}: {value:>11.4f}  {stats[key]:>8.4f}')
+    print(f'pycocotools: {reference_time:.2f} s')
+    for name, seconds in timings.items():
+        print(f'CocoEvaluator, {args.num_workers} workers, {name}: {seconds:.2f} s')
+
+    error = max(abs(stats[key] - value) for key, value in expected.items())
+    print(f'max difference: {error:.2e}')
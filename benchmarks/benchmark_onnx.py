@@ -0,0 +1,68 @@
+"""Parity and CPU latency of ONNX exports against the eager models
+
+The onnxruntime detections are compared with those of the eager model and
+its postprocess, `YolactInference` or `SsdInference`. Boxes are compared in
+pixels, which onnxruntime truncates to integers.
+
+    $ python benchmarks/benchmark_onnx.py --model yolact --batch-size 2
+"""
+import os
+import argparse
+
+import torch
+
+from boda.models import YolactConfig, YolactModel, SsdConfig, SsdModel
+from boda.models import FasterRcnnConfig, FasterRcnnModel
+from boda.models.backbone_mobilenetv3 import mobilenet_v3_large
+from boda.export import export_onnx, compare_onnx
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--model', default='yolact', choices=['yolact', 'ssd', 'faster_rcnn'])
+parser.add_argument('--weights', default=None, type=str)
+parser.add_argument('--batch-size', default=2, type=int)
+parser.add_argument('--num-runs', default=20, type=int)
+parser.add_argument('--num-threads', default=None, type=int)
+parser.add_argument('--output-dir', default='cache/onnx', type=str)
+args = parser.parse_args()
+
+
+def build_model(name):
+    if name == 'yolact':
+        model = YolactModel(
+            YolactConfig(), backbone=mobilenet_v3_large(), selected_backbone_layers=[6, 12, 15])
+    elif name == 'ssd':
+        model = SsdModel(SsdConfig())
+    else:
+        model = FasterRcnnModel(FasterRcnnConfig())
+
+    if args.weights is not None:
+        model.load_weights(args.weights)
+    elif name == 'yolact':
+        # Random weights score no class above the threshold of YolactInference,
+        # so every prior scores the first class higher
+        with torch.no_grad():
+            bias = model.heads[0].score_layers[-1].bias
+            bias.view(-1, model.config.num_classes)[:, 1] += 6
+
+    return model.eval()
+
+
+if __name__ == '__main__':
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, f'{args.model}.onnx')
+
+    torch.manual_seed(0)
+    model = build_model(args.model)
+    export_onnx(model, path, batch_size=1)
+    # A different batch size than the export checks the dynamic batch axis
+    report = compare_onnx(
+        model, path, batch_size=args.batch_size,
+        num_runs=args.num_runs, num_threads=args.num_threads)
+
+    if report['num_detections'] == 0:
+        raise SystemExit('No detections to compare, lower the score threshold')
+    if report['num_detections_diff'] > 0 or report['max_scores_diff'] > 1e-4 or \
+            report['max_labels_diff'] > 0 or report['max_boxes_diff'] > 1 or \
+            report.get('max_masks_diff', 0.0) > 1e-2:
+        raise SystemExit('onnxruntime outputs differ from the eager model')
@@ -0,0 +1,107 @@
+"""Throughput of each transform in boda.utils.transforms on synthetic samples
+
+    $ python benchmarks/benchmark_transforms.py --height 480 --width 640 --num-masks 20
+"""
+import time
+import argparse
+
+import numpy as np
+
+from boda.utils import transforms as T
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--height', default=480, type=int)
+parser.add_argument('--width', default=640, type=int)
+parser.add_argument('--num-masks', default=20, type=int)
+parser.add_argument('--num-runs', default=100, type=int)
+args = parser.parse_args()
+
+
+def make_sample(rng):
+    h, w = args.height, args.width
+    image = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    x1 = rng.uniform(0, w - 50, args.num_masks)
+    y1 = rng.uniform(0, h - 50, args.num_masks)
+    boxes = np.stack([x1, y1, x1 + 40, y1 + 40], axis=1).astype(np.float32)
+    masks = np.zeros((args.num_masks, h, w), dtype=np.uint8)
+    for mask, box in zip(masks, boxes.astype(np.int64)):
+        mask[box[1]:box[3], box[0]:box[2]] = 1
+
+    return image, {'boxes': boxes, 'masks': masks}
+
+
+def legacy_rotation(image, targets):
+    """RandomRotation before the affine rewrite, with p=1"""
+    old_height, old_width, _ = image.shape
+    k = np.random.randint(4)
+    image = np.rot90(image, k)
+    boxes = targets['boxes'].copy()
+    for _ in range(k):
+        boxes = np.array([[
+            box[1], old_width - 1 - box[2],
+            box[3], old_width - 1 - box[0]] for box in boxes])
+        old_width, old_height = old_height, old_width
+    targets['masks'] = np.array([np.rot90(mask, k) for mask in targets['masks']])
+
+    return image, targets
+
+
+def legacy_pad(image, targets, width, height):
+    """Pad before the affine rewrite"""
+    im_h, im_w, depth = image.shape
+    expand_image = np.zeros((height, width, depth), dtype=image.dtype)
+    expand_image[:im_h, :im_w] = image
+    expand_masks = np.zeros(
+        (targets['masks'].shape[0], height, width), dtype=targets['masks'].dtype)
+    expand_masks[:, :im_h, :im_w] = targets['masks']
+    targets['masks'] = expand_masks
+
+    return expand_image, targets
+
+
+def measure(transform, samples, float_image=False):
+    """Returns samples per second"""
+    inputs = []
+    for image, targets in samples:
+        image = image.astype(np.float32) if float_image else image.copy()
+        inputs.append((image, {k: v.copy() for k, v in targets.items()}))
+
+    start_time = time.perf_counter()
+    for image, targets in inputs:
+        transform(image, targets)
+
+    return len(inputs) / (time.perf_counter() - start_time)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    np.random.seed(0)
+    samples = [make_sample(rng) for _ in range(args.num_runs)]
+    pad_size = (args.width + 64, args.height + 64)
+
+    geometric = [
+        T.RandomFlip(p=1.0, horizontal=True),
+        T.RandomRotation(p=1.0),
+        T.Pad(*pad_size, p=1.0),
+        T.Resize(550, 550),
+    ]
+    benchmarks = [
+        ('RandomFlip', T.RandomFlip(p=1.0, horizontal=True), False),
+        ('RandomRotation', T.RandomRotation(p=1.0), False),
+        ('RandomRotation (legacy)', legacy_rotation, False),
+        ('Pad', T.Pad(*pad_size, p=1.0), False),
+        ('Pad (legacy)', lambda i, t: legacy_pad(i, t, *pad_size), False),
+        ('Resize', T.Resize(550, 550), False),
+        ('ConvertFromInts', T.ConvertFromInts(), False),
+        ('RandomBrightness', T.RandomBrightness(p=1.0), True),
+        ('RandomContrast', T.RandomContrast(p=1.0), True),
+        ('RandomSaturation', T.RandomSaturation(p=1.0), True),
+        ('RandomHue', T.RandomHue(p=1.0), True),
+        ('Compose (4 geometric, fused)', T.Compose(geometric), False),
+        ('Compose (4 geometric, unfused)', T.Compose(geometric, fuse=False), False),
+    ]
+
+    print(f'{args.height}x{args.width} image, {args.num_masks} masks')
+    for name, transform, float_image in benchmarks:
+        print(f'{name:>32}: {measure(transform, samples, float_image):>9.1f} samples/s')
@@ -0,0 +1,112 @@
+"""End-to-end smoke test of validation with YOLACT and YolactInference
+
+Runs `evaluate_model` with a ResNet-50 YOLACT on synthetic images of mixed
+sizes, once with the untrained model, which detects nothing, and once with
+a class bias that makes it detect boxes. In the second run the ground truth
+is the prediction of the model on each image alone, so the box mAP must be
+1. Batches are padded by `DetectionCollate`, so each run is also checked
+against a batch size of one.
+
+    $ python benchmarks/validation_smoke_test.py --batch-size 3
+"""
+import sys
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from boda.models import YolactConfig, YolactModel
+from boda.models.backbone_resnet import resnet50
+from boda.models.yolact.inference_yolact import YolactInference
+from boda.utils.dataset import DetectionCollate
+from boda.utils.evaluation import CocoEvaluator
+from boda.utils.validation import evaluate_model
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--num-images', default=6, type=int)
+parser.add_argument('--batch-size', default=3, type=int)
+parser.add_argument('--num-classes', default=3, type=int)
+args = parser.parse_args()
+
+
+class SyntheticDataset(Dataset):
+    """Rectangles on noise, in the validation mode of :class:`CocoDataset`"""
+    def __init__(self, num_images):
+        rng = np.random.default_rng(0)
+        self.samples = []
+        for _ in range(num_images):
+            h, w = rng.integers(200, 480, 2)
+            image = torch.as_tensor(rng.uniform(0, 255, (3, h, w)), dtype=torch.float32)
+            boxes, masks = [], []
+            for _ in range(3):
+                x1, y1 = rng.integers(0, w - 60), rng.integers(0, h - 60)
+                x2, y2 = min(x1 + rng.integers(40, 160), w), min(y1 + rng.integers(40, 160), h)
+                mask = torch.zeros(h, w, dtype=torch.uint8)
+                mask[y1:y2, x1:x2] = 1
+                boxes.append([x1, y1, x2, y2])
+                masks.append(mask)
+            self.samples.append((image, {
+                'boxes': torch.as_tensor(boxes, dtype=torch.float32),
+                'masks': torch.stack(masks),
+                'labels': torch.as_tensor(rng.integers(0, args.num_classes, 3), dtype=torch.int64),
+                'crowds': torch.zeros(3, dtype=torch.int64),
+            }, int(h), int(w)))
+
+    def set_targets(self, targets):
+        self.samples = [
+            (image, target, h, w) for (image, _, h, w), target in zip(self.samples, targets)]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        return self.samples[index]
+
+
+def validate(model, dataset, batch_size):
+    loader = DataLoader(dataset, batch_size=batch_size, collate_fn=DetectionCollate())
+    evaluator = CocoEvaluator(args.num_classes)
+    return evaluate_model(
+        model, loader, evaluator, YolactInference(args.num_classes + 1), args.device)
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    model = YolactModel(YolactConfig(num_classes=args.num_classes), backbone=resnet50())
+    model = model.to(args.device).eval()
+    dataset = SyntheticDataset(args.num_images)
+
+    failed = False
+    for name in ('untrained', 'biased'):
+        if name == 'biased':
+            # Every prior scores the first class above the threshold
+            with torch.no_grad():
+                bias = model.heads[0].score_layers[-1].bias.view(-1, args.num_classes + 1)
+                bias[:, 1] += 6
+                postprocess = YolactInference(args.num_classes + 1)
+                targets = []
+                for image, _, h, w in dataset.samples:
+                    preds = postprocess(model([image.to(args.device)]), [(h, w)])[0]
+                    targets.append({
+                        'boxes': preds['boxes'].float().cpu(),
+                        'masks': preds['masks'].byte().cpu(),
+                        'labels': preds['labels'].cpu(),
+                        'crowds': torch.zeros(len(preds['labels']), dtype=torch.int64),
+                    })
+            dataset.set_targets(targets)
+
+        single = validate(model, dataset, 1)
+        batched = validate(model, dataset, args.batch_size)
+        error = max(abs(single[key] - batched[key]) for key in single)
+        print(f'{name:>10}: box/AP {batched["box/AP"]:.4f}, mask/AP {batched["mask/AP"]:.4f}, '
+              f'max difference to batch size 1 {error:.2e}')
+        failed |= error > 1e-6
+        if name == 'biased':
+            # Masks of random weights are mostly empty, which match nothing
+            failed |= batched['box/AP'] < 0.99
+
+    if failed:
+        sys.exit('Validation of padded batches is wrong')
@@ -22,7 +22,12 @@ class BaseConfig:
 
     def __init__(self, **kwargs):
         self.use_torchscript = kwargs.pop('use_torchscript', False)
-        # self.use_fp16 = kwargs.pop('use_fp16', False)
+        # Precision policy of backbone, neck and heads: fp32, bf16 or fp16 autocast.
+        # Box decoding, softmax and NMS IoU always run in fp32.
+        use_fp16 = kwargs.pop('use_fp16', False)
+        self.precision = kwargs.pop('precision', 'fp16' if use_fp16 else 'fp32')
+        if self.precision not in ('fp32', 'bf16', 'fp16'):
+            raise ValueError(f'precision must be fp32, bf16 or fp16, got {self.precision}.')
         self.label_map = kwargs.pop('label_map', {})
         self.num_classes = kwargs.pop('num_classes', 0)
         self.min_size = kwargs.pop('min_size', None)
@@ -0,0 +1,10 @@
+from .onnx import (
+    YolactOnnxModule, SsdOnnxModule, FasterRcnnOnnxModule,
+    OrtInference, export_onnx, compare_onnx
+)
+
+
+__all__ = [
+    'YolactOnnxModule', 'SsdOnnxModule', 'FasterRcnnOnnxModule',
+    'OrtInference', 'export_onnx', 'compare_onnx',
+]
@@ -0,0 +1,754 @@
+import time
+import inspect
+from typing import Tuple, List, Dict, Union, Callable, Optional
+
+import numpy as np
+import torch
+from torch import nn, Tensor
+import torch.nn.functional as F
+from torchvision.ops import nms, roi_align
+
+from ..ops.box import decode, jaccard, sanitize_coordinates
+from ..models.yolact.architecture_yolact import YolactModel
+from ..models.yolact.inference_yolact import YolactInference
+from ..models.yolact.torchscript_yolact import YolactScriptModule
+from ..models.ssd.architecture_ssd import SsdModel
+from ..models.ssd.inference_ssd import SsdInference
+from ..models.faster_rcnn.architecture_faster_rcnn import FasterRcnnModel
+from ..models.faster_rcnn.rpn import concat_box_prediction_layers
+
+
+class BatchedNonMaxSuppression(torch.autograd.Function):
+    """Batched NMS exported as the ONNX `NonMaxSuppression` op
+
+    Boxes with a score not above `score_threshold` are ignored, the
+    remaining boxes are suppressed per image and per class.
+
+    Args:
+        boxes (:obj:`FloatTensor[B, N, 4]`): x1, y1, x2, y2
+        scores (:obj:`FloatTensor[B, C, N]`):
+        max_output_boxes_per_class (:obj:`int`):
+        iou_threshold (:obj:`float`):
+        score_threshold (:obj:`float`):
+
+    Returns:
+        selected_indices (:obj:`LongTensor[K, 3]`): batch, class and box indexes
+    """
+    @staticmethod
+    def forward(
+        ctx,
+        boxes: Tensor,
+        scores: Tensor,
+        max_output_boxes_per_class: int,
+        iou_threshold: float,
+        score_threshold: float
+    ) -> Tensor:
+        selected_indices = []
+        for b in range(scores.size(0)):
+            for c in range(scores.size(1)):
+                index = torch.where(scores[b, c] > score_threshold)[0]
+                keep = nms(boxes[b, index], scores[b, c, index], iou_threshold)
+                index = index[keep[:max_output_boxes_per_class]]
+                selected_indices.append(torch.stack([
+                    torch.full_like(index, b), torch.full_like(index, c), index], dim=1))
+
+        return torch.cat(selected_indices).to(boxes.device)
+
+    @staticmethod
+    def symbolic(g, boxes, scores, max_output_boxes_per_class, iou_threshold, score_threshold):
+        return g.op(
+            'NonMaxSuppression',
+            boxes,
+            scores,
+            g.op('Constant', value_t=torch.tensor([max_output_boxes_per_class], dtype=torch.long)),
+            g.op('Constant', value_t=torch.tensor([iou_threshold], dtype=torch.float)),
+            g.op('Constant', value_t=torch.tensor([score_threshold], dtype=torch.float)),
+            center_point_box_i=0)
+
+
+def batched_nms_keep(
+    boxes: Tensor,
+    scores: Tensor,
+    iou_threshold: float,
+    score_threshold: float = 0.0,
+    max_output_boxes: int = 10000
+) -> Tensor:
+    """Dense keep mask of greedy NMS over a batch
+
+    Args:
+        boxes (:obj:`FloatTensor[B, N, 4]`): boxes of different groups, e.g.
+            classes, must be moved apart so that they never overlap
+        scores (:obj:`FloatTensor[B, N]`):
+
+    Returns:
+        keep (:obj:`BoolTensor[B, N]`):
+    """
+    selected_indices = BatchedNonMaxSuppression.apply(
+        boxes, scores.unsqueeze(1), max_output_boxes, iou_threshold, score_threshold)
+
+    keep = torch.zeros_like(scores)
+    keep[selected_indices[:, 0], selected_indices[:, 2]] = 1.0
+
+    return keep > 0
+
+
+def batched_fast_nms(
+    boxes: Tensor,
+    scores: Tensor,
+    iou_threshold: float = 0.5,
+    top_k: int = 200
+) -> Tuple[Tensor, Tensor]:
+    """Fast NMS of YOLACT as a vectorized subgraph over a batch
+
+    Args:
+        boxes (:obj:`FloatTensor[B, N, 4]`):
+        scores (:obj:`FloatTensor[B, C, N]`):
+        iou_threshold (:obj:`float`):
+        top_k (:obj:`int`): candidates per class
+
+    Returns:
+        scores (:obj:`FloatTensor[B, C, K]`): suppressed candidates are zero
+        index (:obj:`LongTensor[B, C, K]`): box index of each candidate
+    """
+    batch_size, num_classes, num_boxes = scores.size()
+    top_k = min(top_k, num_boxes)
+
+    scores, index = scores.topk(top_k, dim=2)
+    boxes = torch.gather(
+        boxes.unsqueeze(1).expand(batch_size, num_classes, num_boxes, 4), 2,
+        index.unsqueeze(3).expand(batch_size, num_classes, top_k, 4))
+
+    iou = jaccard(boxes.view(-1, top_k, 4), boxes.view(-1, top_k, 4))
+    # Upper triangle without the diagonal, written without Trilu for older opsets
+    arange = torch.arange(top_k, device=boxes.device)
+    iou = iou * (arange.view(1, 1, -1) > arange.view(1, -1, 1)).float()
+    iou_max, _ = iou.max(dim=1)
+
+    keep = iou_max.view(batch_size, num_classes, top_k) <= iou_threshold
+
+    return scores * keep.float(), index
+
+
+def _select_detections(
+    scores: Tensor,
+    num_detections: int
+) -> Tuple[Tensor, Tensor]:
+    """Top detections of each image over all classes
+
+    Args:
+        scores (:obj:`FloatTensor[B, M]`): suppressed or invalid candidates are zero
+
+    Returns:
+        scores (:obj:`FloatTensor[B, D]`):
+        index (:obj:`LongTensor[B, D]`):
+    """
+    num_detections = min(num_detections, scores.size(1))
+
+    return scores.topk(num_detections, dim=1)
+
+
+class YolactOnnxModule(YolactScriptModule):
+    """YOLACT with decoding, Fast NMS and mask assembly in the graph
+
+    Outputs have a fixed number of detections per image, so the graph works
+    with a dynamic batch size. Padded detections have zero scores.
+
+    Args:
+        model (:class:`YolactModel`):
+        kwargs: arguments of :class:`YolactScriptModule`
+    """
+    model_type = 'yolact'
+
+    def forward(self, images: Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        """
+        Args:
+            images (:obj:`FloatTensor[B, C, H, W]`): resized images
+
+        Returns:
+            boxes (:obj:`FloatTensor[B, D, 4]`): relative x1, y1, x2, y2
+            scores (:obj:`FloatTensor[B, D]`):
+            labels (:obj:`LongTensor[B, D]`): class index without background
+            masks (:obj:`FloatTensor[B, D, H, W]`): cropped mask probabilities of the protonet size
+        """
+        boxes, scores, mask_coefs, proto_masks = self.predict(images)
+        boxes = decode(boxes, self.prior_boxes)
+
+        scores = scores[:, :, 1:]
+        max_scores, _ = scores.max(dim=2)
+        scores = scores * (max_scores > self.conf_threshold).unsqueeze(2).float()
+
+        scores, index = batched_fast_nms(
+            boxes, scores.transpose(1, 2), self.nms_threshold, self.nms_top_k)
+        batch_size, num_classes, top_k = scores.size()
+
+        scores, detections = _select_detections(scores.view(batch_size, -1), self.top_k)
+        labels = detections // top_k
+        index = torch.gather(index.view(batch_size, -1), 1, detections)
+
+        boxes = torch.gather(boxes, 1, index.unsqueeze(2).expand(-1, -1, 4))
+        mask_coefs = torch.gather(
+            mask_coefs, 1, index.unsqueeze(2).expand(-1, -1, mask_coefs.size(2)))
+
+        masks = torch.sigmoid(torch.matmul(mask_coefs, proto_masks.flatten(1, 2).transpose(1, 2)))
+        masks = masks.view(batch_size, -1, proto_masks.size(1), proto_masks.size(2))
+        masks = _crop(masks, boxes)
+
+        return boxes, scores, labels, masks
+
+
+def _crop(masks: Tensor, boxes: Tensor, padding: int = 1) -> Tensor:
+    """Batched `boda.ops.box.crop`
+
+    Args:
+        masks (:obj:`FloatTensor[B, D, H, W]`):
+        boxes (:obj:`FloatTensor[B, D, 4]`): relative x1, y1, x2, y2
+    """
+    h, w = masks.size(2), masks.size(3)
+    x1, x2 = sanitize_coordinates(boxes[..., 0], boxes[..., 2], w, padding, cast=False)
+    y1, y2 = sanitize_coordinates(boxes[..., 1], boxes[..., 3], h, padding, cast=False)
+
+    cols = torch.arange(w, device=masks.device, dtype=x1.dtype).view(1, 1, 1, -1)
+    rows = torch.arange(h, device=masks.device, dtype=x1.dtype).view(1, 1, -1, 1)
+
+    crop_mask = \
+        (cols >= x1[..., None, None]) & (cols < x2[..., None, None]) & \
+        (rows >= y1[..., None, None]) & (rows < y2[..., None, None])
+
+    return masks * crop_mask.float()
+
+
+class SsdOnnxModule(nn.Module):
+    """SSD with decoding and NMS in the graph
+
+    Args:
+        model (:class:`SsdModel`):
+        conf_threshold (:obj:`float`):
+        nms_threshold (:obj:`float`):
+        top_k (:obj:`int`): detections per image
+    """
+    model_type = 'ssd'
+
+    def __init__(
+        self,
+        model: SsdModel,
+        conf_threshold: float = 0.01,
+        nms_threshold: float = 0.45,
+        top_k: int = 200
+    ) -> None:
+        super().__init__()
+        model = model.eval()
+        self.size = list(model.config.max_size)
+        self.variances = tuple(model.config.variance)
+        self.conf_threshold = conf_threshold
+        self.nms_threshold = nms_threshold
+        self.top_k = top_k
+
+        self.backbone = model.backbone
+        self.neck = model.neck
+        self.heads = model.heads
+
+        device = next(model.parameters()).device
+        with torch.no_grad():
+            outputs = model(torch.zeros(1, 3, *self.size, device=device))
+        self.register_buffer('prior_boxes', outputs['prior_boxes'].detach().clone().to(device))
+
+    def forward(self, images: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Args:
+            images (:obj:`FloatTensor[B, C, H, W]`): resized images
+
+        Returns:
+            boxes (:obj:`FloatTensor[B, D, 4]`): relative x1, y1, x2, y2
+            scores (:obj:`FloatTensor[B, D]`):
+            labels (:obj:`LongTensor[B, D]`): class index without background
+        """
+        outputs = self.backbone(images)
+        outputs = self.neck(outputs)
+
+        boxes = []
+        scores = []
+        for output, head in zip(outputs, self.heads):
+            # Same layout as `SsdPredictHead.forward`
+            boxes.append(head.box_layer(output).view(images.size(0), -1, 4))
+            scores.append(head.score_layer(output).view(images.size(0), -1, head.num_classes))
+
+        boxes = decode(torch.cat(boxes, dim=1), self.prior_boxes, self.variances)
+        scores = F.softmax(torch.cat(scores, dim=1), dim=-1)[:, :, 1:]
+        batch_size, num_boxes, num_classes = scores.size()
+
+        # Classes are moved apart, so one NMS call suppresses each class separately
+        offsets = torch.arange(num_classes, device=boxes.device, dtype=boxes.dtype)
+        offsets = offsets * (boxes.max() - boxes.min() + 1)
+        class_boxes = boxes.unsqueeze(1) + offsets.view(1, -1, 1, 1)
+        scores = scores.transpose(1, 2).reshape(batch_size, -1)
+
+        keep = batched_nms_keep(
+            class_boxes.reshape(batch_size, -1, 4), scores, self.nms_threshold, self.conf_threshold)
+        scores, detections = _select_detections(scores * keep.float(), self.top_k)
+
+        labels = detections // num_boxes
+        boxes = torch.gather(boxes, 1, (detections % num_boxes).unsqueeze(2).expand(-1, -1, 4))
+
+        return boxes, scores, labels
+
+
+class FasterRcnnOnnxModule(nn.Module):
+    """Faster R-CNN with proposals, RoI align, decoding and NMS in the graph
+
+    Proposals are kept at a fixed number per image, so the graph works with a
+    dynamic batch size. Padded proposals and detections have zero scores.
+
+    Args:
+        model (:class:`FasterRcnnModel`):
+        size (:obj:`Tuple[int, int]`): input resolution
+    """
+    model_type = 'faster_rcnn'
+
+    def __init__(
+        self,
+        model: FasterRcnnModel,
+        size: Tuple[int, int] = (800, 800)
+    ) -> None:
+        super().__init__()
+        model = model.eval()
+        self.size = [int(size[0]), int(size[1])]
+
+        self.backbone = model.backbone
+        self.neck = model.neck
+        self.rpn_head = model.rpn.head
+        self.box_head = model.roi_heads.box_head
+        self.box_predictor = model.roi_heads.box_predictor
+
+        self.rpn_box_coder = model.rpn.box_coder
+        self.roi_box_coder = model.roi_heads.box_coder
+        self.pre_nms_top_n = model.rpn._pre_nms_top_n['testing']
+        self.post_nms_top_n = model.rpn._post_nms_top_n['testing']
+        self.rpn_nms_threshold = model.rpn.nms_thresh
+        self.rpn_min_size = model.rpn.min_size
+        self.score_threshold = model.roi_heads.score_thresh
+        self.nms_threshold = model.roi_heads.nms_thresh
+        self.detections_per_img = model.roi_heads.detections_per_img
+
+        self.box_roi_pool = model.roi_heads.box_roi_pool
+        self._setup(model)
+
+    def _setup(self, model: FasterRcnnModel) -> None:
+        device = next(model.parameters()).device
+        images = torch.zeros(1, 3, *self.size, device=device)
+        with torch.no_grad():
+            features = self.neck(self.backbone(images))
+
+        self.num_anchors_per_level = [
+            feature.size(2) * feature.size(3) * num_anchors
+            for feature, num_anchors in zip(
+                features, model.rpn.anchor_generator.num_anchors_per_location())]
+        anchors = model.rpn.anchor_generator(images, [tuple(self.size)], features)[0]
+        self.register_buffer('anchors', anchors.detach().clone())
+
+        # The pooler infers the scales of feature maps on its first call
+        features = {str(i): feature for i, feature in enumerate(features)}
+        self.box_roi_pool(features, [torch.zeros(1, 4, device=device)], [tuple(self.size)])
+
+    def forward(self, images: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Args:
+            images (:obj:`FloatTensor[B, C, H, W]`): resized images
+
+        Returns:
+            boxes (:obj:`FloatTensor[B, D, 4]`): relative x1, y1, x2, y2
+            scores (:obj:`FloatTensor[B, D]`):
+            labels (:obj:`LongTensor[B, D]`): class index with background at 0
+        """
+        features = self.neck(self.backbone(images))
+        proposals, proposal_scores = self.propose(images, features)
+        batch_size, num_proposals = proposal_scores.size()
+
+        batch_index = torch.arange(batch_size, device=images.device, dtype=proposals.dtype)
+        batch_index = batch_index.view(-1, 1, 1).expand(batch_size, num_proposals, 1)
+        rois = torch.cat([batch_index, proposals], dim=2).view(-1, 5)
+
+        box_features = self.roi_align(features, rois)
+        box_features = self.box_head(box_features)
+        class_logits, box_regression = self.box_predictor(box_features)
+
+        boxes = self.roi_box_coder.decode_single(box_regression, rois[:, 1:])
+        boxes = self.clip(boxes.view(batch_size, num_proposals, -1, 4))
+        scores = F.softmax(class_logits, -1).view(batch_size, num_proposals, -1)
+
+        # Remove background, low scores, empty boxes and padded proposals
+        boxes = boxes[:, :, 1:]
+        scores = scores[:, :, 1:]
+        num_classes = scores.size(2)
+        valid = (scores > self.score_threshold) & \
+            ((boxes[..., 2] - boxes[..., 0]) >= 1e-2) & \
+            ((boxes[..., 3] - boxes[..., 1]) >= 1e-2) & \
+            (proposal_scores > 0).unsqueeze(2)
+        scores = torch.where(valid, scores, torch.zeros_like(scores) - 1)
+
+        # Classes are moved apart, so one NMS call suppresses each class separately
+        offsets = torch.arange(num_classes, device=boxes.device, dtype=boxes.dtype)
+        offsets = offsets * (max(self.size) + 1)
+        class_boxes = boxes + offsets.view(1, 1, -1, 1)
+
+        boxes = boxes.reshape(batch_size, -1, 4)
+        scores = scores.reshape(batch_size, -1)
+        keep = batched_nms_keep(
+            class_boxes.reshape(batch_size, -1, 4), scores, self.nms_threshold, 0.0)
+        scores, detections = _select_detections(
+            scores.clamp(min=0) * keep.float(), self.detections_per_img)
+
+        labels = detections % num_classes + 1
+        boxes = torch.gather(boxes, 1, detections.unsqueeze(2).expand(-1, -1, 4))
+        scale = torch.tensor(
+            [self.size[1], self.size[0], self.size[1], self.size[0]],
+            dtype=boxes.dtype, device=boxes.device)
+
+        return boxes / scale, scores, labels
+
+    def propose(self, images: Tensor, features: List[Tensor]) -> Tuple[Tensor, Tensor]:
+        """
+        Returns:
+            proposals (:obj:`FloatTensor[B, P, 4]`):
+            scores (:obj:`FloatTensor[B, P]`): objectness plus one, zero for padded proposals
+        """
+        batch_size = images.size(0)
+        objectness, box_regression = self.rpn_head(features)
+        objectness, box_regression = concat_box_prediction_layers(objectness, box_regression)
+
+        anchors = self.anchors.unsqueeze(0).expand(batch_size, -1, 4).reshape(-1, 4)
+        proposals = self.rpn_box_coder.decode_single(box_regression, anchors)
+        proposals = proposals.view(batch_size, -1, 4)
+        objectness = objectness.view(batch_size, -1)
+
+        # Top candidates of each level before NMS
+        index = []
+        levels = []
+        offset = 0
+        for level, num_anchors in enumerate(self.num_anchors_per_level):
+            top_n = min(self.pre_nms_top_n, num_anchors)
+            _, top_n_index = objectness[:, offset:offset + num_anchors].topk(top_n, dim=1)
+            index.append(top_n_index + offset)
+            levels.append(torch.full(
+                (top_n,), level, dtype=proposals.dtype, device=proposals.device))
+            offset += num_anchors
+
+        index = torch.cat(index, dim=1)
+        levels = torch.cat(levels)
+        proposals = self.clip(torch.gather(proposals, 1, index.unsqueeze(2).expand(-1, -1, 4)))
+        scores = torch.sigmoid(torch.gather(objectness, 1, index))
+
+        valid = ((proposals[..., 2] - proposals[..., 0]) >= self.rpn_min_size) & \
+            ((proposals[..., 3] - proposals[..., 1]) >= self.rpn_min_size)
+        scores = torch.where(valid, scores, torch.zeros_like(scores) - 1)
+
+        # Levels are moved apart, so one NMS call suppresses each level separately
+        level_proposals = proposals + (levels * (max(self.size) + 1)).view(1, -1, 1)
+        keep = batched_nms_keep(level_proposals, scores, self.rpn_nms_threshold, -0.5)
+        # Objectness is shifted so that kept proposals with zero probability are not padding
+        scores, index = _select_detections((scores + 1) * keep.float(), self.post_nms_top_n)
+        proposals = torch.gather(proposals, 1, index.unsqueeze(2).expand(-1, -1, 4))
+
+        return proposals, scores
+
+    def roi_align(self, features: List[Tensor], rois: Tensor) -> Tensor:
+        """`MultiScaleRoIAlign` on rois of a whole batch
+
+        Every level pools all rois and each roi takes the features of its
+        level, as assigning the rois of a level by index gives a graph with
+        data-dependent shapes that onnxruntime can not run.
+        """
+        levels = self.box_roi_pool.map_levels([rois[:, 1:]]).view(-1, 1, 1, 1)
+
+        result = None
+        for level, scale in enumerate(self.box_roi_pool.scales):
+            pooled = roi_align(
+                features[level], rois,
+                output_size=self.box_roi_pool.output_size,
+                spatial_scale=scale,
+                sampling_ratio=self.box_roi_pool.sampling_ratio)
+            result = pooled if result is None else torch.where(levels == level, pooled, result)
+
+        return result
+
+    def clip(self, boxes: Tensor) -> Tensor:
+        h, w = self.size
+        x = boxes[..., 0::2].clamp(min=0, max=w)
+        y = boxes[..., 1::2].clamp(min=0, max=h)
+
+        return torch.stack([x[..., 0], y[..., 0], x[..., 1], y[..., 1]], dim=-1)
+
+
+ONNX_MODULES = {
+    YolactModel: YolactOnnxModule,
+    SsdModel: SsdOnnxModule,
+    FasterRcnnModel: FasterRcnnOnnxModule,
+}
+
+
+def export_onnx(
+    model: nn.Module,
+    path: str,
+    batch_size: int = 1,
+    opset_version: int = 16,
+    **kwargs
+) -> nn.Module:
+    """Export YOLACT, SSD or Faster R-CNN with a dynamic batch size
+
+    Args:
+        model (:obj:`nn.Module`): :class:`YolactModel`, :class:`SsdModel`,
+            :class:`FasterRcnnModel` or one of their ONNX modules
+        path (:obj:`str`):
+        batch_size (:obj:`int`): batch size of the example input
+        opset_version (:obj:`int`): RoI align of Faster R-CNN requires 16
+        kwargs: arguments of the ONNX module
+
+    Returns:
+        module (:obj:`nn.Module`): the exported ONNX module, e.g. to compare with
+            the onnxruntime session
+    """
+    import onnx
+
+    module = model
+    if not hasattr(model, 'model_type'):
+        for model_class, module_class in ONNX_MODULES.items():
+            if isinstance(model, model_class):
+                module = module_class(model, **kwargs)
+                break
+        else:
+            raise ValueError(f'{type(model).__name__} can not be exported to ONNX.')
+
+    module = module.eval()
+    device = next(module.parameters()).device
+    images = torch.rand(batch_size, 3, *module.size, device=device)
+
+    output_names = ['boxes', 'scores', 'labels']
+    if module.model_type == 'yolact':
+        output_names.append('masks')
+
+    export_kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # The dynamo exporter does not use the symbolic of BatchedNonMaxSuppression
+        export_kwargs['dynamo'] = False
+
+    with torch.no_grad():
+        torch.onnx.export(
+            module,
+            (images,),
+            path,
+            input_names=['images'],
+            output_names=output_names,
+            dynamic_axes={name: {0: 'batch_size'} for name in ['images'] + output_names},
+            opset_version=opset_version,
+            **export_kwargs)
+
+    # OrtInference reads the preprocessing from the metadata
+    onnx_model = onnx.load(path)
+    metadata = {'model_type': module.model_type, 'size': f'{module.size[0]},{module.size[1]}'}
+    for key, value in metadata.items():
+        prop = onnx_model.metadata_props.add()
+        prop.key = key
+        prop.value = value
+    onnx.save(onnx_model, path)
+
+    return module
+
+
+class OrtInference:
+    """onnxruntime CPU backend of exported detection models
+
+    Returns the same dictionaries as :class:`YolactInference`.
+
+    Args:
+        path (:obj:`str`): model exported by `export_onnx`
+        num_threads (:obj:`int`): intra-op threads, onnxruntime default if None
+        mask_threshold (:obj:`float`):
+        providers (:obj:`List[str]`): `CPUExecutionProvider` if None
+
+    Examples::
+        >>> export_onnx(model, 'yolact.onnx')
+        >>> inference = OrtInference('yolact.onnx')
+        >>> outputs = inference([image])  # [{'boxes', 'scores', 'labels', 'masks'}]
+    """
+    def __init__(
+        self,
+        path: str,
+        num_threads: Optional[int] = None,
+        mask_threshold: float = 0.5,
+        providers: Optional[List[str]] = None
+    ) -> None:
+        import onnxruntime
+
+        if providers is None:
+            providers = ['CPUExecutionProvider']
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+
+        self.session = onnxruntime.InferenceSession(path, options, providers=providers)
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.model_type = metadata['model_type']
+        self.size = tuple(int(v) for v in metadata['size'].split(','))
+        self.output_names = [output.name for output in self.session.get_outputs()]
+        self.mask_threshold = mask_threshold
+
+    def preprocess(
+        self,
+        images: List[Union[Tensor, np.ndarray]]
+    ) -> Tuple[np.ndarray, List[Tuple[int, int]]]:
+        """Resize images like `Model.resize_inputs`
+
+        Args:
+            images (:obj:`List[FloatTensor[C, H, W]]`): or :obj:`ndarray[H, W, C]`
+        """
+        tensors = []
+        image_sizes = []
+        for image in images:
+            if isinstance(image, np.ndarray):
+                image = torch.as_tensor(image.transpose((2, 0, 1)), dtype=torch.float32)
+            image = image.float().cpu()
+            image_sizes.append((image.size(1), image.size(2)))
+            tensors.append(F.interpolate(image.unsqueeze(0), size=self.size, mode='nearest'))
+
+        return torch.cat(tensors).numpy(), image_sizes
+
+    def run(self, images: np.ndarray) -> Dict[str, np.ndarray]:
+        outputs = self.session.run(self.output_names, {'images': images})
+
+        return dict(zip(self.output_names, outputs))
+
+    def __call__(self, images: List[Union[Tensor, np.ndarray]]) -> List[Dict[str, Tensor]]:
+        inputs, image_sizes = self.preprocess(images)
+        outputs = {k: torch.from_numpy(v) for k, v in self.run(inputs).items()}
+
+        return_list = []
+        for i, (h, w) in enumerate(image_sizes):
+            keep = outputs['scores'][i] > 0
+            boxes = outputs['boxes'][i][keep]
+
+            x1, x2 = sanitize_coordinates(boxes[:, 0], boxes[:, 2], w, cast=False)
+            y1, y2 = sanitize_coordinates(boxes[:, 1], boxes[:, 3], h, cast=False)
+
+            return_dict = {
+                'boxes': torch.stack([x1, y1, x2, y2], dim=1).long(),
+                'scores': outputs['scores'][i][keep],
+                'labels': outputs['labels'][i][keep],
+            }
+
+            if 'masks' in outputs:
+                masks = outputs['masks'][i][keep]
+                masks = F.interpolate(
+                    masks.unsqueeze(0), size=(h, w), mode='bilinear', align_corners=False)
+                masks = masks.squeeze(0)
+                return_dict['masks'] = masks.gt(self.mask_threshold).float()
+
+            return_list.append(return_dict)
+
+        return return_list
+
+
+def _default_postprocess(model: nn.Module) -> Optional[Callable]:
+    if isinstance(model, YolactModel):
+        return YolactInference(model.config.num_classes)
+    if isinstance(model, SsdModel):
+        return SsdInference(model.config.num_classes + 1, variances=model.config.variance)
+
+    return None
+
+
+def _eager_detections(
+    model: nn.Module,
+    images: Tensor,
+    postprocess: Optional[Callable] = None
+) -> List[Dict[str, Tensor]]:
+    """Detections of the eager model and its postprocess on images at the export size"""
+    image_sizes = [(images.size(2), images.size(3))] * images.size(0)
+    if isinstance(model, YolactModel):
+        return postprocess(model(list(images)), image_sizes)
+    if isinstance(model, SsdModel):
+        return postprocess(model(images), image_sizes)
+    if isinstance(model, FasterRcnnModel):
+        # The forward resizes to its own range, so the RPN and the RoI heads
+        # are called on the images at the export size
+        features = model.neck(model.backbone(images))
+        features = {str(i): feature for i, feature in enumerate(features)}
+        proposals = model.rpn(images, image_sizes, features)
+
+        return model.roi_heads(features, proposals, image_sizes)
+
+    raise ValueError(
+        f'{type(model).__name__} is not a YolactModel, SsdModel or FasterRcnnModel.')
+
+
+def compare_onnx(
+    model: nn.Module,
+    path: str,
+    batch_size: int = 2,
+    num_runs: int = 20,
+    num_threads: Optional[int] = None,
+    seed: int = 0,
+    postprocess: Optional[Callable] = None
+) -> Dict[str, float]:
+    """Report parity and CPU latency of an exported model against the eager model
+
+    Detections of :class:`OrtInference` are compared in score order with
+    those of the eager model and its postprocess, on random images at the
+    export size. Boxes are in pixels and the masks difference is the share
+    of differing pixels. Latencies include pre- and postprocessing.
+
+    Args:
+        model (:obj:`nn.Module`): the exported :class:`YolactModel`,
+            :class:`SsdModel` or :class:`FasterRcnnModel`
+        path (:obj:`str`): exported model
+        batch_size (:obj:`int`): may differ from the export batch size
+        num_runs (:obj:`int`):
+        num_threads (:obj:`int`):
+        seed (:obj:`int`):
+        postprocess (:obj:`Callable`): of the eager outputs, a default
+            :class:`YolactInference` or :class:`SsdInference` if None
+    """
+    inference = OrtInference(path, num_threads=num_threads)
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.rand(batch_size, 3, *inference.size, generator=generator) * 255
+
+    model = model.cpu().eval()
+    if postprocess is None:
+        postprocess = _default_postprocess(model)
+
+    with torch.no_grad():
+        eager_outputs = _eager_detections(model, images, postprocess)
+    ort_outputs = inference(list(images))
+
+    report = {'num_detections': 0, 'num_detections_diff': 0}
+    report.update({f'max_{name}_diff': 0.0 for name in ort_outputs[0]})
+    for eager, ort in zip(eager_outputs, ort_outputs):
+        num_eager, num_ort = len(eager['scores']), len(ort['scores'])
+        report['num_detections'] += num_eager
+        report['num_detections_diff'] += abs(num_eager - num_ort)
+
+        num_detections = min(num_eager, num_ort)
+        for name in ort:
+            diff = (eager[name][:num_detections].cpu().float() - ort[name][:num_detections].float())
+            diff = diff.abs()
+            if name == 'masks':
+                diff = diff.flatten(1).mean(1)
+            if diff.numel() > 0:
+                report[f'max_{name}_diff'] = max(report[f'max_{name}_diff'], float(diff.max()))
+
+    with torch.no_grad():
+        start_time = time.perf_counter()
+        for _ in range(num_runs):
+            _eager_detections(model, images, postprocess)
+        report['eager_ms'] = (time.perf_counter() - start_time) / num_runs * 1000
+
+    inputs = list(images)
+    start_time = time.perf_counter()
+    for _ in range(num_runs):
+        inference(inputs)
+    report['onnxruntime_ms'] = (time.perf_counter() - start_time) / num_runs * 1000
+    report['speedup'] = report['eager_ms'] / report['onnxruntime_ms']
+
+    for k, v in report.items():
+        print(f'{k:>20}: {v:>10.4f}')
+
+    return report
@@ -5,7 +5,7 @@ from torch import nn, Tensor
 from torch.nn import functional as F
 from typing import Any, Callable, Dict, List, Optional, Sequence
 
-from torchvision.models.utils import load_state_dict_from_url
+from torch.hub import load_state_dict_from_url
 from .backbone_mobilenetv2 import _make_divisible, ConvBNActivation
 # from torchsummary import summary
 
@@ -188,14 +188,13 @@ class MobileNetV3(nn.Module):
 
         # self.backbone_modules = [m for m in self.modules() if isinstance(m, nn.Conv2d)]
 
-    def _forward_impl(self, x: Tensor) -> Tensor:
+    def _forward_impl(self, x: Tensor) -> List[Tensor]:
         # x = self.features(x)
         outputs = []
         # for feat in self.features:
         for (i, feat) in enumerate(self.features):
             x = feat(x)
             outputs.append(x)
-            print(i, x.size())
 
         # print(self.channels)
         # x = self.avgpool(x)
@@ -204,7 +203,7 @@ class MobileNetV3(nn.Module):
 
         return outputs
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor) -> List[Tensor]:
         return self._forward_impl(x)
 
     def init_backbone(self, path):
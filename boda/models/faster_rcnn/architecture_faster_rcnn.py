@@ -29,7 +29,6 @@ class FasterRcnnNeck(FeaturePyramidNetworks):
         num_extra_fpn_layers: int = 1,
     ) -> None:
         super().__init__(
-            config,
             channels,
             selected_layers,
             fpn_channels,
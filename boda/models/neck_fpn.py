@@ -1,5 +1,4 @@
 from typing import List, Sequence
-import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
 
@@ -37,7 +36,6 @@ class FeaturePyramidNetworks(nn.Module):
         self.selected_layers = selected_layers
         self.selected_backbones = selected_layers
         self.out_channels = out_channels
-        self.extra_layers = extra_layers
         self.num_extra_layers = 0
         self.num_extra_predict_layers = num_extra_predict_layers
         # TODO: remove variable
@@ -75,7 +73,11 @@ class FeaturePyramidNetworks(nn.Module):
         # TODO: rename self.extra_layers -> self.extra_predict_layers for training
         # TODO: merge two trigger variables to one variable
         # use_num_extra_layers?
-        if self.extra_layers and self.num_extra_predict_layers > 0:
+        # `extra_layers` is always a ModuleList and `use_extra_layers` selects the
+        # branch in forward, so the module can be compiled by torch.jit.script
+        self.use_extra_layers = bool(extra_layers) and self.num_extra_predict_layers > 0
+        self.extra_layers = nn.ModuleList()
+        if self.use_extra_layers:
             self.extra_layers = nn.ModuleList([
                 nn.Conv2d(
                     self.out_channels,
@@ -97,21 +99,23 @@ class FeaturePyramidNetworks(nn.Module):
         Returns:
             outputs (:obj:`List[FloatTensor[B, C, H, W]]`)
         """
-        device = inputs[0].device
         inputs = [inputs[i] for i in self.selected_backbones]
 
-        x = torch.zeros(1, device=device)
-        outputs = [x for _ in range(len(inputs))]
+        # The top-down pathway starts from the coarsest lateral output instead
+        # of a zero tensor, so the graph stays traceable by torch.fx
+        outputs = list(inputs)
+        x = inputs[-1]
 
         i = len(inputs)
         for lateral_layer in self.lateral_layers:
             i -= 1
             if i < len(inputs) - 1:
-                _, _, h, w = inputs[i].size()
                 x = F.interpolate(
-                    x, size=(h, w), mode='bilinear', align_corners=False)
+                    x, size=inputs[i].shape[-2:], mode='bilinear', align_corners=False)
+                x = x + lateral_layer(inputs[i])
+            else:
+                x = lateral_layer(inputs[i])
 
-            x = x + lateral_layer(inputs[i])
             outputs[i] = x
 
         i = len(inputs)
@@ -119,7 +123,7 @@ class FeaturePyramidNetworks(nn.Module):
             i -= 1
             outputs[i] = F.relu(predict_layer(outputs[i]))
 
-        if self.extra_layers:
+        if self.use_extra_layers:
             for extra_layer in self.extra_layers:
                 outputs.append(extra_layer(outputs[-1]))
 
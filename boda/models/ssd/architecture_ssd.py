@@ -9,6 +9,7 @@ import torch.nn.functional as F
 
 import itertools 
 from ...base_architecture import Neck, Head, Model
+from ...utils.misc import auto_fp16
 from .configuration_ssd import SsdConfig
 from ..backbone_vggnet import vgg16
 
@@ -318,6 +319,7 @@ class SsdModel(SsdPretrained):
                 in_channels, config.boxes[i], config.aspect_ratios[i], config.steps[i], config.min_sizes[i], config.max_sizes[i])
             self.heads.append(head)
 
+    @auto_fp16()
     def forward(self, inputs):
         inputs = self.check_inputs(inputs)
         outputs = self.backbone(inputs)
@@ -336,10 +338,7 @@ class SsdModel(SsdPretrained):
         if self.training:
             return preds
         else:
-            for k, v in preds.items():
-                print(k, v.size())
-
-            preds['scores'] = F.softmax(preds['scores'], dim=-1)
+            preds['scores'] = F.softmax(preds['scores'].float(), dim=-1)
             return preds
 
     def load_weights(self, path):
@@ -1,167 +1,73 @@
-import torch
-from torch.autograd import Function
-from ..box_utils import decode, nms
-from data import voc as cfg
-from torchvision.ops import nms
-
-
-# Adapted from https://github.com/Hakuyume/chainer-ssd
-def decode(loc, priors, variances):
-    """Decode locations from predictions using priors to undo
-    the encoding we did for offset regression at train time.
-    Args:
-        loc (tensor): location predictions for loc layers,
-            Shape: [num_priors,4]
-        priors (tensor): Prior boxes in center-offset form.
-            Shape: [num_priors,4].
-        variances: (list[float]) Variances of priorboxes
-    Return:
-        decoded bounding box predictions
-    """
+from typing import Tuple, List, Dict
 
-    boxes = torch.cat((
-        priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:],
-        priors[:, 2:] * torch.exp(loc[:, 2:] * variances[1])), 1)
-    boxes[:, :2] -= boxes[:, 2:] / 2
-    boxes[:, 2:] += boxes[:, :2]
-    return boxes
-
-
-def nms(boxes, scores, overlap=0.5, top_k=200):
-    """Apply non-maximum suppression at test time to avoid detecting too many
-    overlapping bounding boxes for a given object.
-    Args:
-        boxes: (tensor) The location preds for the img, Shape: [num_priors,4].
-        scores: (tensor) The class predscores for the img, Shape:[num_priors].
-        overlap: (float) The overlap thresh for suppressing unnecessary boxes.
-        top_k: (int) The Maximum number of box preds to consider.
-    Return:
-        The indices of the kept boxes with respect to num_priors.
-    """
+import torch
+from torch import Tensor
+from torchvision.ops import batched_nms
 
-    keep = scores.new(scores.size(0)).zero_().long()
-    if boxes.numel() == 0:
-        return keep
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-    area = torch.mul(x2 - x1, y2 - y1)
-    v, idx = scores.sort(0)  # sort in ascending order
-    # I = I[v >= 0.01]
-    idx = idx[-top_k:]  # indices of the top-k largest vals
-    xx1 = boxes.new()
-    yy1 = boxes.new()
-    xx2 = boxes.new()
-    yy2 = boxes.new()
-    w = boxes.new()
-    h = boxes.new()
+from ...ops.box import decode, sanitize_coordinates
 
-    # keep = torch.Tensor()
-    count = 0
-    while idx.numel() > 0:
-        i = idx[-1]  # index of current largest val
-        # keep.append(i)
-        keep[count] = i
-        count += 1
-        if idx.size(0) == 1:
-            break
-        idx = idx[:-1]  # remove kept element from view
-        # load bboxes of next highest vals
-        torch.index_select(x1, 0, idx, out=xx1)
-        torch.index_select(y1, 0, idx, out=yy1)
-        torch.index_select(x2, 0, idx, out=xx2)
-        torch.index_select(y2, 0, idx, out=yy2)
-        # store element-wise max with next highest score
-        xx1 = torch.clamp(xx1, min=x1[i])
-        yy1 = torch.clamp(yy1, min=y1[i])
-        xx2 = torch.clamp(xx2, max=x2[i])
-        yy2 = torch.clamp(yy2, max=y2[i])
-        w.resize_as_(xx2)
-        h.resize_as_(yy2)
-        w = xx2 - xx1
-        h = yy2 - yy1
-        # check sizes of xx1 and xx2.. after each iteration
-        w = torch.clamp(w, min=0.0)
-        h = torch.clamp(h, min=0.0)
-        inter = w*h
-        # IoU = i / (area(a) + area(b) - i)
-        rem_areas = torch.index_select(area, 0, idx)  # load remaining areas)
-        union = (rem_areas - inter) + area[i]
-        IoU = inter/union  # store result in iou
-        # keep only elements with an IoU <= overlap
-        idx = idx[IoU.le(overlap)]
-    return keep, count
 
+class SsdInference:
+    def __init__(
+        self,
+        num_classes: int = 21,
+        top_k: int = 200,
+        nms_threshold: float = 0.45,
+        score_threshold: float = 0.01,
+        variances: Tuple[float, float] = (0.1, 0.2)
+    ) -> None:
+        """Decoding and per-class NMS of :class:`SsdModel` outputs
 
-class Detect(Function):
-    """At test time, Detect is the final layer of SSD.  Decode location preds,
-    apply non-maximum suppression to location predictions based on conf
-    scores and threshold to a top_k number of output predictions for both
-    confidence score and locations.
-    """
-    def __init__(self, num_classes, bkg_label, top_k, conf_thresh, nms_thresh):
+        Args:
+            num_classes (:obj:`int`): with background
+            top_k (:obj:`int`): detections per image
+            nms_threshold (:obj:`float`):
+            score_threshold (:obj:`float`): class scores not above it are dropped
+            variances (:obj:`Tuple[float, float]`): `config.variance` of the model
+        """
         self.num_classes = num_classes
-        self.background_label = bkg_label
         self.top_k = top_k
-        # Parameters used in nms.
-        self.nms_thresh = nms_thresh
-        if nms_thresh <= 0:
-            raise ValueError('nms_threshold must be non negative.')
-        self.conf_thresh = conf_thresh
-        self.variance = cfg['variance']
-
-    def forward(self, boxes, scores, prior_boxes):
+        self.nms_threshold = nms_threshold
+        self.score_threshold = score_threshold
+        self.variances = tuple(variances)
+
+    def __call__(
+        self,
+        preds: Dict[str, Tensor],
+        image_sizes: List[Tuple[int]]
+    ) -> List[Dict[str, Tensor]]:
         """
         Args:
-            boxes (:obj:`Tensor`): [B, N, 4]
-            scores (:obj:`Tensor`): [N, C]
-            prior_boxes (:obj:`Tensor`): [N, 4]
-
-            loc_data: (tensor) Loc preds from loc layers
-                Shape: [batch, num_priors*4]
-            conf_data: (tensor) Shape: Conf preds from conf layers
-                Shape: [batch*num_priors,num_classes]
-            prior_data: (tensor) Prior boxes and variances from priorbox layers
-                Shape: [1,num_priors,4]
+            preds (:obj:`Dict[str, Tensor]`): outputs of :class:`SsdModel` in eval mode
+            image_sizes (:obj:`List[Tuple[int, int]]`): h, w of the original images
+
+        Returns:
+            return_list (:obj:`List[Dict[str, Tensor]]`):
+                `boxes` (:obj:`LongTensor[K, 4]`): x1, y1, x2, y2 in pixels
+                `scores` (:obj:`FloatTensor[K]`):
+                `labels` (:obj:`LongTensor[K]`): class index without background
         """
-        num = boxes.size(0)  # batch size
-        num_priors = prior_boxes.size(0)
-        output = torch.zeros(num, self.num_classes, self.top_k, 5)
-        conf_preds = scores.view(num, num_priors, self.num_classes).transpose(2, 1)
-
-        # Decode predictions into bboxes.
-        for i in range(num):
-            decoded_boxes = decode(boxes[i], prior_data, self.variance)
-            # For each class, perform nms
-            conf_scores = conf_preds[i].clone()
+        prior_boxes = preds['prior_boxes']
+        pred_scores = preds['scores'].view(-1, prior_boxes.size(0), self.num_classes)
 
-            for cl in range(1, self.num_classes):
-                c_mask = conf_scores[cl].gt(self.conf_thresh)
-                scores = conf_scores[cl][c_mask]
+        return_list = []
+        for boxes, scores, (h, w) in zip(preds['boxes'], pred_scores, image_sizes):
+            boxes = decode(boxes, prior_boxes, self.variances)
 
-                score_mask = scores[i].gt(0.05)
+            index, labels = torch.where(scores[:, 1:] > self.score_threshold)
+            boxes = boxes[index]
+            scores = scores[index, labels + 1].float()
 
-                score = scores[score_mask]
-                index = index[score_mask]
+            keep = batched_nms(boxes, scores, labels, self.nms_threshold)[:self.top_k]
+            boxes = boxes[keep]
 
-                if scores.size(0) == 0:
-                    continue
+            x1, x2 = sanitize_coordinates(boxes[:, 0], boxes[:, 2], w, cast=False)
+            y1, y2 = sanitize_coordinates(boxes[:, 1], boxes[:, 3], h, cast=False)
 
-                l_mask = c_mask.unsqueeze(1).expand_as(decoded_boxes)
-                boxes = decoded_boxes[l_mask].view(-1, 4)
-                # idx of highest scoring and non-overlapping boxes per class
-                # ids, count = nms(boxes, scores, self.nms_thresh, self.top_k)
-                # boxes (Tensor[N, 4])) – boxes to perform NMS on. They are expected to be in (x1, y1, x2, y2) format
-                # scores (Tensor[N]) – scores for each one of the boxes
-                # iou_threshold (float) – discards all overlapping boxes with IoU > iou_threshold
-                keep = nms(boxes, scores, self.nms_thresh)
-                output[i, cl, :count] = \
-                    torch.cat((scores[ids[:count]].unsqueeze(1),
-                               boxes[ids[:count]]), 1)
+            return_list.append({
+                'boxes': torch.stack([x1, y1, x2, y2], dim=1).long(),
+                'scores': scores[keep],
+                'labels': labels[keep],
+            })
 
-        flt = output.contiguous().view(num, -1, 5)
-        _, idx = flt[:, :, 0].sort(1, descending=True)
-        _, rank = idx.sort(1)
-        flt[(rank < self.top_k).unsqueeze(-1).expand_as(flt)].fill_(0)
-        return output
\ No newline at end of file
+        return return_list
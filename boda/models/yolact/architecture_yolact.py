@@ -10,6 +10,7 @@ from torch import nn, Tensor
 import torch.nn.functional as F
 
 from ...base_architecture import Backbone, Neck, Head, Model
+from ...utils.misc import auto_fp16
 from .configuration_yolact import YolactConfig
 from ..backbone_resnet import resnet101, resnet50, resnet18, resnet34
 from ..neck_fpn import FeaturePyramidNetworks
@@ -329,6 +330,10 @@ class YolactPretrained(Model):
             name_or_path, cache_dir=cls.config_class.cache_dir)
         model.load_weights(pretrained_file)
 
+        if config.use_torchscript:
+            from .torchscript_yolact import script_yolact
+            return script_yolact(model)
+
         return model
 
 
@@ -430,10 +435,14 @@ class YolactModel(YolactPretrained):
                 if module.bias is not None:
                     module.bias.data.zero_()
 
+    @auto_fp16()
     def forward(self, images: List[Tensor], targets: Dict[str, Tensor] = None) -> Dict[str, List[Tensor]]:
         """
         Do not transform resized image, expected original image
 
+        Backbone, neck and heads run under `config.precision`, the outputs
+        are returned in fp32.
+
         Args:
             inputs (:obj:`List[FloatTensor[B, C, H, W]]`):
             targets (:obj:):
@@ -486,7 +495,7 @@ class YolactModel(YolactPretrained):
             return_dict['semantic_masks'] = self.semantic_layer(outputs[0])
             return return_dict
         else:
-            return_dict['scores'] = F.softmax(return_dict['scores'], dim=-1)
+            return_dict['scores'] = F.softmax(return_dict['scores'].float(), dim=-1)
             # # TODO: ah si ba!! What should I do?!
             # from .inference_yolact import YolactInference, _convert_boxes_and_masks
 
@@ -59,6 +59,10 @@ class YolactInference:
         for i, image_size in enumerate(image_sizes):
             decoded_boxes = decode(pred_boxes[i], prior_boxes)
             results = self._filter_overlaps(i, decoded_boxes, pred_masks, pred_scores)
+            if results is None or len(results['scores']) == 0:
+                # No class scores above the threshold, e.g. an untrained model
+                return_list.append(_empty_results(image_size, proto_masks.device))
+                continue
             results['proto_masks'] = proto_masks[i]
 
             return_list.append(_convert_boxes_and_masks(results, image_size))
@@ -111,6 +115,16 @@ class YolactInference:
         return return_dict
 
 
+def _empty_results(size, device) -> Dict[str, Tensor]:
+    h, w = size
+    return {
+        'boxes': torch.zeros((0, 4), dtype=torch.long, device=device),
+        'scores': torch.zeros(0),
+        'labels': torch.zeros(0, dtype=torch.long, device=device),
+        'masks': torch.zeros((0, h, w), device=device),
+    }
+
+
 def _convert_boxes_and_masks(preds, size):
     """
     Args:
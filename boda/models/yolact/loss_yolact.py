@@ -11,6 +11,19 @@ from ...base_architecture import LossFunction
 from ...ops.box import elemwise_box_iou, jaccard, cxywh_to_xyxy, crop, xyxy_to_cxywh
 from ...ops.loss import log_sum_exp
 from ...ops.mask import elemwise_mask_iou
+from ...utils.misc import force_fp32
+
+
+@force_fp32(apply_to=('pred_masks', 'boxes'))
+def _cropped_mask_bce(pred_masks: Tensor, true_masks: Tensor, boxes: Tensor) -> Tensor:
+    """Per-pixel BCE of the sigmoid of assembled masks cropped to the boxes
+
+    Sigmoid probabilities near 0 and 1 are not representable in fp16 and
+    `binary_cross_entropy` is not allowed under autocast, so it runs in fp32.
+    """
+    pred_masks = crop(torch.sigmoid(pred_masks), boxes)
+
+    return F.binary_cross_entropy(torch.clamp(pred_masks, 0, 1), true_masks, reduction='none')
 
 
 class Matcher:
@@ -58,7 +71,7 @@ class Matcher:
         # FloatTensor[N, 4]
         # decoded_priors = self.decode(
         #     pred_boxes, pred_priors)
-        decoded_priors = cxcywh_to_xyxy(pred_priors)
+        decoded_priors = cxywh_to_xyxy(pred_priors)
 
         # LongTensor[number of ground truths]
         overlaps = jaccard(true_boxes, decoded_priors)
@@ -174,7 +187,7 @@ class YolactLoss(LossFunction):
         Args:
             inputs (Dict[str, List[Tensor]]):
                 `boxes` (:obj:`FloatTensor[B, N*S, 4]`): B is the number of batch size, S is the number of selected_layers
-                `masks` (:obj:`FloatTensor[B, N*S, P]`): P is the number of prototypes
+                `mask_coefs` (:obj:`FloatTensor[B, N*S, P]`): P is the number of prototypes
                 `scores` (:obj:`FloatTensor[B, N*S, C]`): C is the number of classes with background e.g. 80 + 1
                 `priors` (:obj:`FloatTensor[N, 4]`):
                 `prototype_masks` (:obj:`FloatTensor[B, H, W, P]`):
@@ -197,7 +210,7 @@ class YolactLoss(LossFunction):
         losses = defaultdict()
 
         pred_boxes = inputs['boxes']
-        pred_masks = inputs['masks']
+        pred_masks = inputs['mask_coefs']
         pred_scores = inputs['scores']
         prior_boxes = inputs['prior_boxes']
         pred_proto_masks = inputs['proto_masks']
@@ -220,6 +233,7 @@ class YolactLoss(LossFunction):
         # matched_indexes = torch.zeros((batch_size, num_priors), dtype=torch.int64)
 
         true_masks = []
+        true_proto_masks = []
         true_labels = []
         h, w = self.max_size
         for i, target in enumerate(targets):
@@ -228,6 +242,7 @@ class YolactLoss(LossFunction):
                 torch.as_tensor([w, h, w, h], dtype=torch.float32, device=pred_boxes.device)
 
             true_masks.append(target['masks'])
+            true_proto_masks.append(target.get('proto_masks'))
             true_labels.append(target['labels'])
             # true_labels[i] = target['labels']
             true_crowds = target['crowds']
@@ -285,7 +300,8 @@ class YolactLoss(LossFunction):
             pred_masks,
             pred_proto_masks,
             true_masks,
-            matched_true_boxes) * self.mask_weight
+            matched_true_boxes,
+            true_proto_masks=true_proto_masks) * self.mask_weight
 
         # Confidence loss
         losses['C'] = self.ohem_conf_loss(
@@ -320,11 +336,15 @@ class YolactLoss(LossFunction):
         pred_proto_masks,
         true_masks,
         matched_true_boxes,
-        mode: str = 'bilinear'
+        mode: str = 'bilinear',
+        true_proto_masks=None
     ) -> Tensor:
         """
         Args:
             mode (:obj:`str`): interpolation mode
+            true_proto_masks (:obj:`List[ByteTensor[N, H, W]]`): masks already
+                rasterized at the prototype resolution, used instead of
+                downsampling `true_masks` when given
         Returns:
         """
         h = pred_proto_masks.size(1)
@@ -333,13 +353,17 @@ class YolactLoss(LossFunction):
         loss = 0
         for i in range(pred_masks.size(0)):
             with torch.no_grad():
-                downsampled_masks = F.interpolate(
-                    true_masks[i].unsqueeze(0).float(), (h, w),
-                    mode=mode, align_corners=False
-                ).squeeze(0)
-                downsampled_masks = downsampled_masks.permute(1, 2, 0).contiguous()
-                # mask_proto_binarize_downsampled_gt
-                downsampled_masks = downsampled_masks.gt(0.5).float()
+                if true_proto_masks is not None and true_proto_masks[i] is not None \
+                        and tuple(true_proto_masks[i].shape[-2:]) == (h, w):
+                    downsampled_masks = true_proto_masks[i].permute(1, 2, 0).float().contiguous()
+                else:
+                    downsampled_masks = F.interpolate(
+                        true_masks[i].unsqueeze(0).float(), (h, w),
+                        mode=mode, align_corners=False
+                    ).squeeze(0)
+                    downsampled_masks = downsampled_masks.permute(1, 2, 0).contiguous()
+                    # mask_proto_binarize_downsampled_gt
+                    downsampled_masks = downsampled_masks.gt(0.5).float()
 
             j = positive_scores[i]  # current position
             positive_index = matched_indexes[i, j]  # positive index
@@ -366,11 +390,7 @@ class YolactLoss(LossFunction):
             _true_masks = downsampled_masks[:, :, positive_index]
             # Size([h, w, num_positives])
             _pred_masks = proto_masks @ proto_coef.t()
-            _pred_masks = torch.sigmoid(_pred_masks)
-            _pred_masks = crop(_pred_masks, positive_true_boxes)
-
-            _loss = F.binary_cross_entropy(
-                torch.clamp(_pred_masks, 0, 1), _true_masks, reduction='none')
+            _loss = _cropped_mask_bce(_pred_masks, _true_masks, positive_true_boxes)
 
             # mask_proto_normalize_emulate_roi_pooling
             weight = h * w
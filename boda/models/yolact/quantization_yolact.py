@@ -0,0 +1,281 @@
+import copy
+from typing import Tuple, List, Dict, Callable, Optional, Sequence
+
+import numpy as np
+import torch
+from torch import nn, Tensor
+import torch.nn.functional as F
+
+from ...base_architecture import Model
+from ...utils.misc import measure_latency
+from .architecture_yolact import YolactModel
+
+
+class YolactQuantizableCore(nn.Module):
+    """Traceable backbone, neck, head and protonet of :class:`YolactModel`
+
+    `YolactModel.forward` resizes a list of images, generates prior boxes in
+    Python and shares the head weights through `HeadBranch.parent`, none of
+    which can be traced by torch.fx. This module only keeps the convolutional
+    graph and returns raw tensors, prior boxes and everything after the heads
+    stay in float on the outside.
+
+    Args:
+        model (:class:`YolactModel`):
+    """
+    def __init__(self, model: YolactModel) -> None:
+        super().__init__()
+        self.backbone = model.backbone
+        self.neck = model.neck
+        # All head branches share the layers of the first branch
+        self.head = model.heads[0]
+        self.proto_layer = model.proto_layer
+        self.selected_layers = list(model.neck.selected_layers)
+        self.num_classes = model.heads[0].num_classes
+        self.mask_dim = model.heads[0].mask_dim
+
+    def forward(self, images: Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        """
+        Args:
+            images (:obj:`FloatTensor[B, C, H, W]`): resized images
+
+        Returns:
+            boxes (:obj:`FloatTensor[B, N*S, 4]`):
+            scores (:obj:`FloatTensor[B, N*S, C]`): logits, not softmaxed
+            mask_coefs (:obj:`FloatTensor[B, N*S, P]`):
+            proto_masks (:obj:`FloatTensor[B, H, W, P]`):
+        """
+        outputs = self.backbone(images)
+        outputs = self.neck(outputs)
+
+        boxes = []
+        scores = []
+        mask_coefs = []
+        for i in self.selected_layers:
+            inputs = self.head.upsample_layers(outputs[i])
+            batch_size = inputs.size(0)
+
+            box = self.head.box_layers(inputs)
+            score = self.head.score_layers(inputs)
+            mask_coef = self.head.mask_layers(inputs)
+
+            boxes.append(box.permute(0, 2, 3, 1).reshape(batch_size, -1, 4))
+            scores.append(score.permute(0, 2, 3, 1).reshape(batch_size, -1, self.num_classes))
+            mask_coefs.append(mask_coef.permute(0, 2, 3, 1).reshape(batch_size, -1, self.mask_dim))
+
+        proto_masks = F.relu(self.proto_layer(outputs[0]))
+        proto_masks = proto_masks.permute(0, 2, 3, 1)
+
+        boxes = torch.cat(boxes, dim=1)
+        scores = torch.cat(scores, dim=1)
+        mask_coefs = torch.tanh(torch.cat(mask_coefs, dim=1))
+
+        return boxes, scores, mask_coefs, proto_masks
+
+
+class QuantizedYolactModel(nn.Module):
+    """INT8 YOLACT for CPU inference
+
+    Returns the same dictionary as :class:`YolactModel` in eval mode, so the
+    outputs can be passed to `YolactInference` without changes.
+
+    Args:
+        core (:obj:`nn.Module`): converted :class:`YolactQuantizableCore`
+        prior_boxes (:obj:`FloatTensor[N*S, 4]`):
+        size (:obj:`Tuple[int, int]`): input resolution of the model
+    """
+    def __init__(
+        self,
+        core: nn.Module,
+        prior_boxes: Tensor,
+        size: Tuple[int, int] = (550, 550)
+    ) -> None:
+        super().__init__()
+        self.core = core
+        self.size = tuple(size)
+        self.register_buffer('prior_boxes', prior_boxes)
+
+    def forward(self, images: List[Tensor]) -> Dict[str, Tensor]:
+        images = Model.check_inputs(images)
+        images, _ = Model.resize_inputs(images, self.size)
+
+        boxes, scores, mask_coefs, proto_masks = self.core(images)
+
+        return_dict = {
+            'scores': F.softmax(scores.float(), dim=-1),
+            'boxes': boxes.float(),
+            'prior_boxes': self.prior_boxes,
+            'mask_coefs': mask_coefs.float(),
+            'proto_masks': proto_masks.float().contiguous(),
+        }
+
+        return return_dict
+
+
+class YolactQuantizer:
+    """Post-training static quantization of YOLACT with FX graph mode
+
+    Backbone, neck, heads and protonet are quantized to INT8. Decoding of
+    prior boxes, softmax, NMS and mask assembly stay in float.
+
+    Requires PyTorch 1.13 or later for `torch.ao.quantization`.
+
+    Args:
+        model (:class:`YolactModel`): trained float model, it is not modified
+        backend (:obj:`str`): `fbgemm` or `x86` for x86 CPUs, `qnnpack` for ARM
+        size (:obj:`Tuple[int, int]`): input resolution of the model
+
+    Examples::
+        >>> quantizer = YolactQuantizer(model, backend='fbgemm')
+        >>> quantizer.prepare()
+        >>> quantizer.calibrate(dataset, num_samples=200)
+        >>> quantized_model = quantizer.convert()
+        >>> quantizer.save('cache/yolact/yolact-mobilenetv3-int8.pth')
+    """
+    def __init__(
+        self,
+        model: YolactModel,
+        backend: str = 'fbgemm',
+        size: Tuple[int, int] = (550, 550)
+    ) -> None:
+        self.model = copy.deepcopy(model).cpu().eval()
+        self.backend = backend
+        self.size = tuple(size)
+        self.prepared = None
+        self.quantized = None
+        self.prior_boxes = self._generate_prior_boxes()
+
+    def _example_inputs(self, batch_size: int = 1) -> Tuple[Tensor]:
+        return (torch.rand(batch_size, 3, *self.size),)
+
+    def _generate_prior_boxes(self) -> Tensor:
+        with torch.no_grad():
+            outputs = self.model(list(self._example_inputs()[0]))
+
+        return outputs['prior_boxes'].detach().cpu().clone()
+
+    def prepare(self) -> nn.Module:
+        """Fuse conv, batch norm and relu and insert observers"""
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx
+
+        torch.backends.quantized.engine = self.backend
+        qconfig_mapping = get_default_qconfig_mapping(self.backend)
+
+        core = YolactQuantizableCore(self.model).eval()
+        self.prepared = prepare_fx(core, qconfig_mapping, self._example_inputs())
+
+        return self.prepared
+
+    @torch.no_grad()
+    def calibrate(
+        self,
+        dataset,
+        num_samples: int = 100,
+        batch_size: int = 8,
+        seed: int = 0
+    ) -> None:
+        """Collect activation ranges on a random subset of the dataset
+
+        Args:
+            dataset (:class:`CocoDataset`): returns an image as
+                :obj:`ndarray[H, W, C]` or :obj:`FloatTensor[C, H, W]` first
+            num_samples (:obj:`int`): size of the calibration subset
+            batch_size (:obj:`int`):
+            seed (:obj:`int`): seed to choose the subset
+        """
+        if self.prepared is None:
+            self.prepare()
+
+        generator = np.random.default_rng(seed)
+        num_samples = min(num_samples, len(dataset))
+        indices = generator.choice(len(dataset), num_samples, replace=False)
+
+        for i in range(0, num_samples, batch_size):
+            images = [_image_to_tensor(dataset[j][0]) for j in indices[i:i+batch_size]]
+            images, _ = Model.resize_inputs(images, self.size)
+            self.prepared(images)
+
+    def convert(self) -> QuantizedYolactModel:
+        """Convert the calibrated model to INT8"""
+        from torch.ao.quantization.quantize_fx import convert_fx
+
+        if self.prepared is None:
+            raise RuntimeError('Call prepare and calibrate before convert.')
+
+        core = convert_fx(self.prepared)
+        self.quantized = QuantizedYolactModel(core, self.prior_boxes, self.size).eval()
+
+        return self.quantized
+
+    def save(self, path: str) -> None:
+        if self.quantized is None:
+            raise RuntimeError('Call convert before save.')
+
+        torch.save({
+            'backend': self.backend,
+            'size': self.size,
+            'state_dict': self.quantized.state_dict(),
+        }, path)
+
+    @classmethod
+    def load(cls, model: YolactModel, path: str) -> QuantizedYolactModel:
+        """Load a quantized checkpoint
+
+        The quantized graph is rebuilt from the float architecture without
+        calibration and the saved scales and weights are loaded into it.
+
+        Args:
+            model (:class:`YolactModel`): float model of the same architecture
+            path (:obj:`str`): checkpoint written by `save`
+        """
+        checkpoint = torch.load(path, map_location='cpu')
+        quantizer = cls(model, checkpoint['backend'], checkpoint['size'])
+        quantizer.prepare()
+        quantized_model = quantizer.convert()
+        quantized_model.load_state_dict(checkpoint['state_dict'])
+
+        return quantized_model
+
+
+def _image_to_tensor(image) -> Tensor:
+    if isinstance(image, np.ndarray):
+        image = torch.as_tensor(image.transpose((2, 0, 1)), dtype=torch.float32)
+
+    return image.float()
+
+
+def compare_quantization(
+    float_model: nn.Module,
+    quantized_model: nn.Module,
+    images: Sequence[Tensor],
+    evaluate: Optional[Callable[[nn.Module], float]] = None,
+    num_runs: int = 20
+) -> Dict[str, float]:
+    """Report latency and mAP of the float and the quantized model on CPU
+
+    Args:
+        float_model (:class:`YolactModel`):
+        quantized_model (:class:`QuantizedYolactModel`):
+        images (:obj:`List[FloatTensor[C, H, W]]`): inputs for timing
+        evaluate (:obj:`Callable`): returns mAP of a model on a validation set
+        num_runs (:obj:`int`):
+    """
+    float_model = float_model.cpu().eval()
+    images = [image.cpu() for image in images]
+
+    report = {
+        'float_ms': measure_latency(float_model, images, num_runs=num_runs),
+        'quantized_ms': measure_latency(quantized_model, images, num_runs=num_runs),
+    }
+    report['speedup'] = report['float_ms'] / report['quantized_ms']
+
+    if evaluate is not None:
+        report['float_map'] = evaluate(float_model)
+        report['quantized_map'] = evaluate(quantized_model)
+        report['map_delta'] = report['quantized_map'] - report['float_map']
+
+    for k, v in report.items():
+        print(f'{k:>14}: {v:>9.4f}')
+
+    return report
@@ -0,0 +1,249 @@
+import copy
+from typing import Tuple, List, Dict
+
+import torch
+from torch import nn, Tensor
+import torch.nn.functional as F
+
+from ...ops.box import decode, jaccard, crop, sanitize_coordinates
+from .architecture_yolact import YolactModel
+
+
+class YolactScriptModule(nn.Module):
+    """End-to-end YOLACT inference that can be compiled by `torch.jit.script`
+
+    Runs resize, backbone, FPN, heads, box decoding, Fast NMS and mask
+    assembly in one module. Compared with :class:`YolactModel` and
+    :class:`YolactInference`:
+
+    - prior boxes are generated once at construction and kept as a buffer
+    - the shared head layers are called directly instead of through
+      `HeadBranch.parent`
+    - the config is never mutated and no `defaultdict` is used
+
+    Args:
+        model (:class:`YolactModel`): it is copied, the original is not modified
+        size (:obj:`Tuple[int, int]`): input resolution, `config.max_size` by default
+        top_k (:obj:`int`): maximum number of detections per image
+        conf_threshold (:obj:`float`): candidates below this score are dropped before NMS
+        nms_threshold (:obj:`float`):
+        nms_top_k (:obj:`int`): candidates per class kept for NMS
+        max_num_detections (:obj:`int`): detections kept after NMS across classes
+
+    Examples::
+        >>> module = YolactScriptModule(model)
+        >>> scripted = torch.jit.script(module)
+        >>> scripted.save('yolact.pt')
+        >>> outputs = torch.jit.load('yolact.pt')([image])
+    """
+    def __init__(
+        self,
+        model: YolactModel,
+        size: Tuple[int, int] = None,
+        top_k: int = 10,
+        conf_threshold: float = 0.05,
+        nms_threshold: float = 0.3,
+        nms_top_k: int = 200,
+        max_num_detections: int = 200
+    ) -> None:
+        super().__init__()
+        model = copy.deepcopy(model).eval()
+        if size is None:
+            size = model.config.max_size
+
+        self.size: List[int] = [int(size[0]), int(size[1])]
+        self.top_k = top_k
+        self.conf_threshold = conf_threshold
+        self.nms_threshold = nms_threshold
+        self.nms_top_k = nms_top_k
+        self.max_num_detections = max_num_detections
+
+        self.backbone = model.backbone
+        self.neck = model.neck
+        # All head branches share the layers of the first branch
+        self.upsample_layers = model.heads[0].upsample_layers
+        self.box_layers = model.heads[0].box_layers
+        self.score_layers = model.heads[0].score_layers
+        self.mask_layers = model.heads[0].mask_layers
+        self.proto_layer = model.proto_layer
+
+        self.selected_layers: List[int] = list(model.neck.selected_layers)
+        self.num_classes: int = model.heads[0].num_classes
+        self.mask_dim: int = model.heads[0].mask_dim
+
+        self.register_buffer('prior_boxes', self._generate_prior_boxes(model))
+
+    def _generate_prior_boxes(self, model: YolactModel) -> Tensor:
+        device = next(model.parameters()).device
+        with torch.no_grad():
+            outputs = model([torch.zeros(3, self.size[0], self.size[1], device=device)])
+
+        return outputs['prior_boxes'].detach().clone()
+
+    def forward(self, images: List[Tensor]) -> List[Dict[str, Tensor]]:
+        """
+        Args:
+            images (:obj:`List[FloatTensor[C, H, W]]`): original images
+
+        Returns:
+            return_list (:obj:`List[Dict[str, Tensor]]`):
+                `boxes` (:obj:`LongTensor[K, 4]`): x1, y1, x2, y2 in pixels of the original image
+                `scores` (:obj:`FloatTensor[K]`):
+                `labels` (:obj:`LongTensor[K]`): class index without background
+                `masks` (:obj:`FloatTensor[K, H, W]`): binarized masks
+        """
+        image_sizes: List[List[int]] = []
+        resized_images: List[Tensor] = []
+        for image in images:
+            image_sizes.append([image.size(1), image.size(2)])
+            resized_images.append(
+                F.interpolate(image.unsqueeze(0), size=self.size, mode='nearest'))
+
+        boxes, scores, mask_coefs, proto_masks = self.predict(torch.cat(resized_images))
+
+        return_list: List[Dict[str, Tensor]] = []
+        for i, image_size in enumerate(image_sizes):
+            return_list.append(self.postprocess(
+                boxes[i], scores[i], mask_coefs[i], proto_masks[i], image_size[0], image_size[1]))
+
+        return return_list
+
+    def predict(self, images: Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        """
+        Args:
+            images (:obj:`FloatTensor[B, C, H, W]`): resized images
+
+        Returns:
+            boxes (:obj:`FloatTensor[B, N*S, 4]`):
+            scores (:obj:`FloatTensor[B, N*S, C]`):
+            mask_coefs (:obj:`FloatTensor[B, N*S, P]`):
+            proto_masks (:obj:`FloatTensor[B, H, W, P]`):
+        """
+        outputs = self.backbone(images)
+        outputs = self.neck(outputs)
+
+        boxes: List[Tensor] = []
+        scores: List[Tensor] = []
+        mask_coefs: List[Tensor] = []
+        for i in self.selected_layers:
+            inputs = self.upsample_layers(outputs[i])
+            batch_size = inputs.size(0)
+
+            boxes.append(self.box_layers(inputs).permute(0, 2, 3, 1).reshape(batch_size, -1, 4))
+            scores.append(self.score_layers(inputs).permute(0, 2, 3, 1).reshape(
+                batch_size, -1, self.num_classes))
+            mask_coefs.append(self.mask_layers(inputs).permute(0, 2, 3, 1).reshape(
+                batch_size, -1, self.mask_dim))
+
+        proto_masks = F.relu(self.proto_layer(outputs[0]))
+        proto_masks = proto_masks.permute(0, 2, 3, 1).contiguous()
+
+        boxes = torch.cat(boxes, dim=1)
+        scores = F.softmax(torch.cat(scores, dim=1), dim=-1)
+        mask_coefs = torch.tanh(torch.cat(mask_coefs, dim=1))
+
+        return boxes, scores, mask_coefs, proto_masks
+
+    def postprocess(
+        self,
+        boxes: Tensor,
+        scores: Tensor,
+        mask_coefs: Tensor,
+        proto_masks: Tensor,
+        h: int,
+        w: int
+    ) -> Dict[str, Tensor]:
+        """Decode, suppress and assemble the detections of one image"""
+        boxes = decode(boxes, self.prior_boxes)
+        scores = scores[:, 1:].t()
+
+        max_scores, _ = torch.max(scores, dim=0)
+        keep = max_scores > self.conf_threshold
+        scores = scores[:, keep]
+        boxes = boxes[keep]
+        mask_coefs = mask_coefs[keep]
+
+        if boxes.size(0) == 0:
+            return {
+                'boxes': torch.zeros((0, 4), dtype=torch.long, device=boxes.device),
+                'scores': torch.zeros((0,), device=boxes.device),
+                'labels': torch.zeros((0,), dtype=torch.long, device=boxes.device),
+                'masks': torch.zeros((0, h, w), device=boxes.device),
+            }
+
+        boxes, mask_coefs, labels, scores = self.fast_nms(boxes, scores, mask_coefs)
+        boxes = boxes[:self.top_k]
+        mask_coefs = mask_coefs[:self.top_k]
+        labels = labels[:self.top_k]
+        scores = scores[:self.top_k]
+
+        masks = torch.sigmoid(proto_masks @ mask_coefs.t())
+        masks = crop(masks, boxes)
+        masks = masks.permute(2, 0, 1).contiguous()
+        masks = F.interpolate(
+            masks.unsqueeze(0), size=[h, w], mode='bilinear', align_corners=False).squeeze(0)
+        masks = masks.gt(0.5).float()
+
+        x1, x2 = sanitize_coordinates(boxes[:, 0], boxes[:, 2], w, cast=False)
+        y1, y2 = sanitize_coordinates(boxes[:, 1], boxes[:, 3], h, cast=False)
+        boxes = torch.stack([x1, y1, x2, y2], dim=1).long()
+
+        return {
+            'boxes': boxes,
+            'scores': scores,
+            'labels': labels,
+            'masks': masks,
+        }
+
+    def fast_nms(
+        self,
+        boxes: Tensor,
+        scores: Tensor,
+        mask_coefs: Tensor
+    ) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        """Fast NMS of YOLACT, see `boda.ops.nms.fast_nms`
+
+        Args:
+            boxes (:obj:`FloatTensor[N, 4]`):
+            scores (:obj:`FloatTensor[C, N]`):
+            mask_coefs (:obj:`FloatTensor[N, P]`):
+        """
+        scores, idx = scores.sort(1, descending=True)
+        idx = idx[:, :self.nms_top_k].contiguous()
+        scores = scores[:, :self.nms_top_k]
+
+        num_classes, num_dets = idx.size()
+        boxes = boxes[idx.view(-1)].view(num_classes, num_dets, 4)
+        mask_coefs = mask_coefs[idx.view(-1)].view(num_classes, num_dets, self.mask_dim)
+
+        iou = jaccard(boxes, boxes)
+        iou = iou.triu(diagonal=1)
+        iou_max, _ = iou.max(dim=1)
+        keep = iou_max <= self.nms_threshold
+
+        labels = torch.arange(num_classes, device=boxes.device)[:, None].expand_as(keep)
+        labels = labels[keep]
+        boxes = boxes[keep]
+        scores = scores[keep]
+        mask_coefs = mask_coefs[keep]
+
+        scores, idx = scores.sort(0, descending=True)
+        idx = idx[:self.max_num_detections]
+        scores = scores[:self.max_num_detections]
+
+        return boxes[idx], mask_coefs[idx], labels[idx], scores
+
+
+def script_yolact(model: YolactModel, path: str = None, **kwargs) -> torch.jit.ScriptModule:
+    """Compile YOLACT with post-processing by `torch.jit.script`
+
+    Args:
+        model (:class:`YolactModel`):
+        path (:obj:`str`): saves the scripted module if given
+        kwargs: arguments of :class:`YolactScriptModule`
+    """
+    scripted = torch.jit.script(YolactScriptModule(model, **kwargs))
+    if path is not None:
+        scripted.save(path)
+
+    return scripted
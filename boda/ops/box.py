@@ -1,5 +1,5 @@
 import math
-from typing import Tuple, List
+from typing import Tuple
 import numpy as np
 
 import torch
@@ -96,6 +96,9 @@ def jaccard(box_a: Tensor, box_b: Tensor, iscrowd: bool = False) -> Tensor:
     Returns:
         jaccard overlap: (tensor) Shape: [box_a.size(0), box_b.size(0)]
     """
+    # Areas of large boxes lose precision in fp16 and bf16
+    box_a = box_a.float()
+    box_b = box_b.float()
     use_batch = True
     if box_a.dim() == 2:
         use_batch = False
@@ -302,7 +305,11 @@ class BoxCoder:
         return pred_boxes
 
 
-def decode(boxes: Tensor, prior_boxes: Tensor, variances: List[float] = [0.1, 0.2]):
+def decode(
+    boxes: Tensor,
+    prior_boxes: Tensor,
+    variances: Tuple[float, float] = (0.1, 0.2)
+) -> Tensor:
     """Decode locations from predictions using priors to undo
     the encoding we did for offset regression at train time.
 
@@ -310,17 +317,19 @@ def decode(boxes: Tensor, prior_boxes: Tensor, variances: List[float] = [0.1, 0.
 
     Args:
         loc (tensor): location predictions for loc layers,
-            Shape: [num_priors, 4]
+            Shape: [num_priors, 4] or [batch_size, num_priors, 4]
         priors (tensor): Prior boxes in center-offset form.
             Shape: [num_priors, 4].
-        variances: (`List[float]`) Variances of priorboxes
+        variances: (`Tuple[float, float]`) Variances of priorboxes
     Return:
         decoded bounding box predictions
     """
-    boxes = torch.cat((
-        prior_boxes[:, :2] + boxes[:, :2] * variances[0] * prior_boxes[:, 2:],
-        prior_boxes[:, 2:] * torch.exp(boxes[:, 2:] * variances[1])), dim=1)
-    boxes[:, :2] -= boxes[:, 2:] / 2
-    boxes[:, 2:] += boxes[:, :2]
-
-    return boxes
+    # exp overflows in half precision, decoding always runs in fp32
+    boxes = boxes.float()
+    prior_boxes = prior_boxes.float()
+    centers = prior_boxes[..., :2] + boxes[..., :2] * variances[0] * prior_boxes[..., 2:]
+    sizes = prior_boxes[..., 2:] * torch.exp(boxes[..., 2:] * variances[1])
+    # Out of place, so the function can be traced for ONNX export
+    mins = centers - sizes / 2
+
+    return torch.cat((mins, sizes + mins), dim=-1)
@@ -6,12 +6,15 @@ import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
 
+from ..utils.misc import force_fp32
+
 
 def sigmoid(x: ndarray) -> ndarray:
     """Sigmoid for NumPy"""
     return 1 / (1 + np.exp(-x))
 
 
+@force_fp32()
 def log_sum_exp(x):
     """Utility function for computing log_sum_exp while determining
     This will be used to determine unaveraged confidence loss across
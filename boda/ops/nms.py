@@ -2,8 +2,10 @@ import torch
 from torch import Tensor
 from torchvision.ops import nms as torchvision_nms
 from .box import jaccard
+from ..utils.misc import force_fp32
 
 
+@force_fp32(apply_to=('boxes', 'scores'))
 def hard_nms(
     boxes,
     scores,
@@ -60,6 +62,7 @@ def hard_nms(
     return boxes[idx] / 550, masks[idx], classes, scores
 
 
+@force_fp32(apply_to=('boxes', 'scores'))
 def fast_nms(
     boxes,
     scores,
@@ -0,0 +1,397 @@
+import os
+import json
+from array import array
+from typing import Tuple, List, Dict, Any, Optional, Union
+
+import numpy as np
+
+
+CACHE_MAGIC = b'BODAIDX1'
+CACHE_VERSION = 1
+CACHE_ALIGNMENT = 64
+
+# Kinds of segmentation in the packed buffer
+SEGM_NONE = 0
+SEGM_POLYGON = 1
+SEGM_RLE = 2  # compressed counts string
+SEGM_RLE_COUNTS = 3  # uncompressed counts list
+
+
+def encode_segmentation(segmentation: Union[List, Dict, None]) -> Tuple[int, bytes]:
+    """Pack a COCO segmentation into bytes
+
+    - polygons: int32 number of polygons, int32 lengths, float32 coordinates
+    - RLE: int32 height and width followed by the counts, as ASCII for
+      compressed RLE and as uint32 for uncompressed RLE
+
+    Returns:
+        kind (:obj:`int`): one of `SEGM_*`
+        data (:obj:`bytes`):
+    """
+    if segmentation is None or len(segmentation) == 0:
+        return SEGM_NONE, b''
+
+    if isinstance(segmentation, list):
+        lengths = [len(polygon) for polygon in segmentation]
+        header = np.asarray([len(lengths)] + lengths, dtype=np.int32)
+        coords = np.fromiter(
+            (v for polygon in segmentation for v in polygon), dtype=np.float32, count=sum(lengths))
+        return SEGM_POLYGON, header.tobytes() + coords.tobytes()
+
+    header = np.asarray(segmentation['size'], dtype=np.int32).tobytes()
+    counts = segmentation['counts']
+    if isinstance(counts, list):
+        return SEGM_RLE_COUNTS, header + np.asarray(counts, dtype=np.uint32).tobytes()
+
+    if isinstance(counts, str):
+        counts = counts.encode('ascii')
+
+    return SEGM_RLE, header + bytes(counts)
+
+
+def decode_segmentation(kind: int, data: np.ndarray) -> Union[List, Dict, None]:
+    """Inverse of `encode_segmentation`, returns the COCO format"""
+    if kind == SEGM_NONE:
+        return None
+
+    if kind == SEGM_POLYGON:
+        num_polygons = int(data[:4].view(np.int32)[0])
+        lengths = data[4:4 * (num_polygons + 1)].view(np.int32)
+        coords = data[4 * (num_polygons + 1):].view(np.float32)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        return [coords[offsets[i]:offsets[i+1]].tolist() for i in range(num_polygons)]
+
+    size = data[:8].view(np.int32).tolist()
+    if kind == SEGM_RLE_COUNTS:
+        return {'size': size, 'counts': data[8:].view(np.uint32).tolist()}
+
+    return {'size': size, 'counts': data[8:].tobytes()}
+
+
+class AnnotationStoreBuilder:
+    """Collects images and annotations one by one into compact buffers
+
+    Nothing is kept as a Python object per annotation, so a builder fed by a
+    streaming parser uses memory close to the final store.
+    """
+    def __init__(self) -> None:
+        self.image_ids = array('q')
+        self.heights = array('i')
+        self.widths = array('i')
+        self.file_name_lengths = array('q')
+        self.file_names = bytearray()
+
+        self.annot_ids = array('q')
+        self.annot_image_ids = array('q')
+        self.category_ids = array('i')
+        self.boxes = array('f')
+        self.areas = array('f')
+        self.iscrowd = array('B')
+        self.segm_kinds = array('B')
+        self.segm_lengths = array('q')
+        self.segm_data = bytearray()
+
+        self.categories: List[Dict[str, Any]] = []
+
+    def add_image(self, image: Dict[str, Any]) -> None:
+        file_name = image['file_name'].encode('utf-8')
+        self.image_ids.append(image['id'])
+        self.heights.append(image['height'])
+        self.widths.append(image['width'])
+        self.file_name_lengths.append(len(file_name))
+        self.file_names += file_name
+
+    def add_annotation(self, annot: Dict[str, Any]) -> None:
+        self.annot_ids.append(annot.get('id', len(self.annot_ids)))
+        self.annot_image_ids.append(annot['image_id'])
+        self.category_ids.append(annot['category_id'])
+        self.boxes.extend(annot['bbox'])
+        self.areas.append(annot.get('area', 0.0))
+        self.iscrowd.append(annot.get('iscrowd', 0))
+
+        kind, data = encode_segmentation(annot.get('segmentation'))
+        self.segm_kinds.append(kind)
+        self.segm_lengths.append(len(data))
+        self.segm_data += data
+
+    def add_category(self, category: Dict[str, Any]) -> None:
+        self.categories.append(dict(category))
+
+    def build(self) -> 'AnnotationStore':
+        """Sort images by id and group annotations by image"""
+        image_ids = np.frombuffer(self.image_ids, dtype=np.int64)
+        image_order = np.argsort(image_ids, kind='stable')
+        image_ids = image_ids[image_order]
+
+        file_name_offsets = _offsets(np.frombuffer(self.file_name_lengths, dtype=np.int64))
+        file_names, file_name_offsets = _gather(
+            np.frombuffer(self.file_names, dtype=np.uint8), file_name_offsets, image_order)
+
+        # Annotations of unknown images are dropped
+        annot_image_ids = np.frombuffer(self.annot_image_ids, dtype=np.int64)
+        rows = np.searchsorted(image_ids, annot_image_ids)
+        rows = np.minimum(rows, max(len(image_ids) - 1, 0))
+        valid = np.zeros(len(rows), dtype=bool)
+        if len(image_ids) > 0:
+            valid = image_ids[rows] == annot_image_ids
+        annot_order = np.flatnonzero(valid)
+        annot_order = annot_order[np.argsort(rows[annot_order], kind='stable')]
+
+        segm_offsets = _offsets(np.frombuffer(self.segm_lengths, dtype=np.int64))
+        segm_data, segm_offsets = _gather(
+            np.frombuffer(self.segm_data, dtype=np.uint8), segm_offsets, annot_order)
+
+        arrays = {
+            'image_ids': image_ids,
+            'heights': np.frombuffer(self.heights, dtype=np.int32)[image_order],
+            'widths': np.frombuffer(self.widths, dtype=np.int32)[image_order],
+            'file_name_offsets': file_name_offsets,
+            'file_names': file_names,
+            'annot_offsets': _offsets(np.bincount(rows[annot_order], minlength=len(image_ids))),
+            'annot_ids': np.frombuffer(self.annot_ids, dtype=np.int64)[annot_order],
+            'category_ids': np.frombuffer(self.category_ids, dtype=np.int32)[annot_order],
+            'boxes': np.frombuffer(self.boxes, dtype=np.float32).reshape(-1, 4)[annot_order],
+            'areas': np.frombuffer(self.areas, dtype=np.float32)[annot_order],
+            'iscrowd': np.frombuffer(self.iscrowd, dtype=np.uint8)[annot_order],
+            'segm_kinds': np.frombuffer(self.segm_kinds, dtype=np.uint8)[annot_order],
+            'segm_offsets': segm_offsets,
+            'segm_data': segm_data,
+        }
+
+        return AnnotationStore(arrays, self.categories)
+
+
+def _align(offset: int) -> int:
+    return (offset + CACHE_ALIGNMENT - 1) // CACHE_ALIGNMENT * CACHE_ALIGNMENT
+
+
+def _offsets(lengths: np.ndarray) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _gather(
+    data: np.ndarray,
+    offsets: np.ndarray,
+    order: np.ndarray,
+    chunk_size: int = 1 << 22
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Reorder variable length chunks of a flat buffer without a Python loop
+    per chunk
+
+    The byte index is built for about `chunk_size` output bytes at a time,
+    so the peak memory is the output and not eight times the buffer.
+    """
+    starts = offsets[:-1][order]
+    lengths = offsets[1:][order] - starts
+    new_offsets = _offsets(lengths)
+    if len(order) == len(offsets) - 1 and np.array_equal(order, np.arange(len(order))):
+        # Already in order, e.g. annotations grouped by image
+        return data.copy(), new_offsets
+
+    gathered = np.empty(new_offsets[-1], dtype=data.dtype)
+    rows = np.searchsorted(new_offsets, np.arange(0, new_offsets[-1], chunk_size), side='right') - 1
+    bounds = np.unique(np.append(rows, len(order)))
+    for i, j in zip(bounds[:-1], bounds[1:]):
+        index = np.arange(new_offsets[i], new_offsets[j], dtype=np.int64)
+        index += np.repeat(starts[i:j] - new_offsets[i:j], lengths[i:j])
+        gathered[new_offsets[i]:new_offsets[j]] = data[index]
+
+    return gathered, new_offsets
+
+
+class AnnotationStore:
+    """Columnar COCO annotations backed by numpy arrays
+
+    Images are sorted by id, and the annotations of the i-th image are rows
+    `annot_offsets[i]:annot_offsets[i+1]`. Segmentations are packed into one
+    byte buffer indexed by `segm_offsets`. Since there are only a few large
+    arrays and no Python object per annotation, DataLoader workers share the
+    store through copy-on-write instead of copying it.
+
+    Args:
+        arrays (:obj:`Dict[str, ndarray]`): built by :class:`AnnotationStoreBuilder`
+        categories (:obj:`List[Dict]`): categories of the COCO file
+    """
+    fields = (
+        'image_ids', 'heights', 'widths', 'file_name_offsets', 'file_names',
+        'annot_offsets', 'annot_ids', 'category_ids', 'boxes', 'areas', 'iscrowd',
+        'segm_kinds', 'segm_offsets', 'segm_data')
+
+    def __init__(self, arrays: Dict[str, np.ndarray], categories: List[Dict[str, Any]]) -> None:
+        for field in self.fields:
+            setattr(self, field, arrays[field])
+        self.categories = categories
+
+    @classmethod
+    def from_dict(cls, coco: Dict[str, Any]) -> 'AnnotationStore':
+        builder = AnnotationStoreBuilder()
+        for image in coco['images']:
+            builder.add_image(image)
+        for annot in coco.get('annotations', []):
+            builder.add_annotation(annot)
+        for category in coco.get('categories', []):
+            builder.add_category(category)
+
+        return builder.build()
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {field: getattr(self, field) for field in self.fields}
+
+    def save(self, path: str, key: Dict[str, Any] = None) -> None:
+        """Write the store as one file that `load` can memory-map
+
+        The file is a JSON header with the dtype, shape and offset of every
+        column followed by the raw columns, each aligned to 64 bytes. It is
+        written to a temporary file and renamed, so concurrent readers never
+        see a partial file.
+
+        Args:
+            path (:obj:`str`):
+            key (:obj:`Dict`): identifies the source, checked by `load`
+        """
+        columns = {}
+        offset = 0
+        for field in self.fields:
+            value = np.ascontiguousarray(getattr(self, field))
+            columns[field] = [value.dtype.str, list(value.shape), offset]
+            offset = _align(offset + value.nbytes)
+
+        header = json.dumps({
+            'version': CACHE_VERSION,
+            'key': key,
+            'categories': self.categories,
+            'columns': columns,
+        }).encode('utf-8')
+        data_offset = _align(len(CACHE_MAGIC) + 8 + len(header))
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(CACHE_MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for field in self.fields:
+                value = np.ascontiguousarray(getattr(self, field))
+                f.seek(data_offset + columns[field][2])
+                f.write(value.tobytes())
+            f.truncate(data_offset + offset)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, key: Dict[str, Any] = None) -> Optional['AnnotationStore']:
+        """Memory-map a store written by `save`
+
+        Returns `None` if the file is not a valid cache or was written for
+        another key, e.g. the annotation file has changed since.
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return None
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            try:
+                header = json.loads(f.read(header_size).decode('utf-8'))
+            except ValueError:
+                return None
+
+        if header.get('version') != CACHE_VERSION or header.get('key') != key:
+            return None
+
+        data_offset = _align(len(CACHE_MAGIC) + 8 + header_size)
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        arrays = {}
+        for field, (dtype, shape, offset) in header['columns'].items():
+            start = data_offset + offset
+            nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+            arrays[field] = buffer[start:start+nbytes].view(dtype).reshape(shape)
+
+        return cls(arrays, header['categories'])
+
+    @property
+    def num_images(self) -> int:
+        return len(self.image_ids)
+
+    @property
+    def num_annots(self) -> int:
+        return len(self.annot_ids)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, field).nbytes for field in self.fields)
+
+    def index(self, image_id: int) -> Optional[int]:
+        """Row of an image id, `None` if it is not in the store"""
+        i = int(np.searchsorted(self.image_ids, image_id))
+        if i < len(self.image_ids) and self.image_ids[i] == image_id:
+            return i
+
+        return None
+
+    def _index(self, image_id: int) -> int:
+        i = self.index(image_id)
+        if i is None:
+            raise KeyError(f'Image id {image_id} is not in the annotations.')
+
+        return i
+
+    def get_image_info(self, image_id: int) -> Dict[str, Any]:
+        i = self._index(image_id)
+        return {
+            'id': int(self.image_ids[i]),
+            'file_name': self.get_file_name(image_id),
+            'height': int(self.heights[i]),
+            'width': int(self.widths[i]),
+        }
+
+    def get_image_size(self, image_id: int) -> Tuple[int, int]:
+        i = self._index(image_id)
+        return int(self.heights[i]), int(self.widths[i])
+
+    def get_file_name(self, image_id: int) -> str:
+        i = self._index(image_id)
+        start, end = self.file_name_offsets[i:i+2]
+        return self.file_names[start:end].tobytes().decode('utf-8')
+
+    def get_annot_slice(self, image_id: int) -> slice:
+        i = self._index(image_id)
+        return slice(int(self.annot_offsets[i]), int(self.annot_offsets[i+1]))
+
+    def get_annot_arrays(self, image_id: int) -> Dict[str, np.ndarray]:
+        """Annotations of an image as views of the columns
+
+        Returns:
+            `ids` (:obj:`ndarray[N]`):
+            `category_ids` (:obj:`ndarray[N]`):
+            `boxes` (:obj:`ndarray[N, 4]`): x, y, w, h
+            `areas` (:obj:`ndarray[N]`):
+            `iscrowd` (:obj:`ndarray[N]`):
+        """
+        s = self.get_annot_slice(image_id)
+        return {
+            'ids': self.annot_ids[s],
+            'category_ids': self.category_ids[s],
+            'boxes': self.boxes[s],
+            'areas': self.areas[s],
+            'iscrowd': self.iscrowd[s],
+        }
+
+    def get_segmentation(self, row: int) -> Union[List, Dict, None]:
+        start, end = self.segm_offsets[row:row+2]
+        return decode_segmentation(int(self.segm_kinds[row]), self.segm_data[start:end])
+
+    def get_segmentations(self, image_id: int) -> List[Union[List, Dict, None]]:
+        s = self.get_annot_slice(image_id)
+        return [self.get_segmentation(row) for row in range(s.start, s.stop)]
+
+    def get_annots(self, image_id: int) -> List[Dict[str, Any]]:
+        """Annotations of an image in the COCO format"""
+        s = self.get_annot_slice(image_id)
+        return [{
+            'id': int(self.annot_ids[row]),
+            'image_id': image_id,
+            'category_id': int(self.category_ids[row]),
+            'bbox': self.boxes[row].tolist(),
+            'segmentation': self.get_segmentation(row),
+            'area': float(self.areas[row]),
+            'iscrowd': int(self.iscrowd[row]),
+        } for row in range(s.start, s.stop)]
@@ -0,0 +1,256 @@
+from typing import Tuple, List, Dict, Callable
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+
+def _split_targets(
+    targets: List[Dict[str, Tensor]],
+    key: str
+) -> Tuple[List[int], List[int]]:
+    """Indices of the targets holding `key` and their number of rows"""
+    indices = [i for i, t in enumerate(targets) if key in t]
+    return indices, [targets[i][key].size(0) for i in indices]
+
+
+def rgb_to_hsv(images: Tensor) -> Tensor:
+    """Same convention as `cv2.COLOR_RGB2HSV` of float images
+
+    Args:
+        images (:obj:`Tensor[B, 3, H, W]`): RGB in 0-255
+
+    Returns:
+        images (:obj:`Tensor[B, 3, H, W]`): hue in degrees, saturation in 0-1
+            and value in 0-255
+    """
+    r, g, b = images.unbind(1)
+    value = images.amax(dim=1)
+    chroma = value - images.amin(dim=1)
+    saturation = torch.where(value > 0, chroma / value.clamp(min=1e-12), torch.zeros_like(value))
+
+    safe_chroma = chroma.clamp(min=1e-12)
+    hue = torch.where(
+        r == value, torch.remainder((g - b) / safe_chroma, 6.0),
+        torch.where(g == value, (b - r) / safe_chroma + 2.0, (r - g) / safe_chroma + 4.0))
+    hue = torch.where(chroma > 0, hue * 60.0, torch.zeros_like(hue))
+
+    return torch.stack([hue, saturation, value], dim=1)
+
+
+def hsv_to_rgb(images: Tensor) -> Tensor:
+    """Inverse of :func:`rgb_to_hsv`, as `cv2.COLOR_HSV2RGB`"""
+    hue, saturation, value = images.unsqueeze(2).unbind(1)
+    # Channel n is V - V * S * clamp(min(k, 4 - k), 0, 1) with k = (n + H / 60) mod 6
+    n = torch.tensor([5.0, 3.0, 1.0], device=images.device, dtype=images.dtype).view(1, 3, 1, 1)
+    k = torch.remainder(n + hue / 60.0, 6.0)
+    weight = torch.minimum(k, 4.0 - k).clamp(0.0, 1.0)
+
+    return value - value * saturation * weight
+
+
+class BatchCompose:
+    """Augmentations applied to a collated batch on the training device
+
+    Each transform draws its random parameters per sample and applies them
+    to the whole batch at once, so the cost does not grow with the number of
+    dataloader workers. Images are float RGB in 0-255 before normalization.
+
+    Args:
+        transforms (:obj:`List[Callable]`):
+
+    Examples::
+        >>> augmentation = BatchCompose([
+        >>>     BatchRandomBrightness(), BatchRandomContrast(),
+        >>>     BatchRandomSaturation(), BatchRandomHue(),
+        >>>     BatchRandomFlip(p=0.5, horizontal=True), BatchResize(550, 550)])
+        >>> images, targets = augmentation(images.to(device), targets)
+    """
+    def __init__(self, transforms: List[Callable]) -> None:
+        self.transforms = transforms
+
+    @torch.no_grad()
+    def __call__(
+        self,
+        images: Tensor,
+        targets: List[Dict[str, Tensor]]
+    ) -> Tuple[Tensor, List[Dict[str, Tensor]]]:
+        for t in self.transforms:
+            images, targets = t(images, targets)
+
+        return images, targets
+
+
+class _BatchPhotometric:
+    def __init__(self, p: float) -> None:
+        self.p = p
+
+    def _sample(self, images: Tensor, lower: float, upper: float, identity: float) -> Tensor:
+        """Per-sample factors of shape [B, 1, 1, 1], `identity` where skipped"""
+        size = (images.size(0), 1, 1, 1)
+        factors = torch.empty(size, device=images.device, dtype=images.dtype).uniform_(lower, upper)
+        applied = torch.rand(size, device=images.device) < self.p
+
+        return torch.where(applied, factors, torch.full_like(factors, identity))
+
+
+class BatchRandomBrightness(_BatchPhotometric):
+    """Batched :class:`RandomBrightness`"""
+    def __init__(self, delta: float = 32, p: float = 0.5):
+        assert delta >= 0.0
+        assert delta <= 255.0
+        super().__init__(p)
+        self.delta = delta
+
+    def __call__(self, images, targets):
+        return images + self._sample(images, -self.delta, self.delta, 0.0), targets
+
+
+class BatchRandomContrast(_BatchPhotometric):
+    """Batched :class:`RandomContrast`"""
+    def __init__(self, lower: float = 0.5, upper: float = 1.5, p: float = 0.5):
+        assert upper >= lower, "contrast upper must be >= lower."
+        assert lower >= 0, "contrast lower must be non-negative."
+        super().__init__(p)
+        self.lower = lower
+        self.upper = upper
+
+    def __call__(self, images, targets):
+        return images * self._sample(images, self.lower, self.upper, 1.0), targets
+
+
+class BatchRandomSaturation(_BatchPhotometric):
+    """Batched :class:`RandomSaturation` on RGB images
+
+    Scaling the HSV saturation keeps the value and hue, so each channel
+    moves linearly towards the maximum channel and no HSV round trip is
+    needed.
+    """
+    def __init__(self, lower: float = 0.5, upper: float = 1.5, p: float = 0.5):
+        assert upper >= lower, "contrast upper must be >= lower."
+        assert lower >= 0, "contrast lower must be non-negative."
+        super().__init__(p)
+        self.lower = lower
+        self.upper = upper
+
+    def __call__(self, images, targets):
+        value = images.amax(dim=1, keepdim=True)
+        factors = self._sample(images, self.lower, self.upper, 1.0)
+
+        return torch.addcmul(value, value - images, factors, value=-1.0), targets
+
+
+class BatchRandomHue(_BatchPhotometric):
+    """Batched :class:`RandomHue` on RGB images"""
+    def __init__(self, delta: float = 18.0, p: float = 0.5):
+        assert delta >= 0.0 and delta <= 360.0
+        super().__init__(p)
+        self.delta = delta
+
+    def __call__(self, images, targets):
+        # The HSV round trip is the most expensive photometric transform,
+        # skipped samples are left out of it
+        selected = (torch.rand(images.size(0), device=images.device) < self.p).nonzero().squeeze(1)
+        if selected.numel() == 0:
+            return images, targets
+
+        hsv = rgb_to_hsv(images[selected])
+        hue = hsv[:, :1]
+        hue += torch.empty_like(hue[:, :, :1, :1]).uniform_(-self.delta, self.delta)
+        torch.remainder(hue, 360.0, out=hue)
+
+        return images.index_copy(0, selected, hsv_to_rgb(hsv)), targets
+
+
+class BatchRandomFlip:
+    """Batched :class:`RandomFlip`, each sample is flipped with probability `p`
+
+    Boxes and masks of all samples are concatenated, and the rows of the
+    flipped samples are updated with one `index_copy` per key.
+
+    Args:
+        p (:obj:`float`):
+        horizontal (:obj:`bool`): flips upside down by default
+    """
+    def __init__(self, p: float = 0.2, horizontal: bool = False):
+        self.p = p
+        self.horizontal = horizontal
+
+    def __call__(self, images, targets):
+        dim = -1 if self.horizontal else -2
+        flipped = torch.rand(images.size(0), device=images.device) < self.p
+        selected = flipped.nonzero().squeeze(1)
+        if selected.numel() == 0:
+            return images, targets
+
+        images = images.index_copy(0, selected, images[selected].flip(dim))
+        size = images.size(dim)
+
+        targets = [dict(t) for t in targets]
+        for key in ('boxes', 'masks', 'proto_masks'):
+            indices, counts = _split_targets(targets, key)
+            if sum(counts) == 0:
+                continue
+
+            values = torch.cat([targets[i][key] for i in indices])
+            rows = flipped[indices].repeat_interleave(
+                torch.as_tensor(counts, device=images.device)).nonzero().squeeze(1)
+            if key == 'boxes':
+                boxes = values[rows]
+                if self.horizontal:
+                    boxes = torch.stack(
+                        [size - boxes[:, 2], boxes[:, 1], size - boxes[:, 0], boxes[:, 3]], dim=1)
+                else:
+                    boxes = torch.stack(
+                        [boxes[:, 0], size - boxes[:, 3], boxes[:, 2], size - boxes[:, 1]], dim=1)
+                values = values.index_copy(0, rows, boxes)
+            else:
+                values = values.index_copy(0, rows, values[rows].flip(dim))
+
+            for i, value in zip(indices, values.split(counts)):
+                targets[i][key] = value
+
+        return images, targets
+
+
+class BatchResize:
+    """Batched :class:`Resize` with bilinear interpolation
+
+    Masks at the image resolution are resized with the image by nearest
+    neighbour sampling of pixel centers, as :class:`Resize`, masks at
+    another resolution, e.g. prototype masks, are kept.
+    """
+    def __init__(self, width: int, height: int) -> None:
+        self.width = width
+        self.height = height
+
+    def __call__(self, images, targets):
+        h, w = images.shape[-2:]
+        if (h, w) == (self.height, self.width):
+            return images, targets
+
+        images = F.interpolate(
+            images, size=(self.height, self.width), mode='bilinear', align_corners=False)
+
+        targets = [dict(t) for t in targets]
+        scale = torch.tensor(
+            [self.width / w, self.height / h, self.width / w, self.height / h],
+            device=images.device)
+        for t in targets:
+            if 'boxes' in t:
+                t['boxes'] = t['boxes'] * scale.to(t['boxes'].dtype)
+
+        indices = [i for i, t in enumerate(targets)
+                   if 'masks' in t and tuple(t['masks'].shape[-2:]) == (h, w)]
+        counts = [targets[i]['masks'].size(0) for i in indices]
+        if sum(counts) > 0:
+            masks = torch.cat([targets[i]['masks'] for i in indices])
+            resized = F.interpolate(
+                masks.unsqueeze(1), size=(self.height, self.width), mode='nearest-exact').squeeze(1)
+            for i, value in zip(indices, resized.split(counts)):
+                targets[i]['masks'] = value
+        else:
+            for i in indices:
+                targets[i]['masks'] = targets[i]['masks'].new_zeros((0, self.height, self.width))
+
+        return images, targets
@@ -0,0 +1,176 @@
+import os
+import re
+import glob
+import threading
+from typing import Any, Dict, List, Optional
+
+import torch
+from torch import Tensor
+
+
+def snapshot_to_cpu(obj: Any) -> Any:
+    """Copy every tensor of a nested state to CPU memory
+
+    CUDA tensors are copied into pinned memory without blocking and the
+    stream is synchronized once at the end, CPU tensors are cloned, so the
+    snapshot does not change when training updates the state in place.
+    """
+    has_cuda = [False]
+
+    def copy(value):
+        if isinstance(value, Tensor):
+            if value.is_cuda:
+                has_cuda[0] = True
+                out = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+                return out.copy_(value.detach(), non_blocking=True)
+            return value.detach().clone()
+        if isinstance(value, dict):
+            return type(value)((k, copy(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(copy(v) for v in value)
+        return value
+
+    snapshot = copy(obj)
+    if has_cuda[0]:
+        torch.cuda.synchronize()
+
+    return snapshot
+
+
+def atomic_save(obj: Any, path: str) -> None:
+    """`torch.save` to a temporary file renamed to `path` once it is on disk,
+    `path` is never left partially written"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    # The rename itself is durable once the directory is synced
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class CheckpointManager:
+    """Writes checkpoints on a background thread
+
+    :meth:`save` copies the state to CPU memory and returns, the copy is
+    written by :func:`atomic_save` while training goes on. At most one
+    write is pending, a save waits for the previous one. Errors of the
+    write are raised by the next :meth:`save`, :meth:`wait` or
+    :meth:`close`.
+
+    Args:
+        directory (:obj:`str`):
+        keep_last (:obj:`int`): number of checkpoints kept, all if `None`
+        interval (:obj:`int`): optimizer steps between checkpoints, only at
+            the end of each epoch if `None`
+        prefix (:obj:`str`): files are named `{prefix}_{step:08d}.pth`
+
+    Examples::
+        >>> manager = CheckpointManager('checkpoints', keep_last=3, interval=1000)
+        >>> trainer = Trainer(..., checkpoint=manager)
+        >>> state = manager.load()  # latest checkpoint
+    """
+    def __init__(
+        self,
+        directory: str = 'checkpoints',
+        keep_last: Optional[int] = 3,
+        interval: Optional[int] = None,
+        prefix: str = 'checkpoint'
+    ) -> None:
+        if keep_last is not None and keep_last < 1:
+            raise ValueError('keep_last must be positive.')
+        self.directory = directory
+        self.keep_last = keep_last
+        self.interval = interval
+        self.prefix = prefix
+        self.thread = None
+        self.error = None
+
+        # Leftovers of writes interrupted by a crash
+        for path in glob.glob(os.path.join(directory, f'{prefix}_*.pth.tmp')):
+            os.remove(path)
+
+    def __enter__(self) -> 'CheckpointManager':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def path(self, step: int) -> str:
+        return os.path.join(self.directory, f'{self.prefix}_{step:08d}.pth')
+
+    def checkpoints(self) -> List[str]:
+        """Paths of the written checkpoints, oldest first"""
+        pattern = re.compile(re.escape(self.prefix) + r'_(\d+)\.pth$')
+        steps = []
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            match = pattern.match(name)
+            if match is not None:
+                steps.append(int(match.group(1)))
+
+        return [self.path(step) for step in sorted(steps)]
+
+    def latest(self) -> Optional[str]:
+        self.wait()
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def should_save(self, step: int) -> bool:
+        return self.interval is not None and step % self.interval == 0
+
+    def save(self, state: Dict[str, Any], step: int) -> str:
+        """Snapshot `state` and write it in the background, a checkpoint of
+        the same step is replaced
+
+        Returns the path of the checkpoint.
+        """
+        self.wait()
+        snapshot = snapshot_to_cpu(state)
+        path = self.path(step)
+        self.thread = threading.Thread(target=self._write, args=(snapshot, path), daemon=True)
+        self.thread.start()
+
+        return path
+
+    def _write(self, snapshot, path) -> None:
+        try:
+            atomic_save(snapshot, path)
+            if self.keep_last is not None:
+                for old_path in self.checkpoints()[:-self.keep_last]:
+                    os.remove(old_path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self) -> None:
+        """Block until the pending write is on disk"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing the checkpoint failed.') from error
+
+    def close(self) -> None:
+        self.wait()
+
+    def load(self, path: Optional[str] = None, map_location='cpu') -> Optional[Dict[str, Any]]:
+        """Load a checkpoint, the latest one if `path` is `None`"""
+        path = path or self.latest()
+        if path is None:
+            return None
+
+        return torch.load(path, map_location=map_location, weights_only=False)
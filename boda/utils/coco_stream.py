@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import time
+import codecs
+from typing import Any, Iterator, Tuple, Callable, Optional
+
+from .annotation_store import AnnotationStore, AnnotationStoreBuilder
+
+
+def get_peak_rss() -> int:
+    """Peak resident set size of this process in bytes, 0 if unknown"""
+    try:
+        import resource
+    except ImportError:
+        return 0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class JsonStream:
+    """Incremental reader of a JSON document
+
+    Only the structure of the top-level object and arrays is walked by hand.
+    Each array element is decoded by `json.JSONDecoder.raw_decode` from a
+    bounded text buffer, so one element is held in memory at a time.
+
+    Args:
+        f (:obj:`BinaryIO`): file opened in binary mode
+        chunk_size (:obj:`int`): bytes read at a time
+    """
+    whitespace = ' \t\n\r'
+
+    def __init__(self, f, chunk_size: int = 1 << 24) -> None:
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.bytes_read = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        """Read the next chunk, returns False at the end of the file"""
+        if self.eof:
+            return False
+
+        chunk = self.f.read(self.chunk_size)
+        self.bytes_read += len(chunk)
+        self.eof = len(chunk) == 0
+        # Drop consumed text so the buffer stays around one chunk
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(chunk, final=self.eof)
+        self.pos = 0
+
+        return not self.eof
+
+    def peek(self) -> str:
+        """Next non-whitespace character, empty at the end of the file"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at byte {self.bytes_read} of the JSON file.')
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decode the next complete value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+
+            self.pos = end
+            return value
+
+    def items(self) -> Iterator[Any]:
+        """Iterate over the elements of the next array"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def keys(self) -> Iterator[str]:
+        """Iterate over the keys of the next object, the caller must consume
+        the value of each key"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+
+def stream_coco(
+    info_file: str,
+    chunk_size: int = 1 << 24,
+    log_interval: float = 5.0,
+    callback: Optional[Callable[[Tuple[int, int, int, int]], None]] = None
+) -> AnnotationStore:
+    """Parse a COCO annotation file into an :class:`AnnotationStore`
+    without loading the whole document
+
+    `images`, `annotations` and `categories` are walked element by element
+    and written into the columnar builder. Other keys, e.g. `info` and
+    `licenses`, are decoded and dropped.
+
+    Args:
+        info_file (:obj:`str`):
+        chunk_size (:obj:`int`): bytes read at a time
+        log_interval (:obj:`float`): seconds between progress reports, `0` disables them
+        callback (:obj:`Callable`): called with bytes read, total bytes,
+            number of images and number of annotations after each element
+    """
+    total_bytes = os.path.getsize(info_file)
+    builder = AnnotationStoreBuilder()
+    handlers = {
+        'images': builder.add_image,
+        'annotations': builder.add_annotation,
+        'categories': builder.add_category,
+    }
+
+    start_time = time.time()
+    last_time = start_time
+
+    def report(stream):
+        print(
+            f'Parsing {os.path.basename(info_file)}... '
+            f'{stream.bytes_read / max(total_bytes, 1):>6.1%} '
+            f'images: {len(builder.image_ids):,} '
+            f'annotations: {len(builder.annot_ids):,} '
+            f'peak RSS: {get_peak_rss() / 2**20:,.0f} MB '
+            f'({time.time() - start_time:.1f}s)')
+
+    with open(info_file, 'rb') as f:
+        stream = JsonStream(f, chunk_size)
+        for key in stream.keys():
+            handler = handlers.get(key)
+            if handler is None:
+                stream.value()
+                continue
+
+            for item in stream.items():
+                handler(item)
+
+                if callback is not None:
+                    callback((stream.bytes_read, total_bytes,
+                              len(builder.image_ids), len(builder.annot_ids)))
+
+                if log_interval > 0 and time.time() - last_time > log_interval:
+                    report(stream)
+                    last_time = time.time()
+
+        if log_interval > 0:
+            report(stream)
+
+    return builder.build()
@@ -1,25 +1,61 @@
 import os
 import json
-from collections import defaultdict
+import queue
+import hashlib
+import threading
+from typing import Tuple, List, Dict, Sequence
 
 import cv2
 import numpy as np
-from pycocotools import mask
+import torch
+from torch import Tensor
+from torch.utils.data import Dataset, get_worker_info
 
-from torch.utils.data import Dataset
+from .annotation_store import AnnotationStore
+from .coco_stream import stream_coco
+from .masks import decode_segmentation_mask
 
 
 class CocoParser:
-    def __init__(self, info_file):
-        self.coco = self._from_json(info_file)
-        self.image_info = {
-            c['id']: {
-                'file_name': c['file_name'],
-                'height': c['height'],
-                'width': c['width']} for c in self.coco['images']}
-        self.annot_info = self._get_annot_info()
-        self.category_info = self.coco['categories']
-        print(f'Attached dataset... {len(self.image_info):,}')
+    """Columnar index of a COCO annotation file
+
+    The JSON document is released after it is converted to an
+    :class:`AnnotationStore`, lookups by image id go through its offset index.
+
+    The store is written to a binary cache on first load and memory-mapped
+    on later loads, so the JSON is parsed once per annotation file. The
+    cache is keyed by the path, size and mtime of the JSON and is rebuilt
+    when any of them changes.
+
+    Args:
+        info_file (:obj:`str`): path of the COCO annotation file
+        cache_dir (:obj:`str`): directory of the cache, next to `info_file` by default
+        use_cache (:obj:`bool`):
+        streaming (:obj:`bool`): parse the JSON incrementally with `stream_coco`
+            for files that do not fit in memory as Python objects
+    """
+    def __init__(self, info_file, cache_dir=None, use_cache=True, streaming=False):
+        self.info_file = info_file
+        self.store = None
+        if use_cache:
+            cache_file = self._get_cache_file(info_file, cache_dir)
+            key = self._get_cache_key(info_file)
+            if os.path.isfile(cache_file):
+                self.store = AnnotationStore.load(cache_file, key)
+
+        if self.store is None:
+            if streaming:
+                self.store = stream_coco(info_file)
+            else:
+                self.store = AnnotationStore.from_dict(self._from_json(info_file))
+            if use_cache:
+                try:
+                    self.store.save(cache_file, key)
+                except OSError as e:
+                    print(f'Could not write the annotation cache {cache_file}: {e}')
+
+        self.category_info = self.store.categories
+        print(f'Attached dataset... {self.store.num_images:,}')
 
     def _from_json(self, info_file):
         with open(info_file, 'r', encoding='utf-8') as f:
@@ -27,47 +63,101 @@ class CocoParser:
 
         return info
 
-    def _get_annot_info(self):
-        annot_info = defaultdict(list)
-        for annot in self.coco['annotations']:
-            annot_info[annot['image_id']].append({
-                'id': annot['id'],
-                'category_id': annot['category_id'],
-                'bbox': annot['bbox'],
-                'segmentation': annot['segmentation'],
-                'area': annot['area'],
-                'iscrowd': annot['iscrowd']
-            })
+    @staticmethod
+    def _get_cache_key(info_file):
+        stat = os.stat(info_file)
+        return {
+            'path': os.path.abspath(info_file),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+
+    @staticmethod
+    def _get_cache_file(info_file, cache_dir=None):
+        if cache_dir is None:
+            return f'{info_file}.index'
+
+        os.makedirs(cache_dir, exist_ok=True)
+        path_hash = hashlib.sha1(os.path.abspath(info_file).encode('utf-8')).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(info_file))[0]
+
+        return os.path.join(cache_dir, f'{name}-{path_hash}.index')
+
+    @property
+    def image_ids(self) -> np.ndarray:
+        return self.store.image_ids
 
-        return annot_info
+    def get_image_info(self, image_id):
+        return self.store.get_image_info(image_id)
+
+    def get_image_size(self, image_id):
+        return self.store.get_image_size(image_id)
 
     def get_annots(self, image_id):
-        return self.annot_info.get(image_id)
+        return self.store.get_annots(image_id)
+
+    def get_annot_arrays(self, image_id):
+        return self.store.get_annot_arrays(image_id)
+
+    def get_segmentations(self, image_id):
+        return self.store.get_segmentations(image_id)
 
     # TODO: get_image_path or get_file_name
     def get_file_name(self, image_id):
-        return self.image_info.get(image_id)['file_name']
+        return self.store.get_file_name(image_id)
 
     def get_masks(self):
         raise NotImplementedError
 
 
 class CocoDataset(Dataset):
+    """
+    Args:
+        image_dir (:obj:`str`):
+        info_file (:obj:`str`): path of the COCO annotation file
+        mode (:obj:`str`): `train` returns image and targets, otherwise
+            the original height and width are returned too
+        use_mask (:obj:`bool`):
+        transforms (:obj:`Callable`):
+        label_map (:obj:`Dict[int, int]`): category id to label starting from 1
+        cache_dir (:obj:`str`): see :class:`CocoParser`
+        mask_size (:obj:`Tuple[int, int]`): rasterize polygons and resample
+            RLEs straight to this resolution, e.g. (550, 550), instead of
+            decoding full resolution masks
+        proto_mask_size (:obj:`Tuple[int, int]`): also returns `proto_masks`
+            at this resolution, e.g. (138, 138), for the mask loss
+    """
     def __init__(
         self,
         image_dir,
         info_file,
         mode: str = 'train',
         use_mask: bool = True,
-        transforms=None):
+        transforms=None,
+        label_map=None,
+        cache_dir=None,
+        mask_size=None,
+        proto_mask_size=None):
         self.image_dir = image_dir
         # self.coco = COCO(info_file)
         # self.image_ids = list(self.coco.imgToAnns.keys())
         self.mode = mode
         self.use_mask = use_mask
         self.transforms = transforms
-        self.coco = CocoParser(info_file)
-        self.image_ids = list(self.coco.image_info.keys())
+        # Resolutions the masks are rasterized at, the image resolution if None
+        self.mask_size = mask_size
+        self.proto_mask_size = proto_mask_size
+        self.coco = CocoParser(info_file, cache_dir=cache_dir)
+        self.image_ids = self.coco.image_ids
+
+        # Category id to contiguous label starting from 1
+        if label_map is None:
+            category_ids = sorted(c['id'] for c in self.coco.category_info)
+            label_map = {category_id: i + 1 for i, category_id in enumerate(category_ids)}
+        self.label_map = label_map
+        self.label_lookup = np.zeros(max(label_map, default=0) + 1, dtype=np.int64)
+        for category_id, label in label_map.items():
+            self.label_lookup[category_id] = label
 
         # self.label_map = { 1:  1,  2:  2,  3:  3,  4:  4,  5:  5,  6:  6,  7:  7,  8:  8,
         #            9:  9, 10: 10, 11: 11, 13: 12, 14: 13, 15: 14, 16: 15, 17: 16,
@@ -88,6 +178,16 @@ class CocoDataset(Dataset):
     def __len__(self):
         return len(self.image_ids)
 
+    def load_image(self, image_id):
+        """Returns the image as :obj:`ndarray[H, W, C]`"""
+        image = self.coco.get_file_name(image_id)
+        # image = Image.open(os.path.join(self.image_dir, image)).convert('RGB')
+        image = image.replace('\\', '/')
+
+        # Grayscale images are decoded to 3 channels
+        image = cv2.imread(os.path.join(self.image_dir, image), cv2.IMREAD_COLOR)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
     def __getitem__(self, index):
         """
         Returns:
@@ -95,51 +195,38 @@ class CocoDataset(Dataset):
             boxes [xyxy]
         """
         image_id = self.image_ids[index]
-        targets = self.coco.get_annots(image_id)
+        annots = self.coco.get_annot_arrays(image_id)
 
-        image = self.coco.get_file_name(image_id)
-        # image = Image.open(os.path.join(self.image_dir, image)).convert('RGB')
-        image = image.replace('\\', '/')
-        # print(os.path.join(self.image_dir, image))
-        image = cv2.imread(os.path.join(self.image_dir, image), cv2.COLOR_BGR2RGB)
-        # print(image)
+        image = self.load_image(image_id)
         h, w, _ = image.shape
+        # Annotations are in pixels of the original image, which differs
+        # from the loaded image when it was resized in advance
+        original_h, original_w = self.coco.get_image_size(image_id)
 
-        boxes = []
-        labels = []
         masks = []
-        crowds = []
-        areas = []
-
-        for target in targets:
-            boxes.append(target['bbox'])
-            # labels.append(target['category_id'])
-            # print(target['category_id'])
-            labels.append(self.label_map.get(target['category_id'])-1)
-            crowds.append(target['iscrowd'])
-            areas.append(target['area'])
-
-            if self.use_mask:
-                if target['segmentation'] is not None:
-                    segment = target['segmentation']
-                    if isinstance(segment, list):
-                        rles = mask.frPyObjects(segment, h, w)
-                        rle = mask.merge(rles)
-                    elif isinstance(segment['counts'], list):
-                        rle = mask.frPyObjects(segment, h, w)
-                    else:
-                        rle = segment
-
-                    masks.append(mask.decode(rle))
-        masks = np.vstack(masks).reshape(-1, h, w)
-
-        boxes = np.asarray(boxes, dtype=np.float32)
+        proto_masks = []
+        if self.use_mask:
+            mask_size = (h, w) if self.mask_size is None else tuple(self.mask_size)
+            for segment in self.coco.get_segmentations(image_id):
+                if segment is not None:
+                    masks.append(decode_segmentation_mask(
+                        segment, original_h, original_w, mask_size))
+                    if self.proto_mask_size is not None:
+                        proto_masks.append(decode_segmentation_mask(
+                            segment, original_h, original_w, self.proto_mask_size))
+
+            masks = np.asarray(masks, dtype=np.uint8).reshape(-1, *mask_size)
+
+        boxes = np.array(annots['boxes'], dtype=np.float32).reshape(-1, 4)
         # xywh to xyxy
         boxes[:, 2] = boxes[:, 0] + boxes[:, 2]
         boxes[:, 3] = boxes[:, 1] + boxes[:, 3]
+        if (h, w) != (original_h, original_w):
+            boxes *= np.asarray(
+                [w / original_w, h / original_h, w / original_w, h / original_h], dtype=np.float32)
 
-        labels = np.asarray(labels, dtype=np.int64)
-        crowds = np.asarray(crowds, dtype=np.int64)
+        labels = self.label_lookup[annots['category_ids']] - 1
+        crowds = annots['iscrowd'].astype(np.int64)
 
         # masks = np.vstack(masks).reshape(-1, h, w)
         # image = image.transpose((2, 0, 1))
@@ -151,6 +238,9 @@ class CocoDataset(Dataset):
                 'labels': labels,
                 'crowds': crowds,
             }
+            if self.proto_mask_size is not None:
+                targets['proto_masks'] = np.asarray(
+                    proto_masks, dtype=np.uint8).reshape(-1, *self.proto_mask_size)
         else:
             targets = {
                 'boxes': boxes,
@@ -171,6 +261,227 @@ class CocoDataset(Dataset):
             return image, targets, h, w
 
 
+def _as_tensor(value) -> Tensor:
+    return torch.from_numpy(np.ascontiguousarray(value)) if isinstance(value, np.ndarray) \
+        else torch.as_tensor(value)
+
+
+class DetectionCollate:
+    """Collate samples of :class:`CocoDataset` into padded tensors
+
+    Images are stacked into :obj:`Tensor[B, C, H, W]`, padded at the bottom
+    and right to the largest image. Each target key is stacked into
+    :obj:`Tensor[B, N, ...]` padded to the sample with the most objects,
+    and `counts` holds the number of objects of each sample. Every output
+    is allocated once and filled in place, in pinned memory when
+    `pin_memory` is set and the collate runs in the main process. Worker
+    outputs are pinned by the DataLoader as usual.
+
+    Numpy images are expected as [H, W, C] and tensors as [C, H, W], i.e.
+    before and after :class:`ToTensor`.
+
+    Args:
+        pin_memory (:obj:`bool`):
+
+    Examples::
+        >>> loader = DataLoader(
+        >>>     dataset, batch_size=8, collate_fn=DetectionCollate(), pin_memory=True)
+        >>> for images, targets in DevicePrefetcher(loader, 'cuda'):
+        >>>     ...
+    """
+    def __init__(self, pin_memory: bool = False) -> None:
+        self.pin_memory = pin_memory
+
+    def _empty(self, shape: Sequence[int], dtype: torch.dtype) -> Tensor:
+        pin = self.pin_memory and get_worker_info() is None and torch.cuda.is_available()
+        return torch.zeros(shape, dtype=dtype, pin_memory=pin)
+
+    def __call__(self, batch: List[Tuple]) -> Tuple:
+        images = [_as_tensor(sample[0]) for sample in batch]
+        images = [image.permute(2, 0, 1) if isinstance(sample[0], np.ndarray) else image
+                  for image, sample in zip(images, batch)]
+        channels = images[0].size(0)
+        height = max(image.size(1) for image in images)
+        width = max(image.size(2) for image in images)
+
+        outputs = self._empty((len(batch), channels, height, width), images[0].dtype)
+        for output, image in zip(outputs, images):
+            output[:, :image.size(1), :image.size(2)].copy_(image)
+
+        targets = [{k: _as_tensor(v) for k, v in sample[1].items()} for sample in batch]
+        counts = self._empty((len(batch),), torch.int64)
+        padded = {'counts': counts}
+        for key in targets[0]:
+            values = [t[key] for t in targets]
+            shape = [max(v.size(d) for v in values) for d in range(values[0].dim())]
+            if len(shape) == 0:
+                padded[key] = torch.stack(values)
+                continue
+
+            padded[key] = self._empty((len(batch), *shape), values[0].dtype)
+            for output, value in zip(padded[key], values):
+                output[tuple(slice(0, n) for n in value.shape)].copy_(value)
+
+        for i, t in enumerate(targets):
+            counts[i] = len(t['labels']) if 'labels' in t else len(next(iter(t.values()), []))
+
+        # Original height and width in the validation mode
+        extras = tuple(
+            torch.as_tensor([sample[i] for sample in batch]) for i in range(2, len(batch[0])))
+
+        return (outputs, padded) + extras
+
+
+def split_targets(
+    targets: Dict[str, Tensor],
+    counts: Sequence[int] = None
+) -> List[Dict[str, Tensor]]:
+    """Unpad the targets of :class:`DetectionCollate` into one dict per
+    sample, the slices are views
+
+    Only the object dimension is unpadded, masks keep the padded height
+    and width of the images. Pass `counts` from the host to avoid a device
+    synchronization.
+    """
+    if counts is None:
+        counts = targets['counts'].tolist()
+
+    return [{k: v[i, :n] for k, v in targets.items() if k != 'counts'}
+            for i, n in enumerate(counts)]
+
+
+def move_to_device(batch, device, non_blocking: bool = False):
+    """Move every tensor of nested lists, tuples and dicts to `device`"""
+    if isinstance(batch, Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    elif isinstance(batch, np.ndarray):
+        return _as_tensor(batch).to(device, non_blocking=non_blocking)
+    elif isinstance(batch, dict):
+        return {k: move_to_device(v, device, non_blocking) for k, v in batch.items()}
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(move_to_device(v, device, non_blocking) for v in batch)
+
+    return batch
+
+
+class DevicePrefetcher:
+    """Copy the next batch to the device while the current one is used
+
+    On CUDA the copy runs on a side stream from pinned memory. On other
+    devices, a background thread loads and moves up to `num_prefetch`
+    batches ahead. Batches of :class:`DetectionCollate` are yielded as
+    images and a list of target dicts, like the default collate.
+
+    Args:
+        loader (:obj:`Iterable`):
+        device (:obj:`str` or :obj:`torch.device`):
+        num_prefetch (:obj:`int`): batches loaded ahead by the thread
+    """
+    def __init__(self, loader, device, num_prefetch: int = 2) -> None:
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_stream()
+
+        return self._iter_thread()
+
+    @staticmethod
+    def _split(batch):
+        if isinstance(batch, tuple) and len(batch) > 1 \
+                and isinstance(batch[1], dict) and 'counts' in batch[1]:
+            counts = batch[1]['counts'].tolist()
+            return batch, counts
+
+        return batch, None
+
+    @staticmethod
+    def _finish(batch, counts):
+        if counts is None:
+            return batch
+
+        return (batch[0], split_targets(batch[1], counts)) + tuple(batch[2:])
+
+    def _iter_stream(self):
+        stream = torch.cuda.Stream(self.device)
+
+        def load(batch):
+            batch, counts = self._split(batch)
+            with torch.cuda.stream(stream):
+                return move_to_device(batch, self.device, non_blocking=True), counts
+
+        def record(batch):
+            # The memory was allocated on the side stream
+            if isinstance(batch, Tensor):
+                batch.record_stream(torch.cuda.current_stream(self.device))
+            elif isinstance(batch, dict):
+                for v in batch.values():
+                    record(v)
+            elif isinstance(batch, (list, tuple)):
+                for v in batch:
+                    record(v)
+
+        iterator = iter(self.loader)
+        try:
+            next_batch = load(next(iterator))
+        except StopIteration:
+            return
+
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch, counts = next_batch
+            record(batch)
+            try:
+                next_batch = load(next(iterator))
+            except StopIteration:
+                next_batch = None
+
+            yield self._finish(batch, counts)
+
+    def _iter_thread(self):
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    batch, counts = self._split(batch)
+                    if not put((move_to_device(batch, self.device), counts)):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+
+                yield self._finish(*item)
+        finally:
+            stop.set()
+
+
 if __name__ == '__main__':
     coco_dataset = CocoDataset('./benchmarks/samples/', './benchmarks/samples/annotations.json')
     coco_dataset[0]
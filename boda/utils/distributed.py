@@ -0,0 +1,193 @@
+import os
+import itertools
+from typing import Dict, Optional
+
+import torch
+import torch.distributed as dist
+from torch import nn, Tensor
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler, IterableDataset, Sampler
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(backend: Optional[str] = None) -> bool:
+    """Initialize the process group from the environment of `torchrun` or
+    :mod:`boda.utils.launch`
+
+    Returns `False` and does nothing when the process was not launched for
+    distributed training, i.e. `WORLD_SIZE` is not set.
+
+    Args:
+        backend (:obj:`str`): `nccl` with CUDA, otherwise `gloo` if `None`
+    """
+    if is_distributed():
+        return True
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1 and 'RANK' not in os.environ:
+        return False
+
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl':
+        torch.cuda.set_device(get_local_rank())
+    dist.init_process_group(backend=backend)
+
+    return True
+
+
+def cleanup_distributed() -> None:
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def get_device() -> torch.device:
+    """`cuda:LOCAL_RANK` if CUDA is available, otherwise the CPU"""
+    if torch.cuda.is_available():
+        return torch.device('cuda', get_local_rank())
+
+    return torch.device('cpu')
+
+
+def all_reduce_mean(values: Dict[str, Tensor]) -> Dict[str, Tensor]:
+    """Average detached scalars across ranks with one collective"""
+    if not is_distributed() or len(values) == 0:
+        return {k: v.detach() for k, v in values.items()}
+
+    keys = list(values)
+    stacked = torch.stack([values[k].detach().float().reshape(()) for k in keys])
+    dist.all_reduce(stacked)
+    stacked /= get_world_size()
+
+    return dict(zip(keys, stacked.unbind(0)))
+
+
+def frozen_batch_norms(model: nn.Module):
+    """Batch normalization layers whose affine parameters were frozen, e.g.
+    by :meth:`Model.freeze`"""
+    return [
+        module for module in model.modules()
+        if isinstance(module, _BatchNorm) and module.weight is not None
+        and not module.weight.requires_grad
+    ]
+
+
+def set_frozen_batch_norm_eval(model: nn.Module) -> None:
+    """Put frozen batch normalization layers in eval mode
+
+    Their running statistics then stay the loaded ones and are identical
+    on every rank, so DDP does not need to broadcast them.
+    """
+    for module in frozen_batch_norms(model):
+        module.eval()
+
+
+def wrap_model(
+    model: nn.Module,
+    device: torch.device,
+    find_unused_parameters: bool = False
+) -> nn.Module:
+    """Wrap a model in :class:`DistributedDataParallel`
+
+    Parameters not requiring gradients, such as frozen batch normalization,
+    are left out of the gradient buckets by DDP, so :meth:`Model.freeze`
+    must be called before wrapping. Buffers are only broadcast from rank 0
+    if some batch normalization layer still trains.
+    """
+    if not is_distributed():
+        return model
+
+    frozen = set(map(id, frozen_batch_norms(model)))
+    trainable_bn = any(
+        isinstance(module, _BatchNorm) and module.track_running_stats and id(module) not in frozen
+        for module in model.modules())
+
+    device = torch.device(device)
+    return DistributedDataParallel(
+        model,
+        device_ids=[device.index] if device.type == 'cuda' else None,
+        broadcast_buffers=trainable_bn,
+        find_unused_parameters=find_unused_parameters)
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def distributed_loader(loader: DataLoader, shuffle: bool = True) -> DataLoader:
+    """Rebuild a DataLoader of a map-style dataset with a
+    :class:`DistributedSampler`, loaders that already shard are returned"""
+    if not is_distributed() or isinstance(loader.dataset, IterableDataset) \
+            or isinstance(loader.sampler, DistributedSampler):
+        return loader
+
+    sampler = DistributedSampler(loader.dataset, shuffle=shuffle, drop_last=loader.drop_last)
+    return DataLoader(
+        loader.dataset,
+        batch_size=loader.batch_size,
+        sampler=sampler,
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+        drop_last=loader.drop_last,
+        timeout=loader.timeout,
+        worker_init_fn=loader.worker_init_fn,
+        persistent_workers=loader.persistent_workers)
+
+
+class _SkipBatchSampler(Sampler):
+    """Batches of `batch_sampler` after the first `num_batches`"""
+    def __init__(self, batch_sampler: Sampler, num_batches: int) -> None:
+        self.batch_sampler = batch_sampler
+        self.num_batches = num_batches
+
+    def __iter__(self):
+        return itertools.islice(iter(self.batch_sampler), self.num_batches, None)
+
+    def __len__(self) -> int:
+        return max(len(self.batch_sampler) - self.num_batches, 0)
+
+
+def skip_batches(loader: DataLoader, num_batches: int) -> DataLoader:
+    """Rebuild a DataLoader of a map-style dataset without its first
+    `num_batches` batches, which are skipped as indices without loading
+    them. The skipped samples are those of the interrupted run if the
+    sampler is seeded, e.g. a `DistributedSampler`. Other loaders are
+    returned."""
+    if num_batches == 0 or isinstance(loader.dataset, IterableDataset):
+        return loader
+
+    return DataLoader(
+        loader.dataset,
+        batch_sampler=_SkipBatchSampler(loader.batch_sampler, num_batches),
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+        timeout=loader.timeout,
+        worker_init_fn=loader.worker_init_fn,
+        generator=loader.generator)
+
+
+def set_epoch(loader: DataLoader, epoch: int) -> None:
+    """Reshuffle a distributed sampler or a sharded dataset for `epoch`"""
+    for obj in (loader.sampler, loader.dataset):
+        if hasattr(obj, 'set_epoch'):
+            obj.set_epoch(epoch)
@@ -1,3 +1,27 @@
+import math
+from copy import deepcopy
+from typing import List, Optional
+
+import torch
+from torch import nn, Tensor
+
+from .distributed import unwrap_model
+
+
+def copy_attr(a, b, include=(), exclude=()):
+    # Copy attributes from b to a, options to only include [...] and to exclude [...]
+    for k, v in b.__dict__.items():
+        if (len(include) and k not in include) or k.startswith('_') or k in exclude:
+            continue
+        setattr(a, k, v)
+
+
+def _floating_tensors(model: nn.Module) -> List[Tensor]:
+    """Floating point parameters and buffers in `state_dict` order"""
+    state = model.state_dict(keep_vars=True)
+    return [v.data for v in state.values() if v.dtype.is_floating_point]
+
+
 class ModelEMA:
     """ Model Exponential Moving Average from https://github.com/rwightman/pytorch-image-models
     Keep a moving average of everything in the model state_dict (parameters and buffers).
@@ -6,30 +30,88 @@ class ModelEMA:
     A smoothed version of the weights is necessary for some training schemes to perform well.
     This class is sensitive where it is initialized in the sequence of model init,
     GPU assignment and distributed training wrappers.
-    """
 
-    def __init__(self, model, decay=0.9999, updates=0):
+    The floating point tensors of both models are collected once, and each
+    update is two multi-tensor kernels (`torch._foreach_mul_` and
+    `torch._foreach_add_`) instead of two kernels per tensor.
+
+    Args:
+        model (:obj:`nn.Module`):
+        decay (:obj:`float`):
+        updates (:obj:`int`): optimizer steps already taken, for resuming
+        update_every (:obj:`int`): optimizer steps between updates, the decay
+            is raised to this power so the averaging horizon in steps is kept
+        device (:obj:`torch.device`): e.g. `cpu` to keep the EMA out of GPU
+            memory, the device of the model if `None`
+        dtype (:obj:`torch.dtype`): floating point dtype of the EMA, e.g.
+            `torch.bfloat16`. Increments smaller than its resolution are
+            lost, so use it with a large `update_every` or a smaller decay.
+    """
+    def __init__(
+        self,
+        model: nn.Module,
+        decay: float = 0.9999,
+        updates: int = 0,
+        update_every: int = 1,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None
+    ) -> None:
+        if update_every < 1:
+            raise ValueError('update_every must be positive.')
         # Create EMA
-        self.ema = deepcopy(model.module if is_parallel(model) else model).eval()  # FP32 EMA
-        # if next(model.parameters()).device.type != 'cpu':
-        #     self.ema.half()  # FP16 EMA
-        self.updates = updates  # number of EMA updates
-        self.decay = lambda x: decay * (1 - math.exp(-x / 2000))  # decay exponential ramp (to help early epochs)
+        self.ema = deepcopy(unwrap_model(model)).eval()  # FP32 EMA
+        if device is not None or dtype is not None:
+            self.ema.to(device=device, dtype=dtype)
+        self.updates = updates  # number of optimizer steps seen
+        self.update_every = update_every
+        # decay exponential ramp (to help early epochs)
+        self.decay = lambda x: decay * (1 - math.exp(-x / 2000))
         for p in self.ema.parameters():
             p.requires_grad_(False)
 
+        self.ema_tensors = _floating_tensors(self.ema)
+        self.model_tensors = None
+        self.source = None
+        self.needs_cast = False
+
+    def _source_tensors(self, model: nn.Module) -> List[Tensor]:
+        # The parameters of a model are updated in place by the optimizer,
+        # so they are only collected again for another model
+        if self.source is not model:
+            self.model_tensors = _floating_tensors(model)
+            self.source = model
+            if len(self.model_tensors) != len(self.ema_tensors):
+                raise ValueError('The model does not match the EMA.')
+            self.needs_cast = any(
+                t.device != e.device or t.dtype != e.dtype
+                for t, e in zip(self.model_tensors, self.ema_tensors))
+
+        return self.model_tensors
+
     def update(self, model):
         # Update EMA parameters
+        self.updates += 1
+        if self.updates % self.update_every != 0:
+            return
+
         with torch.no_grad():
-            self.updates += 1
-            d = self.decay(self.updates)
+            d = self.decay(self.updates) ** self.update_every
+            source = self._source_tensors(unwrap_model(model))
+            ema = self.ema_tensors
+            if self.needs_cast:
+                source = [t.to(device=e.device, dtype=e.dtype)
+                          for t, e in zip(source, ema)]
+
+            torch._foreach_mul_(ema, d)
+            torch._foreach_add_(ema, source, alpha=1. - d)
+
+    def state_dict(self):
+        return {'ema': self.ema.state_dict(), 'updates': self.updates}
 
-            msd = model.module.state_dict() if is_parallel(model) else model.state_dict()  # model state_dict
-            for k, v in self.ema.state_dict().items():
-                if v.dtype.is_floating_point:
-                    v *= d
-                    v += (1. - d) * msd[k].detach()
+    def load_state_dict(self, state):
+        self.ema.load_state_dict(state['ema'])
+        self.updates = state['updates']
 
     def update_attr(self, model, include=(), exclude=('process_group', 'reducer')):
         # Update EMA attributes
-        copy_attr(self.ema, model, include, exclude)
\ No newline at end of file
+        copy_attr(self.ema, model, include, exclude)
@@ -0,0 +1,477 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, List, Dict, Sequence
+
+import numpy as np
+import torch
+from pycocotools import mask as mask_utils
+from torch import Tensor
+
+from .masks import encode_masks
+
+
+# Same values as pycocotools.cocoeval.Params
+IOU_THRESHOLDS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+RECALL_THRESHOLDS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+AREA_RANGES = {
+    'all': (0 ** 2, 1e5 ** 2),
+    'small': (0 ** 2, 32 ** 2),
+    'medium': (32 ** 2, 96 ** 2),
+    'large': (96 ** 2, 1e5 ** 2),
+}
+IOU_TYPES = ('box', 'mask')
+
+
+def _as_numpy(value, dtype=None) -> np.ndarray:
+    if isinstance(value, Tensor):
+        value = value.detach().cpu().numpy()
+    return np.asarray(value, dtype=dtype)
+
+
+def box_iou_matrix(
+    pred_boxes: np.ndarray,
+    true_boxes: np.ndarray,
+    crowds: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """IoU of boxes in xyxy as `pycocotools.mask.iou`, in float64
+
+    The IoU with a crowd is the intersection over the area of the
+    prediction.
+
+    Returns:
+        ious (:obj:`ndarray[D, G]`):
+        pred_areas (:obj:`ndarray[D]`):
+        true_areas (:obj:`ndarray[G]`):
+    """
+    pred_areas = (pred_boxes[:, 2] - pred_boxes[:, 0]) * (pred_boxes[:, 3] - pred_boxes[:, 1])
+    true_areas = (true_boxes[:, 2] - true_boxes[:, 0]) * (true_boxes[:, 3] - true_boxes[:, 1])
+    wh = np.minimum(pred_boxes[:, None, 2:], true_boxes[None, :, 2:]) \
+        - np.maximum(pred_boxes[:, None, :2], true_boxes[None, :, :2])
+    inter = wh.clip(min=0).prod(axis=2)
+    unions = np.where(
+        crowds[None], pred_areas[:, None], pred_areas[:, None] + true_areas[None] - inter)
+    ious = np.divide(inter, unions, out=np.zeros_like(inter), where=unions > 0)
+
+    return ious, pred_areas, true_areas
+
+
+def mask_iou_matrix(
+    pred_rles: List[Dict],
+    true_rles: List[Dict],
+    crowds: np.ndarray
+) -> np.ndarray:
+    """IoU of masks in RLE computed on the run lengths by `pycocotools.mask.iou`
+
+    Returns:
+        ious (:obj:`ndarray[D, G]`):
+    """
+    if len(pred_rles) == 0 or len(true_rles) == 0:
+        return np.zeros((len(pred_rles), len(true_rles)))
+
+    return mask_utils.iou(pred_rles, true_rles, crowds.astype(np.uint8).tolist())
+
+
+def _last_argmax(values: np.ndarray) -> np.ndarray:
+    """Index of the last maximum along the last axis"""
+    return values.shape[-1] - 1 - np.argmax(values[..., ::-1], axis=-1)
+
+
+def match_detections(
+    ious: np.ndarray,
+    pred_labels: np.ndarray,
+    true_labels: np.ndarray,
+    true_ignores: np.ndarray,
+    crowds: np.ndarray,
+    iou_thresholds: np.ndarray = IOU_THRESHOLDS
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Greedy matching of `pycocotools.cocoeval.COCOeval.evaluateImg` for
+    every IoU threshold and area range at once
+
+    Predictions must be sorted by descending score. Each one takes the
+    free ground truth of its class with the highest IoU above the
+    threshold, ground truth outside the area range is only taken when no
+    other one is left, and crowds are never used up. The loop runs over
+    predictions only, predictions without any overlap are skipped.
+
+    Args:
+        ious (:obj:`ndarray[D, G]`):
+        pred_labels (:obj:`ndarray[D]`):
+        true_labels (:obj:`ndarray[G]`):
+        true_ignores (:obj:`ndarray[A, G]`): crowds and ground truth out of
+            each area range
+        crowds (:obj:`ndarray[G]`):
+
+    Returns:
+        matched (:obj:`ndarray[A, T, D]`): true positives
+        matched_ignored (:obj:`ndarray[A, T, D]`): matched to an ignored
+            ground truth
+    """
+    num_areas, num_preds = true_ignores.shape[0], ious.shape[0]
+    num_thresholds = len(iou_thresholds)
+    matched = np.zeros((num_areas, num_thresholds, num_preds), dtype=bool)
+    matched_ignored = np.zeros_like(matched)
+    if num_preds == 0 or ious.shape[1] == 0:
+        return matched, matched_ignored
+
+    ious = np.where(pred_labels[:, None] == true_labels[None], ious, -1.0)
+    used = np.zeros((num_areas, num_thresholds, ious.shape[1]), dtype=bool)
+    thresholds = iou_thresholds[None, :, None]
+    ignores = true_ignores[:, None, :]
+    for i in np.flatnonzero(ious.max(axis=1) >= iou_thresholds.min()):
+        candidates = (~used | crowds) & (ious[i] >= thresholds)
+        regular = np.where(candidates & ~ignores, ious[i], -1.0)
+        ignored = np.where(candidates & ignores, ious[i], -1.0)
+
+        has_regular = regular.max(axis=2) >= 0
+        has_match = has_regular | (ignored.max(axis=2) >= 0)
+        indices = np.where(has_regular, _last_argmax(regular), _last_argmax(ignored))
+
+        a, t = np.nonzero(has_match)
+        used[a, t, indices[a, t]] = True
+        matched[:, :, i] = has_match
+        matched_ignored[:, :, i] = has_match & ~has_regular
+
+    return matched, matched_ignored
+
+
+def average_precision(
+    scores: np.ndarray,
+    matched: np.ndarray,
+    ignored: np.ndarray,
+    num_positives: int,
+    recall_thresholds: np.ndarray = RECALL_THRESHOLDS
+) -> np.ndarray:
+    """101-point interpolated AP of `COCOeval.accumulate` for one class
+
+    Args:
+        scores (:obj:`ndarray[N]`): in the order the images were added
+        matched (:obj:`ndarray[..., N]`):
+        ignored (:obj:`ndarray[..., N]`):
+        num_positives (:obj:`int` or :obj:`ndarray[...]`): ground truth not
+            ignored
+
+    Returns:
+        ap (:obj:`ndarray[...]`):
+    """
+    shape = matched.shape[:-1]
+    if len(scores) == 0:
+        return np.zeros(shape)
+
+    order = np.argsort(-scores, kind='mergesort')
+    matched = matched[..., order]
+    ignored = ignored[..., order]
+
+    tp = np.cumsum(matched & ~ignored, axis=-1, dtype=np.float64)
+    fp = np.cumsum(~matched & ~ignored, axis=-1, dtype=np.float64)
+    num_positives = np.asarray(num_positives, dtype=np.float64)[..., None]
+    recalls = tp / np.maximum(num_positives, 1)
+    precisions = tp / (fp + tp + np.spacing(1))
+    # Precision envelope, the maximum precision at any higher recall
+    precisions = np.maximum.accumulate(precisions[..., ::-1], axis=-1)[..., ::-1]
+
+    recalls = recalls.reshape(-1, recalls.shape[-1])
+    precisions = precisions.reshape(-1, precisions.shape[-1])
+    interpolated = np.zeros((len(recalls), len(recall_thresholds)))
+    for row, (recall, precision) in enumerate(zip(recalls, precisions)):
+        indices = np.searchsorted(recall, recall_thresholds, side='left')
+        valid = indices < len(precision)
+        interpolated[row, valid] = precision[indices[valid]]
+
+    return interpolated.mean(axis=-1).reshape(shape)
+
+
+class CocoEvaluator:
+    """COCO box and mask mAP, as `pycocotools.cocoeval.COCOeval`
+
+    Each image is first reduced to its top predictions with numpy boxes
+    and RLE masks. IoU matrices are computed once per image, mask IoU on
+    the run lengths, and predictions are matched for all IoU thresholds
+    and area ranges together by :func:`match_detections`. Only the scores
+    and the match flags of each prediction are kept, packed into bits, and
+    :meth:`summarize` computes the 101-point interpolated AP from them.
+
+    With `num_workers`, images are matched in chunks of `chunk_size` by a
+    process pool and the results are merged in the order of the images, so
+    the numbers do not depend on the number of workers.
+
+    Predictions and targets are in pixels of the original image, boxes in
+    xyxy and masks binary or a list of COCO RLE. Pass `areas`, the COCO
+    `area` of each ground truth, to reproduce the area ranges of
+    pycocotools exactly, the mask or box area is used otherwise. Scores
+    tied across images are ordered by the order of the images, pycocotools
+    orders them by image id.
+
+    Args:
+        num_classes (:obj:`int`): labels are 0-based
+        iou_types (:obj:`Tuple[str]`): `box` and/or `mask`
+        max_dets (:obj:`int`): predictions kept per image and class
+        num_workers (:obj:`int`): processes matching images, in the calling
+            process if 0
+        chunk_size (:obj:`int`): images per task of a worker
+
+    Examples::
+        >>> evaluator = CocoEvaluator(num_classes=80, num_workers=8)
+        >>> for preds, targets in results:
+        >>>     evaluator.update(preds, targets)
+        >>> stats = evaluator.summarize()  # {'box/AP': ..., 'mask/AP50': ...}
+        >>> evaluator.close()
+    """
+    def __init__(
+        self,
+        num_classes: int,
+        iou_types: Sequence[str] = IOU_TYPES,
+        max_dets: int = 100,
+        num_workers: int = 0,
+        chunk_size: int = 64
+    ) -> None:
+        for iou_type in iou_types:
+            if iou_type not in IOU_TYPES:
+                raise ValueError(f'iou_types must be in {IOU_TYPES}, got {iou_type}.')
+        self.num_classes = num_classes
+        self.iou_types = tuple(iou_types)
+        self.max_dets = max_dets
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.area_ranges = np.array(list(AREA_RANGES.values()))
+        self.executor = None
+        self.reset()
+
+    def __enter__(self) -> 'CocoEvaluator':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def reset(self) -> None:
+        self.scores = []
+        self.labels = []
+        self.matched = {iou_type: [] for iou_type in self.iou_types}
+        self.ignored = {iou_type: [] for iou_type in self.iou_types}
+        self.num_positives = {
+            iou_type: np.zeros((len(self.area_ranges), self.num_classes), dtype=np.int64)
+            for iou_type in self.iou_types}
+        self.num_images = 0
+        # Compact images waiting for a worker and chunks being matched
+        self.chunk = []
+        self.pending = deque()
+
+    def close(self) -> None:
+        """Shut down the worker processes"""
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def _top_predictions(self, scores: np.ndarray, labels: np.ndarray) -> np.ndarray:
+        """Indices of the predictions sorted by score, `max_dets` per class"""
+        order = np.argsort(-scores, kind='mergesort')
+        # Rank of each prediction within its class
+        one_hot = labels[order, None] == np.unique(labels)[None]
+        ranks = (np.cumsum(one_hot, axis=0) - 1)[one_hot]
+
+        return order[ranks < self.max_dets]
+
+    def compact(
+        self,
+        preds: Dict[str, Tensor],
+        targets: Dict[str, Tensor]
+    ) -> Dict[str, np.ndarray]:
+        """Top predictions and targets of one image as numpy arrays and RLE
+        masks, which is all the evaluation keeps of an image"""
+        scores = _as_numpy(preds['scores'], np.float64).reshape(-1)
+        labels = _as_numpy(preds['labels'], np.int64).reshape(-1)
+        keep = self._top_predictions(scores, labels)
+        true_labels = _as_numpy(targets['labels'], np.int64).reshape(-1)
+
+        sample = {
+            'scores': scores[keep],
+            'labels': labels[keep],
+            'boxes': _as_numpy(preds['boxes'], np.float64).reshape(-1, 4)[keep],
+            'true_labels': true_labels,
+            'true_boxes': _as_numpy(targets['boxes'], np.float64).reshape(-1, 4),
+            'crowds': _as_numpy(targets['crowds'], bool).reshape(-1)
+            if 'crowds' in targets else np.zeros(len(true_labels), dtype=bool),
+        }
+        if 'areas' in targets:
+            sample['areas'] = _as_numpy(targets['areas'], np.float64).reshape(-1)
+        if 'mask' in self.iou_types:
+            pred_masks = preds['masks']
+            if isinstance(pred_masks, list):
+                sample['masks'] = [pred_masks[i] for i in keep]
+            else:
+                # Only the kept masks are copied to the host and encoded
+                if isinstance(pred_masks, Tensor):
+                    keep = torch.as_tensor(keep, device=pred_masks.device)
+                sample['masks'] = encode_masks(pred_masks[keep])
+            true_masks = targets['masks']
+            sample['true_masks'] = true_masks if isinstance(true_masks, list) \
+                else encode_masks(true_masks)
+
+        return sample
+
+    def add(self, preds: Dict[str, Tensor], targets: Dict[str, Tensor]) -> None:
+        """Match the predictions of one image
+
+        Args:
+            preds (:obj:`Dict[str, Tensor]`): `boxes`, `scores`, `labels` and
+                `masks` for mask mAP
+            targets (:obj:`Dict[str, Tensor]`): `boxes`, `labels`, optional
+                `crowds` and `areas`, and `masks` for mask mAP
+        """
+        sample = self.compact(preds, targets)
+        if self.num_workers == 0:
+            self.add_compact(sample)
+            return
+
+        self.chunk.append(sample)
+        if len(self.chunk) >= self.chunk_size:
+            self._submit()
+
+    def add_compact(self, sample: Dict[str, np.ndarray]) -> None:
+        """Match an image returned by :meth:`compact`"""
+        crowds = sample['crowds']
+        for iou_type in self.iou_types:
+            if iou_type == 'box':
+                ious, pred_areas, true_areas = box_iou_matrix(
+                    sample['boxes'], sample['true_boxes'], crowds)
+            else:
+                ious = mask_iou_matrix(sample['masks'], sample['true_masks'], crowds)
+                pred_areas = mask_utils.area(sample['masks']) if sample['masks'] else np.zeros(0)
+                true_areas = mask_utils.area(sample['true_masks']) \
+                    if sample['true_masks'] else np.zeros(0)
+            if 'areas' in sample:
+                true_areas = sample['areas']
+
+            self._add(iou_type, ious, sample['labels'], pred_areas.astype(np.float64),
+                      sample['true_labels'], true_areas.astype(np.float64), crowds)
+
+        self.scores.append(sample['scores'])
+        self.labels.append(sample['labels'])
+        self.num_images += 1
+
+    def _add(self, iou_type, ious, labels, pred_areas, true_labels, true_areas, crowds) -> None:
+        lower, upper = self.area_ranges[:, :1], self.area_ranges[:, 1:]
+        true_ignores = crowds[None] | (true_areas[None] < lower) | (true_areas[None] > upper)
+        matched, matched_ignored = match_detections(
+            ious, labels, true_labels, true_ignores, crowds)
+
+        # Unmatched predictions out of the area range are not counted
+        outside = (pred_areas[None] < lower) | (pred_areas[None] > upper)
+        ignored = matched_ignored | (~matched & outside[:, None])
+
+        # One bit per area range and IoU threshold
+        num_flags = matched.shape[0] * matched.shape[1]
+        self.matched[iou_type].append(np.packbits(matched.reshape(num_flags, -1), axis=0))
+        self.ignored[iou_type].append(np.packbits(ignored.reshape(num_flags, -1), axis=0))
+        for a, ignores in enumerate(true_ignores):
+            np.add.at(self.num_positives[iou_type][a], true_labels[~ignores], 1)
+
+    def update(self, preds: List[Dict[str, Tensor]], targets: List[Dict[str, Tensor]]) -> None:
+        """Match the predictions of a batch"""
+        for pred, target in zip(preds, targets):
+            self.add(pred, target)
+
+    def _submit(self) -> None:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.num_workers)
+        config = {'num_classes': self.num_classes, 'iou_types': self.iou_types}
+        self.pending.append(self.executor.submit(_match_chunk, config, self.chunk))
+        self.chunk = []
+
+        # Results are merged in order, and at most two chunks per worker
+        # wait, so compact images do not pile up in memory
+        while self.pending and (self.pending[0].done() or len(self.pending) > 2 * self.num_workers):
+            self.merge(self.pending.popleft().result())
+
+    def synchronize(self) -> None:
+        """Wait for the workers and merge all their results"""
+        if self.chunk:
+            self._submit()
+        while self.pending:
+            self.merge(self.pending.popleft().result())
+
+    def state_dict(self) -> Dict:
+        return {
+            'scores': self.scores,
+            'labels': self.labels,
+            'matched': self.matched,
+            'ignored': self.ignored,
+            'num_positives': self.num_positives,
+            'num_images': self.num_images,
+        }
+
+    def merge(self, state: Dict) -> None:
+        """Append the accumulators of the images of another evaluator"""
+        self.scores.extend(state['scores'])
+        self.labels.extend(state['labels'])
+        for iou_type in self.iou_types:
+            self.matched[iou_type].extend(state['matched'][iou_type])
+            self.ignored[iou_type].extend(state['ignored'][iou_type])
+            self.num_positives[iou_type] += state['num_positives'][iou_type]
+        self.num_images += state['num_images']
+
+    def average_precisions(self, iou_type: str) -> np.ndarray:
+        """AP of each area range, IoU threshold and class
+
+        Returns:
+            ap (:obj:`ndarray[A, T, K]`): NaN for classes without ground truth
+        """
+        self.synchronize()
+        num_areas, num_thresholds = len(self.area_ranges), len(IOU_THRESHOLDS)
+        ap = np.full((num_areas, num_thresholds, self.num_classes), np.nan)
+        if self.num_images == 0:
+            return ap
+
+        scores = np.concatenate(self.scores)
+        labels = np.concatenate(self.labels)
+        matched = np.concatenate(self.matched[iou_type], axis=1)
+        ignored = np.concatenate(self.ignored[iou_type], axis=1)
+        num_positives = self.num_positives[iou_type]
+
+        def unpack(bits, indices):
+            bits = np.unpackbits(bits[:, indices], axis=0, count=num_areas * num_thresholds)
+            return bits.reshape(num_areas, num_thresholds, -1).astype(bool)
+
+        order = np.argsort(labels, kind='mergesort')
+        bounds = np.searchsorted(labels[order], np.arange(self.num_classes + 1))
+        for k in range(self.num_classes):
+            indices = order[bounds[k]:bounds[k + 1]]
+            ap[:, :, k] = average_precision(
+                scores[indices], unpack(matched, indices), unpack(ignored, indices),
+                num_positives[:, k, None])
+            # pycocotools leaves out classes without ground truth
+            ap[num_positives[:, k] == 0, :, k] = np.nan
+
+        return ap
+
+    def summarize(self, verbose: bool = True) -> Dict[str, float]:
+        """mAP over IoU 0.50:0.95, at 0.50 and 0.75, and per area range"""
+        names = list(AREA_RANGES)
+        stats = {}
+        for iou_type in self.iou_types:
+            ap = self.average_precisions(iou_type)
+            stats[f'{iou_type}/AP'] = _nanmean(ap[names.index('all')])
+            stats[f'{iou_type}/AP50'] = _nanmean(ap[names.index('all'), 0])
+            stats[f'{iou_type}/AP75'] = _nanmean(ap[names.index('all'), 5])
+            for name, suffix in (('small', 's'), ('medium', 'm'), ('large', 'l')):
+                stats[f'{iou_type}/AP{suffix}'] = _nanmean(ap[names.index(name)])
+
+        if verbose:
+            for key, value in stats.items():
+                print(f'{key:>10}: {value:.4f}')
+
+        return stats
+
+
+def _match_chunk(config: Dict, samples: List[Dict[str, np.ndarray]]) -> Dict:
+    """Worker task, accumulators of a chunk of compact images"""
+    evaluator = CocoEvaluator(**config)
+    for sample in samples:
+        evaluator.add_compact(sample)
+
+    return evaluator.state_dict()
+
+
+def _nanmean(values: np.ndarray) -> float:
+    """Mean of the values that are not NaN, -1 as pycocotools if there is none"""
+    values = values[~np.isnan(values)]
+    return float(values.mean()) if values.size > 0 else -1.0
@@ -0,0 +1,421 @@
+import os
+import time
+from typing import Tuple, List, Dict, Optional
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .dataset import CocoParser, CocoDataset
+
+
+SHARD_INDEX_NAME = 'index.npz'
+
+
+def _shard_name(shard: int) -> str:
+    return f'shard-{shard:05d}.bin'
+
+
+class ImageShardWriter:
+    """Packs encoded images into large shard files with an offset index
+
+    Images are appended to `shard-00000.bin`, `shard-00001.bin`, ... and a
+    new shard is started when the current one exceeds `shard_size`. Files are
+    copied byte for byte unless `max_size` is given, in which case images
+    larger than `max_size` are resized and encoded again. `close` writes
+    `index.npz` with the shard, offset, length and stored size of each image.
+
+    Args:
+        output_dir (:obj:`str`):
+        shard_size (:obj:`int`): bytes per shard
+        max_size (:obj:`Tuple[int, int]` or :obj:`int`): resize images to this
+            height and width, or the longer side to this size keeping the
+            aspect ratio if an :obj:`int` is given
+        extension (:obj:`str`): encoding of resized images
+        quality (:obj:`int`): JPEG quality of resized images
+
+    Examples::
+        >>> with ImageShardWriter('shards/train2017', max_size=550) as writer:
+        >>>     for image_id, path in images:
+        >>>         writer.add(image_id, path)
+    """
+    def __init__(
+        self,
+        output_dir: str,
+        shard_size: int = 1 << 30,
+        max_size=None,
+        extension: str = '.jpg',
+        quality: int = 95
+    ) -> None:
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.max_size = max_size
+        self.extension = extension
+        self.quality = quality
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.index: Dict[str, List[int]] = {
+            'image_ids': [], 'shards': [], 'offsets': [], 'lengths': [],
+            'heights': [], 'widths': []}
+        self.shard = -1
+        self.offset = 0
+        self.file = None
+
+    def __enter__(self) -> 'ImageShardWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _next_shard(self) -> None:
+        if self.file is not None:
+            self.file.close()
+        self.shard += 1
+        self.offset = 0
+        self.file = open(os.path.join(self.output_dir, _shard_name(self.shard)), 'wb')
+
+    def _resize(self, image: np.ndarray) -> np.ndarray:
+        h, w = image.shape[:2]
+        if isinstance(self.max_size, int):
+            scale = self.max_size / max(h, w)
+            if scale >= 1:
+                return image
+            size = (max(int(round(h * scale)), 1), max(int(round(w * scale)), 1))
+        else:
+            size = tuple(self.max_size)
+
+        return cv2.resize(image, size[::-1], interpolation=cv2.INTER_AREA)
+
+    def add(self, image_id: int, path: str) -> None:
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f'Could not decode {path}.')
+
+        if self.max_size is not None:
+            resized = self._resize(image)
+            if resized is not image:
+                image = resized
+                params = []
+                if self.extension == '.jpg':
+                    params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+                _, data = cv2.imencode(self.extension, image, params)
+                data = data.tobytes()
+
+        self.add_bytes(image_id, data, image.shape[0], image.shape[1])
+
+    def add_bytes(self, image_id: int, data: bytes, height: int, width: int) -> None:
+        """Append an encoded image"""
+        if self.file is None or (self.offset > 0 and self.offset + len(data) > self.shard_size):
+            self._next_shard()
+
+        self.file.write(data)
+        for key, value in zip(
+                self.index, (image_id, self.shard, self.offset, len(data), height, width)):
+            self.index[key].append(value)
+        self.offset += len(data)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        np.savez(
+            os.path.join(self.output_dir, SHARD_INDEX_NAME),
+            image_ids=np.asarray(self.index['image_ids'], dtype=np.int64),
+            shards=np.asarray(self.index['shards'], dtype=np.int32),
+            offsets=np.asarray(self.index['offsets'], dtype=np.int64),
+            lengths=np.asarray(self.index['lengths'], dtype=np.int64),
+            heights=np.asarray(self.index['heights'], dtype=np.int32),
+            widths=np.asarray(self.index['widths'], dtype=np.int32))
+
+
+def write_coco_shards(
+    image_dir: str,
+    info_file: str,
+    output_dir: str,
+    shard_size: int = 1 << 30,
+    max_size=None,
+    log_interval: int = 1000
+) -> None:
+    """Pack the images of a COCO annotation file into shards
+
+    Args:
+        image_dir (:obj:`str`):
+        info_file (:obj:`str`):
+        output_dir (:obj:`str`):
+        shard_size (:obj:`int`): bytes per shard
+        max_size (:obj:`Tuple[int, int]` or :obj:`int`): see :class:`ImageShardWriter`
+        log_interval (:obj:`int`): images between progress reports
+    """
+    coco = CocoParser(info_file)
+    start_time = time.time()
+    with ImageShardWriter(output_dir, shard_size, max_size) as writer:
+        for i, image_id in enumerate(coco.image_ids.tolist()):
+            file_name = coco.get_file_name(image_id).replace('\\', '/')
+            writer.add(image_id, os.path.join(image_dir, file_name))
+
+            if (i + 1) % log_interval == 0:
+                print(f'Packed {i + 1:,}/{len(coco.image_ids):,} images '
+                      f'into {writer.shard + 1} shards ({time.time() - start_time:.1f}s)')
+
+
+class ImageShardReader:
+    """Random access to images packed by :class:`ImageShardWriter`
+
+    Shards are memory-mapped on first access in each process, so the reader
+    can be created before DataLoader workers are forked. Images are decoded
+    by `cv2.imdecode` from a view of the mapping without copying the bytes.
+
+    Args:
+        shard_dir (:obj:`str`):
+    """
+    def __init__(self, shard_dir: str) -> None:
+        self.shard_dir = shard_dir
+        with np.load(os.path.join(shard_dir, SHARD_INDEX_NAME)) as index:
+            order = np.argsort(index['image_ids'], kind='stable')
+            self.image_ids = index['image_ids'][order]
+            self.shards = index['shards'][order]
+            self.offsets = index['offsets'][order]
+            self.lengths = index['lengths'][order]
+            self.heights = index['heights'][order]
+            self.widths = index['widths'][order]
+
+        self._maps: Dict[int, np.memmap] = {}
+
+    def __getstate__(self):
+        # Mappings are reopened in the process that unpickles the reader
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    def __contains__(self, image_id: int) -> bool:
+        return self._index(image_id) is not None
+
+    def _index(self, image_id: int) -> Optional[int]:
+        i = int(np.searchsorted(self.image_ids, image_id))
+        if i < len(self.image_ids) and self.image_ids[i] == image_id:
+            return i
+
+        return None
+
+    def _get_map(self, shard: int) -> np.memmap:
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(
+                os.path.join(self.shard_dir, _shard_name(shard)), dtype=np.uint8, mode='r')
+
+        return self._maps[shard]
+
+    def get_size(self, image_id: int) -> Tuple[int, int]:
+        """Height and width of the stored image"""
+        i = self._index(image_id)
+        return int(self.heights[i]), int(self.widths[i])
+
+    def get_bytes(self, image_id: int) -> np.ndarray:
+        """Encoded image as a view of the shard"""
+        i = self._index(image_id)
+        if i is None:
+            raise KeyError(f'Image id {image_id} is not in the shards.')
+
+        offset = int(self.offsets[i])
+        return self._get_map(int(self.shards[i]))[offset:offset + int(self.lengths[i])]
+
+    def read(self, image_id: int, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+        return cv2.imdecode(self.get_bytes(image_id), flags)
+
+
+class ShardCocoDataset(CocoDataset):
+    """:class:`CocoDataset` reading images from shards instead of files
+
+    If the shards hold resized images, boxes are scaled and masks are
+    rasterized at the stored resolution.
+
+    Args:
+        shard_dir (:obj:`str`): written by :func:`write_coco_shards`
+        info_file (:obj:`str`):
+        kwargs: arguments of :class:`CocoDataset`
+    """
+    def __init__(self, shard_dir, info_file, **kwargs):
+        super().__init__(shard_dir, info_file, **kwargs)
+        self.reader = ImageShardReader(shard_dir)
+
+    def load_image(self, image_id):
+        # Grayscale images are decoded to 3 channels
+        image = self.reader.read(image_id, cv2.IMREAD_COLOR)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class ShardIterableDataset(IterableDataset):
+    """Streams samples of :class:`ShardCocoDataset` shard by shard
+
+    Every epoch the shards are permuted with `seed + epoch`, the same way on
+    every rank, and split across all (rank, worker) pairs, so each process
+    only opens its own shards. If there are fewer shards than processes, the
+    images are split instead. Images of a shard are read in file order and
+    shuffled through a buffer of `buffer_size` samples.
+
+    The stream of image ids is fully determined by the seed, the epoch, the
+    rank and the worker, so `load_state_dict` resumes mid-epoch by skipping
+    the ids already consumed without decoding them. The skip assumes the
+    in-order round-robin of DataLoader workers and equal batch sizes.
+
+    Args:
+        shard_dir (:obj:`str`): written by :func:`write_coco_shards`
+        info_file (:obj:`str`):
+        shuffle (:obj:`bool`):
+        buffer_size (:obj:`int`): samples in the shuffle buffer
+        seed (:obj:`int`):
+        rank (:obj:`int`): rank of `torch.distributed` if `None`
+        world_size (:obj:`int`): world size of `torch.distributed` if `None`
+        kwargs: arguments of :class:`CocoDataset`
+
+    Examples::
+        >>> dataset = ShardIterableDataset('shards/train2017', 'instances_train2017.json')
+        >>> loader = DataLoader(dataset, batch_size=8, num_workers=4, collate_fn=DetectionCollate())
+        >>> for epoch in range(num_epochs):
+        >>>     dataset.set_epoch(epoch)
+        >>>     for i, (images, targets) in enumerate(loader):
+        >>>         ...
+        >>>         state = dataset.state_dict(i + 1, batch_size=8)
+    """
+    def __init__(
+        self,
+        shard_dir: str,
+        info_file: str,
+        shuffle: bool = True,
+        buffer_size: int = 1000,
+        seed: int = 0,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+        **kwargs
+    ) -> None:
+        self.dataset = ShardCocoDataset(shard_dir, info_file, **kwargs)
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if world_size is None:
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+
+        self.epoch = 0
+        # Batches already consumed in `epoch` by the loader of this rank
+        self.resume_batches = 0
+        self.resume_batch_size = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.resume_batches = 0
+        self.epoch = epoch
+
+    def state_dict(self, num_batches: int, batch_size: int) -> Dict[str, int]:
+        """Cursor after `num_batches` batches of the current epoch"""
+        return {
+            'epoch': self.epoch,
+            'num_batches': num_batches,
+            'batch_size': batch_size,
+            'seed': self.seed,
+            'world_size': self.world_size,
+        }
+
+    def load_state_dict(self, state: Dict[str, int]) -> None:
+        if state['seed'] != self.seed or state['world_size'] != self.world_size:
+            raise ValueError('The cursor was saved with another seed or world size.')
+
+        self.epoch = state['epoch']
+        self.resume_batches = state['num_batches']
+        self.resume_batch_size = state['batch_size']
+
+    def get_streams(self, num_workers: int = 1) -> List[np.ndarray]:
+        """Image ids read by every (rank, worker) pair in the current epoch,
+        before the shuffle buffer, unequal lengths"""
+        reader = self.dataset.reader
+        num_streams = self.world_size * num_workers
+
+        # Image ids of every shard in file order, images without annotations
+        # in the info file are skipped
+        order = np.lexsort((reader.offsets, reader.shards))
+        shards, starts = np.unique(reader.shards[order], return_index=True)
+        in_shards = np.split(reader.image_ids[order], starts[1:])
+        in_shards = [ids[np.isin(ids, self.dataset.image_ids)] for ids in in_shards]
+
+        indices = np.arange(len(shards))
+        if self.shuffle:
+            indices = np.random.default_rng([self.seed, self.epoch]).permutation(indices)
+
+        def read_order(selected):
+            """Image ids of the shards in `selected`, each in file order"""
+            image_ids = [in_shards[i] for i in selected]
+            return np.concatenate(image_ids) if image_ids else np.zeros(0, dtype=np.int64)
+
+        if len(shards) >= num_streams:
+            return [read_order(indices[stream::num_streams]) for stream in range(num_streams)]
+
+        image_ids = read_order(indices)
+        return [image_ids[stream::num_streams] for stream in range(num_streams)]
+
+    def get_stream(self, worker_id: int = 0, num_workers: int = 1) -> np.ndarray:
+        """Image ids read by one worker of this rank in the current epoch,
+        before the shuffle buffer
+
+        Whole shards differ in size, so every stream is padded to the longest
+        one by repeating its first images, as `DistributedSampler` does.
+        Every rank then runs the same number of batches, otherwise DDP ranks
+        that finish the epoch early leave the others waiting in the gradient
+        all-reduce.
+        """
+        streams = self.get_streams(num_workers)
+        stream = self.rank * num_workers + worker_id
+        image_ids = streams[stream]
+        length = max(len(ids) for ids in streams)
+        if len(image_ids) == 0:
+            # Fewer images than streams, the padding comes from the others
+            image_ids = np.roll(np.concatenate(streams), -stream)
+
+        return np.resize(image_ids, length)
+
+    def _shuffle(self, image_ids: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        """Order of a shuffle buffer over `image_ids`, ids only"""
+        if not self.shuffle or self.buffer_size <= 1:
+            return image_ids
+
+        output = np.empty_like(image_ids)
+        buffer = list(image_ids[:self.buffer_size])
+        n = 0
+        for image_id in image_ids[self.buffer_size:]:
+            i = rng.integers(len(buffer))
+            output[n] = buffer[i]
+            buffer[i] = image_id
+            n += 1
+        output[n:] = rng.permutation(np.asarray(buffer, dtype=image_ids.dtype))
+
+        return output
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        # DataLoader takes batches from the workers in turn starting at worker 0,
+        # so after a resume worker 0 continues the stream whose batch is next
+        worker_id = (worker_id + self.resume_batches) % num_workers
+
+        image_ids = self.get_stream(worker_id, num_workers)
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker_id])
+        image_ids = self._shuffle(image_ids, rng)
+
+        if self.resume_batches > 0:
+            num_batches = len(range(worker_id, self.resume_batches, num_workers))
+            image_ids = image_ids[num_batches * self.resume_batch_size:]
+
+        dataset_ids = self.dataset.image_ids
+        for image_id in image_ids.tolist():
+            yield self.dataset[int(np.searchsorted(dataset_ids, image_id))]
@@ -0,0 +1,52 @@
+"""Launch a training script on several processes and nodes
+
+    $ python -m boda.utils.launch --nproc-per-node 4 train.py --num-epochs 10
+    $ python -m boda.utils.launch --nnodes 2 --node-rank 0 --master-addr 10.0.0.1 \
+        --nproc-per-node 8 train.py
+
+Thin wrapper of `torch.distributed.run`. Without CUDA, each process gets an
+equal share of the cores in `OMP_NUM_THREADS` unless it is already set, so
+processes do not oversubscribe the CPU. The script calls
+:func:`boda.utils.distributed.init_distributed` and builds a `Trainer`.
+"""
+import os
+import argparse
+
+from torch.distributed import run
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Launch a training script on several processes and nodes')
+    parser.add_argument('--nproc-per-node', type=int, default=None,
+                        help='number of GPUs, or 1 process per 4 cores without CUDA')
+    parser.add_argument('--nnodes', type=int, default=1)
+    parser.add_argument('--node-rank', type=int, default=0)
+    parser.add_argument('--master-addr', default='127.0.0.1')
+    parser.add_argument('--master-port', type=int, default=29500)
+    parser.add_argument('script')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    import torch
+
+    num_cores = os.cpu_count() or 1
+    nproc_per_node = args.nproc_per_node
+    if nproc_per_node is None:
+        nproc_per_node = torch.cuda.device_count() or max(num_cores // 4, 1)
+    if not torch.cuda.is_available() and 'OMP_NUM_THREADS' not in os.environ:
+        os.environ['OMP_NUM_THREADS'] = str(max(num_cores // nproc_per_node, 1))
+
+    run.main([
+        f'--nproc-per-node={nproc_per_node}',
+        f'--nnodes={args.nnodes}',
+        f'--node-rank={args.node_rank}',
+        f'--master-addr={args.master_addr}',
+        f'--master-port={args.master_port}',
+        args.script,
+        *args.script_args,
+    ])
+
+
+if __name__ == '__main__':
+    main()
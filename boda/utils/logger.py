@@ -0,0 +1,166 @@
+import os
+import csv
+import sys
+import json
+import queue
+import threading
+from typing import Any, Dict, List, Optional
+
+
+class MetricSink:
+    """Destination of metric records, called from the logger thread only"""
+    def write(self, record: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class StdoutSink(MetricSink):
+    """Prints `key: value | ...` per record
+
+    Args:
+        keys (:obj:`List[str]`): keys to print in this order, all if `None`
+        precision (:obj:`int`): digits after the decimal point of floats
+        stream (:obj:`TextIO`): `sys.stdout` if `None`
+    """
+    def __init__(self, keys: Optional[List[str]] = None, precision: int = 4, stream=None) -> None:
+        self.keys = keys
+        self.precision = precision
+        self.stream = stream
+
+    def write(self, record):
+        stream = self.stream or sys.stdout
+        keys = record.keys() if self.keys is None else [k for k in self.keys if k in record]
+        fields = []
+        for key in keys:
+            value = record[key]
+            if isinstance(value, float):
+                value = f'{value:>{self.precision + 4}.{self.precision}f}'
+            fields.append(f'{key}: {value}')
+        print(' | '.join(fields), file=stream)
+
+    def flush(self):
+        (self.stream or sys.stdout).flush()
+
+
+class CsvSink(MetricSink):
+    """Appends records to a CSV file
+
+    The header is taken from the existing file or the first record, keys
+    that are not in it are dropped.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = None
+        self.writer = None
+
+    def write(self, record):
+        if self.writer is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            fieldnames = None
+            if os.path.isfile(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, 'r', newline='', encoding='utf-8') as f:
+                    fieldnames = next(csv.reader(f), None)
+            self.file = open(self.path, 'a', newline='', encoding='utf-8')
+            self.writer = csv.DictWriter(
+                self.file, fieldnames=fieldnames or list(record), extrasaction='ignore')
+            if fieldnames is None:
+                self.writer.writeheader()
+        self.writer.writerow(record)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.writer = None
+
+
+class JsonlSink(MetricSink):
+    """Appends one JSON object per record"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = None
+
+    def write(self, record):
+        if self.file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(record) + '\n')
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class MetricLogger:
+    """Hands metric records to sinks on a background thread
+
+    `log` only puts the record in a queue, so formatting and file writes
+    never block the training loop. Sinks are flushed when the queue runs
+    empty and on `close`.
+
+    Args:
+        sinks (:obj:`List[MetricSink]`): :class:`StdoutSink` if `None`
+
+    Examples::
+        >>> logger = MetricLogger([StdoutSink(), JsonlSink('logs/train.jsonl')])
+        >>> logger.log({'epoch': 0, 'step': 100, 'loss': 3.21})
+        >>> logger.close()
+    """
+    def __init__(self, sinks: Optional[List[MetricSink]] = None) -> None:
+        self.sinks = [StdoutSink()] if sinks is None else list(sinks)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> 'MetricLogger':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _run(self) -> None:
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    for sink in self.sinks:
+                        sink.close()
+                    return
+
+                for sink in self.sinks:
+                    sink.write(record)
+                if self.queue.empty():
+                    for sink in self.sinks:
+                        sink.flush()
+            except Exception as e:
+                print(f'MetricLogger: {type(e).__name__}: {e}', file=sys.stderr)
+            finally:
+                self.queue.task_done()
+
+    def log(self, record: Dict[str, Any]) -> None:
+        if not self.thread.is_alive():
+            raise RuntimeError('MetricLogger is closed.')
+        self.queue.put(dict(record))
+
+    def flush(self) -> None:
+        """Wait until every logged record is written"""
+        self.queue.join()
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
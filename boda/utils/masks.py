@@ -0,0 +1,160 @@
+from typing import Tuple, List, Dict, Union
+
+import cv2
+import numpy as np
+from pycocotools import mask
+
+
+def rle_string_to_counts(counts: Union[str, bytes]) -> np.ndarray:
+    """Decode the compressed counts string of COCO RLE
+
+    Same as `rleFrString` of the COCO API.
+    """
+    if isinstance(counts, str):
+        counts = counts.encode('ascii')
+
+    values = []
+    p = 0
+    while p < len(counts):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = counts[p] - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+
+        if len(values) > 2:
+            x += values[-2]
+        values.append(x)
+
+    return np.asarray(values, dtype=np.int64)
+
+
+def resize_rle(
+    counts: np.ndarray,
+    height: int,
+    width: int,
+    size: Tuple[int, int]
+) -> np.ndarray:
+    """Resize a binary mask given by its run lengths
+
+    The runs are expanded into one column-major buffer, resized with area
+    interpolation and thresholded at 0.5. Only one mask of the original
+    resolution exists at a time, they are never stacked.
+
+    Args:
+        counts (:obj:`ndarray[R]`): uncompressed run lengths, starting with zeros
+        height (:obj:`int`): height of the original mask
+        width (:obj:`int`): width of the original mask
+        size (:obj:`Tuple[int, int]`): output height and width
+
+    Returns:
+        mask (:obj:`ndarray[H, W]`): uint8
+    """
+    h, w = size
+    # Odd runs are foreground
+    values = (np.arange(len(counts)) % 2 * 255).astype(np.uint8)
+    full_mask = np.repeat(values, counts).reshape(width, height).T
+
+    if h * w < height * width:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_LINEAR
+    resized = cv2.resize(full_mask, (w, h), interpolation=interpolation)
+
+    return (resized >= 128).astype(np.uint8)
+
+
+def rasterize_polygons(
+    polygons: List[List[float]],
+    height: int,
+    width: int,
+    size: Tuple[int, int]
+) -> np.ndarray:
+    """Rasterize polygons at the output resolution instead of the image
+    resolution
+
+    Args:
+        polygons (:obj:`List[List[float]]`): COCO polygons in image pixels
+        height (:obj:`int`): height of the image
+        width (:obj:`int`): width of the image
+        size (:obj:`Tuple[int, int]`): output height and width
+
+    Returns:
+        mask (:obj:`ndarray[H, W]`): uint8
+    """
+    h, w = size
+    scale = np.asarray([w / width, h / height], dtype=np.float64)
+    polygons = [
+        (np.asarray(polygon, dtype=np.float64).reshape(-1, 2) * scale).reshape(-1).tolist()
+        for polygon in polygons if len(polygon) >= 6]
+    if len(polygons) == 0:
+        return np.zeros((h, w), dtype=np.uint8)
+
+    rle = mask.merge(mask.frPyObjects(polygons, h, w))
+
+    return mask.decode(rle)
+
+
+def encode_masks(masks) -> List[Dict]:
+    """Compressed RLE of binary masks
+
+    Args:
+        masks (:obj:`ndarray[N, H, W]` or :obj:`Tensor[N, H, W]`):
+
+    Returns:
+        rles (:obj:`List[Dict]`): `size` and `counts` of each mask
+    """
+    if hasattr(masks, 'detach'):
+        masks = masks.detach().cpu().numpy()
+    masks = np.asarray(masks)
+    if len(masks) == 0:
+        return []
+
+    return mask.encode(np.asfortranarray(masks.transpose(1, 2, 0), dtype=np.uint8))
+
+
+def decode_segmentation_mask(
+    segmentation: Union[List, Dict],
+    height: int,
+    width: int,
+    size: Tuple[int, int] = None
+) -> np.ndarray:
+    """Binary mask of a COCO segmentation
+
+    Args:
+        segmentation: polygons, compressed RLE or uncompressed RLE
+        height (:obj:`int`): height of the image
+        width (:obj:`int`): width of the image
+        size (:obj:`Tuple[int, int]`): output resolution, the image
+            resolution if `None`
+
+    Returns:
+        mask (:obj:`ndarray[H, W]`): uint8
+    """
+    if size is None or tuple(size) == (height, width):
+        if isinstance(segmentation, list):
+            rle = mask.merge(mask.frPyObjects(segmentation, height, width))
+        elif isinstance(segmentation['counts'], list):
+            rle = mask.frPyObjects(segmentation, height, width)
+        else:
+            rle = segmentation
+
+        return mask.decode(rle)
+
+    if isinstance(segmentation, list):
+        return rasterize_polygons(segmentation, height, width, size)
+
+    counts = segmentation['counts']
+    if isinstance(counts, (str, bytes)):
+        counts = rle_string_to_counts(counts)
+    else:
+        counts = np.asarray(counts, dtype=np.int64)
+    rle_height, rle_width = segmentation['size']
+
+    return resize_rle(counts, rle_height, rle_width, size)
@@ -1,169 +1,210 @@
+import copy
+import time
+import contextlib
 import functools
-# from inspect import getfullargspec
-
-import torch
+from inspect import getfullargspec
 from collections import abc
+from typing import Optional, Callable, List
 
 import numpy as np
 import torch
+from torch import nn, Tensor
+
+
+PRECISION_DTYPES = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def get_autocast_dtype(precision: str) -> Optional[torch.dtype]:
+    """Returns the autocast dtype of a precision policy, `None` for fp32"""
+    if precision not in PRECISION_DTYPES:
+        raise ValueError(
+            f'precision must be one of {list(PRECISION_DTYPES)}, got {precision}.')
+
+    return PRECISION_DTYPES[precision]
+
 
-
-
-
-# def cast_tensor_type(inputs, src_type, dst_type):
-#     if isinstance(inputs, torch.Tensor):
-#         return inputs.to(dst_type)
-#     elif isinstance(inputs, str):
-#         return inputs
-#     elif isinstance(inputs, np.ndarray):
-#         return inputs
-#     elif isinstance(inputs, abc.Mapping):
-#         return type(inputs)({
-#             k: cast_tensor_type(v, src_type, dst_type)
-#             for k, v in inputs.items()
-#         })
-#     elif isinstance(inputs, abc.Iterable):
-#         return type(inputs)(
-#             cast_tensor_type(item, src_type, dst_type) for item in inputs)
-#     else:
-#         return inputs
-
-
-# def auto_fp16(apply_to=None, out_fp32=False):
-#     """Decorator to enable fp16 training automatically.
-#     This decorator is useful when you write custom modules and want to support
-#     mixed precision training. If inputs arguments are fp32 tensors, they will
-#     be converted to fp16 automatically. Arguments other than fp32 tensors are
-#     ignored.
-#     Args:
-#         apply_to (Iterable, optional): The argument names to be converted.
-#             `None` indicates all arguments.
-#         out_fp32 (bool): Whether to convert the output back to fp32.
-#     :Example:
-#         class MyModule1(nn.Module)
-#             # Convert x and y to fp16
-#             @auto_fp16()
-#             def forward(self, x, y):
-#                 pass
-#         class MyModule2(nn.Module):
-#             # convert pred to fp16
-#             @auto_fp16(apply_to=('pred', ))
-#             def do_something(self, pred, others):
-#                 pass
-#     """
-
-#     def auto_fp16_wrapper(old_func):
-
-#         @functools.wraps(old_func)
-#         def new_func(*args, **kwargs):
-#             # check if the module has set the attribute `fp16_enabled`, if not,
-#             # just fallback to the original method.
-#             if not isinstance(args[0], torch.nn.Module):
-#                 raise TypeError('@auto_fp16 can only be used to decorate the '
-#                                 'method of nn.Module')
-#             if not (hasattr(args[0], 'fp16_enabled') and args[0].fp16_enabled):
-#                 return old_func(*args, **kwargs)
-#             # get the arg spec of the decorated method
-#             args_info = getfullargspec(old_func)
-#             # get the argument names to be casted
-#             args_to_cast = args_info.args if apply_to is None else apply_to
-#             # convert the args that need to be processed
-#             new_args = []
-#             # NOTE: default args are not taken into consideration
-#             if args:
-#                 arg_names = args_info.args[:len(args)]
-#                 for i, arg_name in enumerate(arg_names):
-#                     if arg_name in args_to_cast:
-#                         new_args.append(
-#                             cast_tensor_type(args[i], torch.float, torch.half))
-#                     else:
-#                         new_args.append(args[i])
-#             # convert the kwargs that need to be processed
-#             new_kwargs = {}
-#             if kwargs:
-#                 for arg_name, arg_value in kwargs.items():
-#                     if arg_name in args_to_cast:
-#                         new_kwargs[arg_name] = cast_tensor_type(
-#                             arg_value, torch.float, torch.half)
-#                     else:
-#                         new_kwargs[arg_name] = arg_value
-#             # apply converted arguments to the decorated method
-#             output = old_func(*new_args, **new_kwargs)
-#             # cast the results back to fp32 if necessary
-#             if out_fp32:
-#                 output = cast_tensor_type(output, torch.half, torch.float)
-#             return output
-
-#         return new_func
-
-#     return auto_fp16_wrapper
-
-
-# def force_fp32(apply_to=None, out_fp16=False):
-#     """Decorator to convert input arguments to fp32 in force.
-#     This decorator is useful when you write custom modules and want to support
-#     mixed precision training. If there are some inputs that must be processed
-#     in fp32 mode, then this decorator can handle it. If inputs arguments are
-#     fp16 tensors, they will be converted to fp32 automatically. Arguments other
-#     than fp16 tensors are ignored.
-#     Args:
-#         apply_to (Iterable, optional): The argument names to be converted.
-#             `None` indicates all arguments.
-#         out_fp16 (bool): Whether to convert the output back to fp16.
-#     :Example:
-#         class MyModule1(nn.Module)
-#             # Convert x and y to fp32
-#             @force_fp32()
-#             def loss(self, x, y):
-#                 pass
-#         class MyModule2(nn.Module):
-#             # convert pred to fp32
-#             @force_fp32(apply_to=('pred', ))
-#             def post_process(self, pred, others):
-#                 pass
-#     """
-
-#     def force_fp32_wrapper(old_func):
-
-#         @functools.wraps(old_func)
-#         def new_func(*args, **kwargs):
-#             # check if the module has set the attribute `fp16_enabled`, if not,
-#             # just fallback to the original method.
-#             if not isinstance(args[0], torch.nn.Module):
-#                 raise TypeError('@force_fp32 can only be used to decorate the '
-#                                 'method of nn.Module')
-#             if not (hasattr(args[0], 'fp16_enabled') and args[0].fp16_enabled):
-#                 return old_func(*args, **kwargs)
-#             # get the arg spec of the decorated method
-#             args_info = getfullargspec(old_func)
-#             # get the argument names to be casted
-#             args_to_cast = args_info.args if apply_to is None else apply_to
-#             # convert the args that need to be processed
-#             new_args = []
-#             if args:
-#                 arg_names = args_info.args[:len(args)]
-#                 for i, arg_name in enumerate(arg_names):
-#                     if arg_name in args_to_cast:
-#                         new_args.append(
-#                             cast_tensor_type(args[i], torch.half, torch.float))
-#                     else:
-#                         new_args.append(args[i])
-#             # convert the kwargs that need to be processed
-#             new_kwargs = dict()
-#             if kwargs:
-#                 for arg_name, arg_value in kwargs.items():
-#                     if arg_name in args_to_cast:
-#                         new_kwargs[arg_name] = cast_tensor_type(
-#                             arg_value, torch.half, torch.float)
-#                     else:
-#                         new_kwargs[arg_name] = arg_value
-#             # apply converted arguments to the decorated method
-#             output = old_func(*new_args, **new_kwargs)
-#             # cast the results back to fp32 if necessary
-#             if out_fp16:
-#                 output = cast_tensor_type(output, torch.float, torch.half)
-#             return output
-
-#         return new_func
-
-#     return force_fp32_wrapper
\ No newline at end of file
+def autocast(precision: str = 'fp32', device_type: str = 'cuda'):
+    """Context manager running the enclosed ops under a precision policy
+
+    `fp32` is a no-op. `bf16` and `fp16` use `torch.autocast`, which casts
+    convolutions and matrix multiplications to the lower precision and
+    leaves the other ops in the dtype of their inputs.
+
+    Args:
+        precision (:obj:`str`): `fp32`, `bf16` or `fp16`
+        device_type (:obj:`str`): `cuda` or `cpu`
+    """
+    dtype = get_autocast_dtype(precision)
+    if dtype is None:
+        return contextlib.nullcontext()
+
+    return torch.autocast(device_type, dtype=dtype)
+
+
+def get_precision(module: torch.nn.Module) -> str:
+    """Returns `config.precision` of a module, fp32 if it is not set"""
+    config = getattr(module, 'config', None)
+    return getattr(config, 'precision', getattr(module, 'precision', 'fp32'))
+
+
+def cast_tensor_type(inputs, src_type: Optional[torch.dtype], dst_type: torch.dtype):
+    """Cast floating point tensors in nested inputs
+
+    Args:
+        inputs: a tensor, or a mapping or an iterable of tensors
+        src_type (:obj:`torch.dtype`): only tensors of this dtype are cast,
+            `None` casts every floating point tensor
+        dst_type (:obj:`torch.dtype`):
+    """
+    if isinstance(inputs, torch.Tensor):
+        if not inputs.is_floating_point():
+            return inputs
+        if src_type is not None and inputs.dtype != src_type:
+            return inputs
+        return inputs.to(dst_type)
+    elif isinstance(inputs, (str, np.ndarray)):
+        return inputs
+    elif isinstance(inputs, abc.MutableMapping):
+        # Shallow copy keeps the type, e.g. defaultdict returned by models
+        outputs = copy.copy(inputs)
+        for k, v in inputs.items():
+            outputs[k] = cast_tensor_type(v, src_type, dst_type)
+        return outputs
+    elif isinstance(inputs, abc.Mapping):
+        return {k: cast_tensor_type(v, src_type, dst_type) for k, v in inputs.items()}
+    elif isinstance(inputs, (list, tuple)):
+        return type(inputs)(cast_tensor_type(item, src_type, dst_type) for item in inputs)
+    else:
+        return inputs
+
+
+def auto_fp16(out_fp32: bool = True) -> Callable:
+    """Decorator running a method of nn.Module under the precision policy of
+    its config
+
+    The policy is read from `config.precision` of the module at every call,
+    so it can be changed after the model is built. With `fp32` the method is
+    called as is.
+
+    Args:
+        out_fp32 (:obj:`bool`): cast floating point outputs back to fp32
+
+    Examples::
+        >>> class MyModel(Model):
+        >>>     @auto_fp16()
+        >>>     def forward(self, images):
+        >>>         pass
+    """
+    def auto_fp16_wrapper(old_func):
+        @functools.wraps(old_func)
+        def new_func(*args, **kwargs):
+            if not isinstance(args[0], torch.nn.Module):
+                raise TypeError('@auto_fp16 can only be used to decorate the method of nn.Module')
+
+            precision = get_precision(args[0])
+            if get_autocast_dtype(precision) is None:
+                return old_func(*args, **kwargs)
+
+            parameter = next(args[0].parameters(), None)
+            device_type = 'cpu' if parameter is None else parameter.device.type
+            with autocast(precision, device_type):
+                outputs = old_func(*args, **kwargs)
+
+            if out_fp32:
+                outputs = cast_tensor_type(outputs, None, torch.float32)
+
+            return outputs
+
+        return new_func
+
+    return auto_fp16_wrapper
+
+
+def force_fp32(apply_to=None, out_fp16: bool = False) -> Callable:
+    """Decorator keeping a function in fp32 regardless of the precision policy
+
+    Autocast is disabled inside the function and floating point arguments in
+    `apply_to` are cast to fp32. Use it for numerically sensitive steps such
+    as losses and NMS. Functions compiled by `torch.jit.script` cannot be
+    decorated, cast the inputs with `.float()` in them instead.
+
+    Args:
+        apply_to (:obj:`Iterable`): argument names to cast, `None` casts all
+        out_fp16 (:obj:`bool`): cast floating point outputs to fp16
+
+    Examples::
+        >>> @force_fp32(apply_to=('boxes', 'scores'))
+        >>> def fast_nms(boxes, scores, masks=None):
+        >>>     pass
+    """
+    def force_fp32_wrapper(old_func):
+        args_info = getfullargspec(old_func)
+        args_to_cast = args_info.args if apply_to is None else apply_to
+
+        @functools.wraps(old_func)
+        def new_func(*args, **kwargs):
+            arg_names = args_info.args[:len(args)]
+            new_args = [
+                cast_tensor_type(arg, None, torch.float32) if name in args_to_cast else arg
+                for name, arg in zip(arg_names, args)
+            ]
+            # Variable positional arguments are passed through
+            new_args.extend(args[len(arg_names):])
+
+            new_kwargs = {
+                k: cast_tensor_type(v, None, torch.float32) if k in args_to_cast else v
+                for k, v in kwargs.items()
+            }
+
+            with contextlib.ExitStack() as stack:
+                if torch.is_autocast_enabled():
+                    stack.enter_context(torch.autocast('cuda', enabled=False))
+                if _is_autocast_cpu_enabled():
+                    stack.enter_context(torch.autocast('cpu', enabled=False))
+                outputs = old_func(*new_args, **new_kwargs)
+
+            if out_fp16:
+                outputs = cast_tensor_type(outputs, torch.float32, torch.float16)
+
+            return outputs
+
+        return new_func
+
+    return force_fp32_wrapper
+
+
+def _is_autocast_cpu_enabled() -> bool:
+    try:
+        return torch.is_autocast_enabled('cpu')
+    except TypeError:
+        # Before PyTorch 2.4 the device type is not an argument
+        return torch.is_autocast_cpu_enabled()
+
+
+@torch.no_grad()
+def measure_latency(
+    model: nn.Module,
+    images: List[Tensor],
+    num_warmup: int = 3,
+    num_runs: int = 20
+) -> float:
+    """Returns the mean latency of a forward pass in milliseconds"""
+    training = model.training
+    model.eval()
+    for _ in range(num_warmup):
+        model(images)
+
+    if images[0].is_cuda:
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(num_runs):
+        model(images)
+    if images[0].is_cuda:
+        torch.cuda.synchronize()
+    model.train(training)
+
+    return (time.perf_counter() - start_time) / num_runs * 1000
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from typing import Tuple, Dict, Iterator, Optional, Union
+
+from torch import nn
+
+
+class ModelBook:
+    """Maintains the module lookup of a model
+
+    Paths are tuples of attribute names, e.g. `('neck', 'lateral_layers', '0')`.
+    Shared modules are recorded once under the first path found by
+    `named_modules`, so weights shared across branches are not visited twice.
+
+    Adapted from:
+        https://github.com/qfgaohao/pytorch-ssd/blob/master/vision/utils/model_book.py
+    """
+    def __init__(self, model: nn.Module) -> None:
+        self.model = model
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        self._modules: Dict[Tuple[str, ...], nn.Module] = OrderedDict()
+        self._paths: Dict[int, Tuple[str, ...]] = {}
+        for name, module in self.model.named_modules():
+            path = tuple(name.split('.')) if name else ()
+            self._modules[path] = module
+            self._paths[id(module)] = path
+
+    def get_module(self, path: Tuple[str, ...]) -> nn.Module:
+        module = self._modules.get(tuple(path))
+        if module is None:
+            raise KeyError(f'{".".join(path)} is not a module of the model.')
+
+        return module
+
+    def get_path(self, module: nn.Module) -> Optional[Tuple[str, ...]]:
+        return self._paths.get(id(module))
+
+    def modules(
+        self,
+        module_type: Union[type, Tuple[type, ...]] = nn.Module
+    ) -> Iterator[Tuple[Tuple[str, ...], nn.Module]]:
+        for path, module in self._modules.items():
+            if isinstance(module, module_type):
+                yield path, module
+
+    def conv2d_modules(self) -> Iterator[Tuple[Tuple[str, ...], nn.Module]]:
+        return self.modules(module_type=nn.Conv2d)
+
+    def linear_modules(self) -> Iterator[Tuple[Tuple[str, ...], nn.Module]]:
+        return self.modules(module_type=nn.Linear)
+
+    def update(self, path: Tuple[str, ...], module: nn.Module) -> None:
+        """Replace the module at path in the model and in the book"""
+        path = tuple(path)
+        parent = self.get_module(path[:-1])
+        old_module = parent._modules[path[-1]]
+        parent._modules[path[-1]] = module
+
+        self._paths.pop(id(old_module), None)
+        self._modules[path] = module
+        self._paths[id(module)] = path
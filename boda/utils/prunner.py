@@ -1,14 +1,23 @@
-import torch
-import torch.nn as nn
+import copy
 import logging
 from heapq import nsmallest
+from typing import Tuple, List, Dict, Callable, Optional, Sequence
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from .model_book import ModelBook
+from .misc import measure_latency
 
-from ..utils.model_book import ModelBook
+
+Path = Tuple[str, ...]
 
 
 class ModelPrunner:
     def __init__(self, model, train_fun, ignored_paths=[]):
-        """ Implement the pruning algorithm described in the paper https://arxiv.org/pdf/1611.06440.pdf .
+        """ Implement the pruning algorithm described in the paper
+        https://arxiv.org/pdf/1611.06440.pdf .
         The prunning criteria is dC/dh * h, while C is the cost, h is the activation.
 
         https://github.com/qfgaohao/pytorch-ssd/blob/master/vision/prunning/prunner.py
@@ -31,25 +40,15 @@ class ModelPrunner:
             raise TypeError(f"The module is not Conv2d, but {type(conv)}.")
 
         if channel_type == "out":
-            new_conv = nn.Conv2d(conv.in_channels, conv.out_channels - 1, conv.kernel_size, conv.stride,
-                                 conv.padding, conv.dilation, conv.groups, conv.bias is not None)
-            mask = torch.ones(conv.out_channels, dtype=torch.uint8)
-            mask[filter_index] = 0
-            new_conv.weight.data = conv.weight.data[mask, :, :, :]
-            if conv.bias is not None:
-                new_conv.bias.data = conv.bias.data[mask]
-
+            mask = torch.ones(conv.out_channels, dtype=torch.bool)
+            mask[filter_index] = False
+            return prune_conv(conv, mask.nonzero().view(-1), channel_type='out')
         elif channel_type == 'in':
-            new_conv = nn.Conv2d(conv.in_channels - 1, conv.out_channels, conv.kernel_size, conv.stride,
-                                 conv.padding, conv.dilation, conv.groups, conv.bias is not None)
-            mask = torch.ones(conv.in_channels, dtype=torch.uint8)
-            mask[filter_index] = 0
-            new_conv.weight.data = conv.weight.data[:, mask, :, :]
-            if conv.bias is not None:
-                new_conv.bias.data = conv.bias.data
+            mask = torch.ones(conv.in_channels, dtype=torch.bool)
+            mask[filter_index] = False
+            return prune_conv(conv, mask.nonzero().view(-1), channel_type='in')
         else:
             raise ValueError(f"{channel_type} should be either 'in' or 'out'.")
-        return new_conv
 
     def remove_conv_filter(self, path, filter_index):
         conv = self.book.get_module(path)
@@ -67,7 +66,9 @@ class ModelPrunner:
         batch_norm_path = self.decendent_batch_norms.get(path)
         if batch_norm_path:
             batch_norm = self.book.get_module(batch_norm_path)
-            new_batch_norm = nn.BatchNorm2d(batch_norm.num_features - 1)
+            mask = torch.ones(batch_norm.num_features, dtype=torch.bool)
+            mask[filter_index] = False
+            new_batch_norm = prune_batch_norm(batch_norm, mask.nonzero().view(-1))
             self._update_model(batch_norm_path, new_batch_norm)
 
         # reduce the in channels of linear layer
@@ -82,8 +83,8 @@ class ModelPrunner:
         if channel_type == "out":
             new_linear = nn.Linear(linear.in_features, linear.out_features - 1,
                                    bias=linear.bias is not None)
-            mask = torch.ones(linear.out_features, dtype=torch.uint8)
-            mask[feature_index] = 0
+            mask = torch.ones(linear.out_features, dtype=torch.bool)
+            mask[feature_index] = False
             new_linear.weight.data = linear.weight.data[mask, :]
             if linear.bias is not None:
                 new_linear.bias.data = linear.bias.data[mask]
@@ -96,8 +97,8 @@ class ModelPrunner:
                                    bias=linear.bias is not None)
             start_index = feature_index * block
             end_index = (feature_index + 1) * block
-            mask = torch.ones(linear.in_features, dtype=torch.uint8)
-            mask[start_index: end_index] = 0
+            mask = torch.ones(linear.in_features, dtype=torch.bool)
+            mask[start_index: end_index] = False
             new_linear.weight.data = linear.weight.data[:, mask]
             if linear.bias is not None:
                 new_linear.bias.data = linear.bias.data
@@ -121,7 +122,8 @@ class ModelPrunner:
             for i, e in enumerate(v):
                 ranks.append((path, i, e))
         to_prune = nsmallest(num, ranks, key=lambda t: t[2])
-        to_prune = sorted(to_prune, key=lambda t: (t[0], -t[1]))  # prune the filters with bigger indexes first to avoid rearrangement.
+        # prune the filters with bigger indexes first to avoid rearrangement.
+        to_prune = sorted(to_prune, key=lambda t: (t[0], -t[1]))
         for path, filter_index, value in to_prune:
             self.remove_conv_filter(path, filter_index)
         self.deregister_hooks()
@@ -161,7 +163,7 @@ class ModelPrunner:
         for path, m in self.book.modules(module_type=(nn.Conv2d, nn.BatchNorm2d, nn.Linear)):
             h = m.register_forward_hook(forward_hook)
             self.handles.append(h)
-            h = m.register_backward_hook(backward_hook)
+            h = m.register_full_backward_hook(backward_hook)
             self.handles.append(h)
 
     def deregister_hooks(self):
@@ -212,7 +214,7 @@ class ModelPrunner:
         for _, m in self.book.linear_modules():
             h = m.register_forward_hook(forward_hook)
             self.handles.append(h)
-            h = m.register_backward_hook(backward_hook)
+            h = m.register_full_backward_hook(backward_hook)
             self.handles.append(h)
 
     def remove_linear_feature(self, path, feature_index):
@@ -229,10 +231,504 @@ class ModelPrunner:
             self._update_model(next_linear_path, new_next_linear)
 
     def _update_model(self, path, module):
-        parent = self.book.get_module(path[:-1])
-        parent._modules[path[-1]] = module
         self.book.update(path, module)
 
 
+def prune_conv(conv: nn.Conv2d, keep: Tensor, channel_type: str = 'out') -> nn.Conv2d:
+    """Returns a smaller copy of conv with only the kept channels
+
+    Args:
+        conv (:obj:`nn.Conv2d`):
+        keep (:obj:`LongTensor[K]`): indexes of channels to keep
+        channel_type (:obj:`str`): `out`, `in` or `depthwise`
+    """
+    keep = keep.to(conv.weight.device)
+    if channel_type == 'out':
+        in_channels, out_channels, groups = conv.in_channels, len(keep), conv.groups
+        weight = conv.weight.data[keep]
+        bias = conv.bias.data[keep] if conv.bias is not None else None
+    elif channel_type == 'in':
+        if conv.groups != 1:
+            raise ValueError('Only dense convolutions can drop input channels.')
+        in_channels, out_channels, groups = len(keep), conv.out_channels, 1
+        weight = conv.weight.data[:, keep]
+        bias = conv.bias.data if conv.bias is not None else None
+    elif channel_type == 'depthwise':
+        in_channels = out_channels = groups = len(keep)
+        weight = conv.weight.data[keep]
+        bias = conv.bias.data[keep] if conv.bias is not None else None
+    else:
+        raise ValueError(f"{channel_type} should be either 'in', 'out' or 'depthwise'.")
+
+    new_conv = nn.Conv2d(
+        in_channels, out_channels, conv.kernel_size, conv.stride,
+        conv.padding, conv.dilation, groups, conv.bias is not None, conv.padding_mode
+    ).to(conv.weight.device)
+    new_conv.weight.data = weight.clone()
+    if bias is not None:
+        new_conv.bias.data = bias.clone()
+
+    return new_conv
+
+
+def prune_batch_norm(batch_norm: nn.BatchNorm2d, keep: Tensor) -> nn.BatchNorm2d:
+    """Returns a smaller copy of batch_norm keeping its statistics"""
+    new_batch_norm = nn.BatchNorm2d(
+        len(keep), batch_norm.eps, batch_norm.momentum,
+        batch_norm.affine, batch_norm.track_running_stats
+    ).to(keep.device)
+    device = batch_norm.weight.device if batch_norm.affine else batch_norm.running_mean.device
+    keep = keep.to(device)
+    if batch_norm.affine:
+        new_batch_norm.weight.data = batch_norm.weight.data[keep].clone()
+        new_batch_norm.bias.data = batch_norm.bias.data[keep].clone()
+        new_batch_norm.weight.requires_grad = batch_norm.weight.requires_grad
+        new_batch_norm.bias.requires_grad = batch_norm.bias.requires_grad
+    if batch_norm.track_running_stats:
+        new_batch_norm.running_mean.data = batch_norm.running_mean.data[keep].clone()
+        new_batch_norm.running_var.data = batch_norm.running_var.data[keep].clone()
+        new_batch_norm.num_batches_tracked.data = batch_norm.num_batches_tracked.data.clone()
+
+    return new_batch_norm.to(batch_norm.running_mean.device)
+
+
+class ChannelGroup:
+    """Channels that have to be removed together
+
+    Pruning a channel of a group removes the output filter of every producer,
+    the input channel of every consumer and the feature of every batch norm.
+    Depthwise convolutions lose the channel on both sides.
+
+    Args:
+        name (:obj:`str`):
+        producers (:obj:`List[Path]`): convolutions that write the channels
+        consumers (:obj:`List[Path]`): convolutions that read the channels
+        norms (:obj:`List[Path]`): batch norms over the channels
+        depthwise (:obj:`List[Path]`): depthwise convolutions over the channels
+        min_channels (:obj:`int`): the group is never pruned below this
+    """
+    def __init__(
+        self,
+        name: str,
+        producers: Sequence[Path],
+        consumers: Sequence[Path] = (),
+        norms: Sequence[Path] = (),
+        depthwise: Sequence[Path] = (),
+        min_channels: int = 8
+    ) -> None:
+        self.name = name
+        self.producers = [tuple(p) for p in producers]
+        self.consumers = [tuple(p) for p in consumers]
+        self.norms = [tuple(p) for p in norms]
+        self.depthwise = [tuple(p) for p in depthwise]
+        self.min_channels = min_channels
+
+    def num_channels(self, book: ModelBook) -> int:
+        return book.get_module(self.producers[0]).out_channels
+
+    def prune(self, book: ModelBook, keep: Tensor) -> None:
+        for path in self.producers:
+            book.update(path, prune_conv(book.get_module(path), keep, 'out'))
+        for path in self.consumers:
+            book.update(path, prune_conv(book.get_module(path), keep, 'in'))
+        for path in self.depthwise:
+            book.update(path, prune_conv(book.get_module(path), keep, 'depthwise'))
+        for path in self.norms:
+            book.update(path, prune_batch_norm(book.get_module(path), keep))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name})'
+
+
+def _conv_chain_groups(
+    prefix: Path,
+    layers: nn.Sequential,
+    min_channels: int
+) -> List[ChannelGroup]:
+    """Groups between consecutive convolutions of a plain conv/activation stack"""
+    convs = [
+        prefix + (name,) for name, module in layers.named_children()
+        if isinstance(module, nn.Conv2d)]
+
+    return [
+        ChannelGroup('.'.join(producer), [producer], [consumer], min_channels=min_channels)
+        for producer, consumer in zip(convs[:-1], convs[1:])]
+
+
+def count_flops(model: nn.Module, inputs: List[Tensor]) -> int:
+    """Counts multiply-accumulates of convolutions and linear layers
+
+    Modules called several times in one forward pass, like the shared
+    YOLACT head, are counted once per call.
+    """
+    flops = [0]
+
+    def conv_hook(module, _inputs, output):
+        kernel_size = module.kernel_size[0] * module.kernel_size[1]
+        flops[0] += output.numel() * (module.in_channels // module.groups) * kernel_size
+
+    def linear_hook(module, _inputs, output):
+        flops[0] += output.numel() * module.in_features
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(inputs)
+    model.train(training)
+
+    for handle in handles:
+        handle.remove()
+
+    return flops[0] // len(inputs)
+
+
+class YolactPrunner:
+    """Structured channel pruning of YOLACT to a FLOPs or latency budget
+
+    Channels are ranked by the L1 norm of their filters or by the Taylor
+    criterion |dC/dh * h| (https://arxiv.org/abs/1611.06440) and removed
+    physically, so the pruned model is smaller and faster without sparse
+    kernels. Couplings of the architecture are kept consistent:
+
+    - all FPN lateral layers are summed in the top-down pathway, so they lose
+      the same channels, together with the input of the predict layers
+    - the FPN outputs feed the extra layers, the shared head, the protonet
+      and the semantic layer, so these are pruned as one group
+    - `HeadBranch` layers only live in the first branch and are shared by all
+      levels through `parent`, so they are pruned once and activations for
+      the Taylor criterion are accumulated across levels
+    - residual streams of the backbone are left intact, only the inner
+      channels of ResNet blocks and the expanded channels of MobileNetV3
+      blocks are pruned
+
+    Args:
+        model (:class:`YolactModel`): it is copied, the original is not modified
+        criterion (:obj:`str`): `l1` or `taylor`
+        min_channels (:obj:`int`): minimum number of channels of each group
+        size (:obj:`Tuple[int, int]`): size of the dummy images to count FLOPs and latency
+
+    Examples::
+        >>> prunner = YolactPrunner(model)
+        >>> pruned_model = prunner.prune(target_flops=0.5)
+        >>> prunner.report()
+    """
+    def __init__(
+        self,
+        model: nn.Module,
+        criterion: str = 'l1',
+        min_channels: int = 8,
+        size: Tuple[int, int] = (550, 550)
+    ) -> None:
+        if criterion not in ('l1', 'taylor'):
+            raise ValueError(f"{criterion} should be either 'l1' or 'taylor'.")
+
+        self.original_model = model
+        self.model = copy.deepcopy(model)
+        self.criterion = criterion
+        self.min_channels = min_channels
+        self.device = next(model.parameters()).device
+        self.inputs = [torch.rand(3, *size, device=self.device)]
+        self.book = ModelBook(self.model)
+        self.groups = self.build_groups()
+        self.history: List[Dict[str, float]] = []
+
+    def build_groups(self) -> List[ChannelGroup]:
+        model = self.model
+        min_channels = self.min_channels
+        groups = []
+
+        groups += self._backbone_groups()
+
+        # FPN: lateral outputs are summed in the top-down pathway
+        neck = model.neck
+        groups.append(ChannelGroup(
+            'neck.lateral',
+            producers=[('neck', 'lateral_layers', str(i)) for i in range(len(neck.lateral_layers))],
+            consumers=[('neck', 'predict_layers', str(i)) for i in range(len(neck.predict_layers))],
+            min_channels=min_channels))
+
+        # FPN outputs and everything that reads them
+        producers = [('neck', 'predict_layers', str(i)) for i in range(len(neck.predict_layers))]
+        consumers = []
+        if neck.use_extra_layers:
+            producers += [('neck', 'extra_layers', str(i)) for i in range(len(neck.extra_layers))]
+            consumers += [('neck', 'extra_layers', str(i)) for i in range(len(neck.extra_layers))]
+        elif neck.num_extra_predict_layers > 0:
+            # The last predict layer is reused on its own outputs, so its input and output
+            # channels are the same and both FPN groups have to be merged
+            lateral = groups.pop()
+            producers += lateral.producers
+            consumers += lateral.consumers
+
+        head = model.heads[0]
+        consumers.append(('heads', '0', 'upsample_layers', '0'))
+        consumers.append(('proto_layer', '0'))
+        consumers.append(('semantic_layer', '0'))
+        groups.append(ChannelGroup(
+            'neck.outputs', producers, consumers, min_channels=min_channels))
+
+        # Shared head: the upsample layer feeds the first conv of each branch
+        branch_names = ['box_layers', 'mask_layers', 'score_layers']
+        groups.append(ChannelGroup(
+            'heads.0.upsample_layers',
+            producers=[('heads', '0', 'upsample_layers', '0')],
+            consumers=[
+                ('heads', '0', name, _first_conv(getattr(head, name))) for name in branch_names],
+            min_channels=min_channels))
+        for name in branch_names:
+            groups += _conv_chain_groups(('heads', '0', name), getattr(head, name), min_channels)
+
+        groups += _conv_chain_groups(('proto_layer',), model.proto_layer, min_channels)
+
+        return groups
+
+    def _backbone_groups(self) -> List[ChannelGroup]:
+        from ..models.backbone_resnet import BasicBlock, Bottleneck
+        from ..models.backbone_mobilenetv3 import InvertedResidual, SqueezeExcitation
+
+        groups = []
+        for path, module in self.book.modules():
+            if not path or path[0] != 'backbone':
+                continue
+
+            if isinstance(module, Bottleneck):
+                groups.append(ChannelGroup(
+                    '.'.join(path + ('conv1',)),
+                    [path + ('conv1', '0')], [path + ('conv2', '0')], [path + ('bn1',)],
+                    min_channels=self.min_channels))
+                groups.append(ChannelGroup(
+                    '.'.join(path + ('conv2',)),
+                    [path + ('conv2', '0')], [path + ('conv3', '0')], [path + ('bn2',)],
+                    min_channels=self.min_channels))
+            elif isinstance(module, BasicBlock):
+                groups.append(ChannelGroup(
+                    '.'.join(path + ('conv1',)),
+                    [path + ('conv1', '0')], [path + ('conv2', '0')], [path + ('bn1',)],
+                    min_channels=self.min_channels))
+            elif isinstance(module, InvertedResidual):
+                layers = list(module.block.named_children())
+                # Without an expansion layer the block works on the residual stream
+                if len(layers) < 3 or isinstance(layers[1][1], SqueezeExcitation):
+                    continue
+
+                block = path + ('block',)
+                expand, depthwise, project = layers[0][0], layers[1][0], layers[-1][0]
+                producers = [block + (expand, '0')]
+                consumers = [block + (project, '0')]
+                if isinstance(layers[2][1], SqueezeExcitation):
+                    se = block + (layers[2][0],)
+                    producers.append(se + ('fc2',))
+                    consumers.append(se + ('fc1',))
+
+                groups.append(ChannelGroup(
+                    '.'.join(block + (expand,)), producers, consumers,
+                    norms=[block + (expand, '1'), block + (depthwise, '1')],
+                    depthwise=[block + (depthwise, '0')],
+                    min_channels=self.min_channels))
+
+        return groups
+
+    def rank(
+        self,
+        loss_fn: Optional[Callable[[nn.Module], Tensor]] = None
+    ) -> List[Tuple[ChannelGroup, int, float]]:
+        """Importance of every prunable channel, normalized per group
+
+        Args:
+            loss_fn (:obj:`Callable`): runs a forward pass on a batch and returns
+                the loss, required for the `taylor` criterion
+        """
+        if self.criterion == 'taylor':
+            if loss_fn is None:
+                raise ValueError('The taylor criterion requires loss_fn.')
+            scores = self._taylor_scores(loss_fn)
+        else:
+            scores = {}
+            for group in self.groups:
+                score = 0
+                for path in group.producers:
+                    weight = self.book.get_module(path).weight.detach()
+                    norm = weight.abs().flatten(1).sum(1)
+                    score = score + norm / norm.norm().clamp(min=1e-12)
+                scores[group] = score
+
+        ranks = []
+        for group, score in scores.items():
+            score = score.abs()
+            score = score / torch.sqrt(torch.sum(score * score)).clamp(min=1e-12)
+            for i, value in enumerate(score.tolist()):
+                ranks.append((group, i, value))
+
+        return ranks
+
+    def _taylor_scores(self, loss_fn: Callable[[nn.Module], Tensor]) -> Dict[ChannelGroup, Tensor]:
+        accumulated: Dict[Path, Tensor] = {}
+        handles = []
+
+        def make_hook(path):
+            def forward_hook(module, _inputs, output):
+                def grad_hook(grad):
+                    value = (grad * output.detach()).sum(dim=(0, 2, 3)).abs()
+                    # Shared head layers are called once per FPN level
+                    accumulated[path] = accumulated.get(path, 0) + value
+                output.register_hook(grad_hook)
+            return forward_hook
+
+        paths = {path for group in self.groups for path in group.producers}
+        for path in paths:
+            handles.append(self.book.get_module(path).register_forward_hook(make_hook(path)))
+
+        self.model.zero_grad()
+        loss = loss_fn(self.model)
+        loss.backward()
+        self.model.zero_grad()
+
+        for handle in handles:
+            handle.remove()
+
+        scores = {}
+        for group in self.groups:
+            score = 0
+            for path in group.producers:
+                if path in accumulated:
+                    value = accumulated[path]
+                    score = score + value / value.norm().clamp(min=1e-12)
+            if isinstance(score, Tensor):
+                scores[group] = score
+
+        return scores
+
+    def prune_step(
+        self,
+        num_channels: int,
+        loss_fn: Optional[Callable[[nn.Module], Tensor]] = None
+    ) -> int:
+        """Remove the num_channels least important channels across all groups"""
+        ranks = self.rank(loss_fn)
+        ranks = sorted(ranks, key=lambda t: t[2])
+
+        to_prune: Dict[ChannelGroup, List[int]] = {}
+        remaining = {group: group.num_channels(self.book) for group in self.groups}
+        for group, index, _ in ranks:
+            if sum(len(v) for v in to_prune.values()) >= num_channels:
+                break
+            if remaining[group] <= group.min_channels:
+                continue
+            to_prune.setdefault(group, []).append(index)
+            remaining[group] -= 1
+
+        for group, indexes in to_prune.items():
+            mask = torch.ones(group.num_channels(self.book), dtype=torch.bool)
+            mask[indexes] = False
+            logging.info(f'Prune {group.name}: {len(indexes)} channels')
+            group.prune(self.book, mask.nonzero().view(-1))
+
+        self._update_attributes()
+
+        return sum(len(v) for v in to_prune.values())
+
+    def _update_attributes(self):
+        neck = self.model.neck
+        out_channels = self.book.get_module(('neck', 'predict_layers', '0')).out_channels
+        neck.out_channels = out_channels
+        neck.channels = [out_channels] * len(neck.selected_layers)
+
+    def prune(
+        self,
+        target_flops: Optional[float] = None,
+        target_latency: Optional[float] = None,
+        step: float = 0.05,
+        loss_fn: Optional[Callable[[nn.Module], Tensor]] = None,
+        finetune_fn: Optional[Callable[[nn.Module], None]] = None,
+        max_steps: int = 100
+    ) -> nn.Module:
+        """Prune until the model fits the budget
+
+        Args:
+            target_flops (:obj:`float`): multiply-accumulates of the pruned model,
+                a value below 1 is a ratio of the original FLOPs
+            target_latency (:obj:`float`): latency in milliseconds, a value below 1
+                is a ratio of the original latency
+            step (:obj:`float`): fraction of the prunable channels removed per step
+            loss_fn (:obj:`Callable`): required for the `taylor` criterion
+            finetune_fn (:obj:`Callable`): called with the model after every step
+            max_steps (:obj:`int`):
+
+        Returns:
+            model (:class:`YolactModel`): physically smaller model
+        """
+        if target_flops is None and target_latency is None:
+            raise ValueError('Either target_flops or target_latency is required.')
+
+        flops = count_flops(self.model, self.inputs)
+        latency = measure_latency(self.model, self.inputs)
+        self.history = [{
+            'step': 0, 'flops': flops, 'latency': latency, 'params': _num_params(self.model)}]
+
+        if target_flops is not None and target_flops < 1:
+            target_flops = target_flops * flops
+        if target_latency is not None and target_latency < 1:
+            target_latency = target_latency * latency
+
+        for i in range(1, max_steps + 1):
+            if target_flops is not None and flops <= target_flops:
+                break
+            if target_latency is not None and latency <= target_latency:
+                break
+
+            num_channels = int(step * sum(g.num_channels(self.book) for g in self.groups))
+            if self.prune_step(max(num_channels, 1), loss_fn) == 0:
+                logging.warning('Every channel group reached min_channels.')
+                break
+
+            if finetune_fn is not None:
+                finetune_fn(self.model)
+
+            flops = count_flops(self.model, self.inputs)
+            if target_latency is not None:
+                latency = measure_latency(self.model, self.inputs)
+            self.history.append({
+                'step': i, 'flops': flops, 'latency': latency, 'params': _num_params(self.model)})
+
+        self.history[-1]['latency'] = measure_latency(self.model, self.inputs)
+
+        return self.model
+
+    def report(self) -> Dict[str, float]:
+        """Print and return params, FLOPs and latency before and after pruning"""
+        if not self.history:
+            raise RuntimeError('Call prune before report.')
+
+        before, after = self.history[0], self.history[-1]
+        report = {
+            'params': before['params'],
+            'pruned_params': after['params'],
+            'gflops': before['flops'] / 1e9,
+            'pruned_gflops': after['flops'] / 1e9,
+            'latency_ms': before['latency'],
+            'pruned_latency_ms': after['latency'],
+            'speedup': before['latency'] / after['latency'],
+        }
+        for k, v in report.items():
+            print(f'{k:>18}: {v:>14,.4f}')
+
+        return report
+
+
+def _first_conv(layers: nn.Sequential) -> str:
+    for name, module in layers.named_children():
+        if isinstance(module, nn.Conv2d):
+            return name
+
+    raise ValueError('No convolution in layers.')
+
 
-    
\ No newline at end of file
+def _num_params(model: nn.Module) -> int:
+    return sum(p.numel() for p in model.parameters())
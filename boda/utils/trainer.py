@@ -1,6 +1,8 @@
 import math
+import time
+import contextlib
 from collections import deque
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Dict, Union, Callable, Optional
 
 import numpy as np
 from numpy.core.defchararray import decode
@@ -8,6 +10,17 @@ import torch
 from torch import nn, Tensor
 from torch.utils.data import DataLoader
 
+from .dataset import DevicePrefetcher
+from .image_shards import ShardIterableDataset
+from .checkpoint import CheckpointManager
+from .evaluation import CocoEvaluator
+from .validation import BackgroundValidator, evaluate_model
+from .logger import MetricLogger, MetricSink
+from .misc import autocast, get_autocast_dtype
+from .distributed import (
+    is_distributed, get_device, is_main_process, all_reduce_mean, wrap_model, unwrap_model,
+    set_frozen_batch_norm_eval, distributed_loader, set_epoch, skip_batches)
+
 
 class MovingAverage():
     """Keeps an average window of the specified number of items."""
@@ -52,7 +65,66 @@ class MovingAverage():
         return len(self.window)
 
 
+def _grad_scaler(device_type: str, enabled: bool):
+    try:
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    except (AttributeError, TypeError):
+        # Before PyTorch 2.3 only the CUDA scaler exists
+        return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def _is_out_of_memory(error: BaseException) -> bool:
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+
+    message = str(error)
+    return isinstance(error, RuntimeError) and (
+        'out of memory' in message or "can't allocate memory" in message)
+
+
 class Trainer:
+    """Training loop with mixed precision and distributed data parallel
+
+    If the process group is initialized, see :mod:`boda.utils.launch`, the
+    model is wrapped in DDP on the device of the local rank, map-style
+    loaders get a `DistributedSampler`, loss averages are all-reduced and
+    only rank 0 logs and saves checkpoints. Call :meth:`Model.freeze`
+    before building the trainer.
+
+    Args:
+        verbose (:obj:`int`): steps between logs, losses are read from the
+            device only then
+        augmentation (:obj:`Callable`): e.g. :class:`BatchCompose`, applied
+            on the device to the images stacked into :obj:`Tensor[B, C, H, W]`,
+            which the model then gets as one tensor
+        precision (:obj:`str`): `fp32`, or `fp16` and `bf16` to run the
+            forward pass and the losses under autocast. `fp16` scales the
+            loss with a `GradScaler`, numerically sensitive loss terms stay
+            in fp32 through :func:`force_fp32`.
+        sinks (:obj:`List[MetricSink]`): see :mod:`boda.utils.logger`,
+            stdout if `None`
+        accumulation_steps (:obj:`int`): loader batches per optimizer step
+        micro_batches (:obj:`int`): chunks each loader batch is split into
+            for the forward and backward passes
+        auto_split (:obj:`bool`): on out of memory, double `micro_batches`
+            and retry the batch instead of failing. The retry clears the
+            gradients accumulated for the step, and under DDP an OOM in
+            the synchronized backward can not be retried, as the other
+            ranks wait in the gradient all-reduce.
+        ema (:obj:`ModelEMA`): updated after every optimizer step and saved
+            in the checkpoints
+        checkpoint (:obj:`CheckpointManager`): writes the model, optimizer,
+            scheduler, scaler, EMA and data cursor in the background, at
+            the end of each epoch to `checkpoints/` if `None`
+        evaluator (:obj:`CocoEvaluator`): fed by :meth:`valid` batch by
+            batch, validation runs at the end of each epoch if it is set
+        postprocess (:obj:`Callable`): turns the outputs of the model in
+            eval mode and the image sizes into a list of `boxes`, `scores`,
+            `labels` and `masks` dicts, e.g. :class:`YolactInference`
+        validator (:obj:`BackgroundValidator`): validates a snapshot of the
+            weights in another process at the end of each epoch instead of
+            :meth:`valid`, the stats are logged once they are ready
+    """
     def __init__(
         self,
         # config,
@@ -66,6 +138,17 @@ class Trainer:
         num_iterations = None,
         device: str = None,
         verbose: int = 1,
+        augmentation: Optional[Callable] = None,
+        precision: str = 'fp32',
+        sinks: Optional[List[MetricSink]] = None,
+        accumulation_steps: int = 1,
+        micro_batches: int = 1,
+        auto_split: bool = True,
+        ema=None,
+        checkpoint: Optional[CheckpointManager] = None,
+        evaluator: Optional[CocoEvaluator] = None,
+        postprocess: Optional[Callable] = None,
+        validator: Optional[BackgroundValidator] = None,
     ) -> None:
         self.train_loader = train_loader
         self.valid_loader = valid_loader
@@ -77,9 +160,40 @@ class Trainer:
         self.num_iterations = num_iterations
         self.device = device
         self.verbose = verbose
+        # Batched transforms applied on the device, see boda.utils.batch_transforms
+        self.augmentation = augmentation
+        # Where the averaged losses are written every `verbose` steps
+        self.sinks = sinks
+        if accumulation_steps < 1 or micro_batches < 1:
+            raise ValueError('accumulation_steps and micro_batches must be positive.')
+        self.accumulation_steps = accumulation_steps
+        self.micro_batches = micro_batches
+        self.auto_split = auto_split
+        # Whether the running chunk all-reduces its gradients under DDP
+        self._in_synced_chunk = False
+        self.ema = ema
+        self.checkpoint = checkpoint if checkpoint is not None else CheckpointManager()
+        self.evaluator = evaluator
+        self.postprocess = postprocess
+        self.validator = validator
+        # Where train starts, set by load_state_dict
+        self.start_epoch = 0
+        self.start_batches = 0
+        self.global_step = 0
         if self.device is None:
             self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+        self.distributed = is_distributed()
+        if self.distributed:
+            self.device = get_device()
+            self.model = wrap_model(model.to(self.device), self.device)
+            self.train_loader = distributed_loader(train_loader)
+
+        get_autocast_dtype(precision)
+        self.precision = precision
+        self.device_type = torch.device(self.device).type
+        self.scaler = _grad_scaler(self.device_type, enabled=precision == 'fp16')
+
         # if config is not None:
         #     for key, value in config.items():
         #         setattr(self, key, value)
@@ -88,124 +202,268 @@ class Trainer:
         ...
 
     def train(self):
-        loss_averages = {k: MovingAverage(100) for k in ['B', 'M', 'C', 'S']}
-        # loss_averages = {k: MovingAverage(100) for k in ['B', 'C', 'S']}
+        logger = MetricLogger(self.sinks) if is_main_process() else None
         self.model.train()
-        for epoch in range(self.num_epochs):
-            for i, (images, targets) in enumerate(self.train_loader):
-                images = [image.to(self.device) for image in images]
-                targets = [{k: v.to(self.device) for k, v in t.items()} for t in targets]
-
+        set_frozen_batch_norm_eval(self.model)
+        start_time = time.perf_counter()
+        # Loss sums since the last log stay on the device, so a step does
+        # not wait for the device to read them
+        loss_keys = None
+        loss_sums = None
+        num_batches = 0
+        num_steps = 0
+        global_step = self.global_step
+        # Loader batches whose gradients are accumulated for the next step
+        accumulated = 0
+        self.optimizer.zero_grad()
+        try:
+            for epoch in range(self.start_epoch, self.num_epochs):
+                set_epoch(self.train_loader, epoch)
+                # Batches of the epoch consumed before a resume, map-style
+                # loaders skip them here, ShardIterableDataset by its cursor
+                train_loader = self.train_loader
+                dataset = train_loader.dataset
+                if isinstance(dataset, ShardIterableDataset):
+                    offset = dataset.resume_batches
+                else:
+                    offset = self.start_batches if epoch == self.start_epoch else 0
+                    train_loader = skip_batches(train_loader, offset)
+                # The next batch is copied to the device while this step runs
+                for i, (images, targets) in enumerate(DevicePrefetcher(train_loader, self.device)):
+                    if self.augmentation is not None:
+                        # DetectionCollate already stacks the images
+                        if not isinstance(images, Tensor):
+                            images = torch.stack(images)
+                        images, targets = self.augmentation(images, targets)
+
+                    # DDP all-reduces the gradients only in the last backward of a step
+                    sync = accumulated + 1 == self.accumulation_steps
+                    losses, restarted = self.train_one_step(images, targets, sync)
+                    # A retry cleared the gradients of the previous batches, the
+                    # step restarts unless other ranks must reach its all-reduce
+                    if restarted and not self.distributed:
+                        accumulated = 0
+                    accumulated += 1
+
+                    if accumulated == self.accumulation_steps:
+                        self.optimizer_step()
+                        accumulated = 0
+                        num_steps += 1
+                        global_step += 1
+                        if self.checkpoint.should_save(global_step):
+                            self.save_checkpoint(epoch, offset + i + 1, global_step)
+
+                    values = torch.stack([v.reshape(()) for v in losses.values()])
+                    if loss_sums is None:
+                        loss_keys = list(losses)
+                        loss_sums = torch.zeros_like(values)
+                    loss_sums += values
+                    num_batches += 1
+
+                    if accumulated == 0 and global_step % self.verbose == 0:
+                        # One all-reduce and one device to host copy per log
+                        means = all_reduce_mean(dict(zip(loss_keys, loss_sums / num_batches)))
+                        means = dict(zip(loss_keys, torch.stack(list(means.values())).tolist()))
+                        steps_per_second = num_steps / (time.perf_counter() - start_time)
+                        if logger is not None:
+                            logger.log({
+                                'epoch': f'{epoch:>{len(str(self.num_epochs))}}/{self.num_epochs}',
+                                'step': global_step,
+                                'T': sum(means.values()),
+                                **means,
+                                'precision': self.precision,
+                                'it/s': round(steps_per_second, 2),
+                            })
+                        self.log_validation(logger)
+                        loss_sums.zero_()
+                        num_batches = 0
+                        num_steps = 0
+                        start_time = time.perf_counter()
+
+                self.save_checkpoint(epoch + 1, 0, global_step)
+                tag = {'epoch': f'{epoch:>{len(str(self.num_epochs))}}/{self.num_epochs}',
+                       'step': global_step}
+                if self.validator is not None and is_main_process():
+                    # Training goes on while the snapshot is evaluated, the
+                    # last one is always queued
+                    last = epoch + 1 == self.num_epochs
+                    if not self.validator.submit(self.model, tag, block=last):
+                        print(f'Validation of epoch {epoch} skipped, the validator is busy.')
+                elif self.evaluator is not None and self.valid_loader is not None and is_main_process():
+                    logger.log({**tag, **self.valid()})
+
+            if accumulated > 0:
+                # Gradients of an incomplete last step are only applied without
+                # DDP, as they were never all-reduced across ranks
+                if not self.distributed:
+                    self.optimizer_step()
                 self.optimizer.zero_grad()
 
-                outputs = self.model(images)
-                losses = self.criterion(outputs, targets)
-                loss = sum(value for value in losses.values())
-                loss.backward()
-
-                self.optimizer.step()
-
-                for k, v in losses.items():
-                    loss_averages[k].add(v.item())
-
-                loss = sum([loss_averages[k].get_avg() for k in losses.keys()])
-
-                if (i+1) % self.verbose == 0:
-                    print(f'{epoch:>{len(str(self.num_epochs))}}/{self.num_epochs} | T: {loss::>7.4f}', end=' | ')
-                    # for k, v in losses.items():
-                    #     print(f'{k}: {v.item():>7.4f}', end=' | ')
-                    for k, v in loss_averages.items():
-                        print(f'{k}: {v.get_avg():>7.4f}', end=' | ')
-                    print()
-
-            torch.save(self.model.state_dict(), 'test.pth')
+            self.log_validation(logger, wait=True)
+        finally:
+            # Records still queued are written before returning
+            if logger is not None:
+                logger.close()
+            self.checkpoint.wait()
+            if self.validator is not None:
+                self.validator.close()
+            self.global_step = global_step
+
+    def log_validation(self, logger: Optional[MetricLogger], wait: bool = False) -> None:
+        """Log the stats the validator has finished, all of them if `wait`"""
+        if self.validator is None or logger is None:
+            return
 
-    def train_one_step(self):
-        raise NotImplementedError
+        records = self.validator.wait() if wait else self.validator.poll()
+        for record in records:
+            logger.log(record)
+
+    def optimizer_step(self):
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad()
+        if self.ema is not None:
+            self.ema.update(self.model)
+
+    def state_dict(self, epoch: int, num_batches: int, step: int) -> Dict:
+        """Training state after `num_batches` loader batches of `epoch`"""
+        state = {
+            'epoch': epoch,
+            'num_batches': num_batches,
+            'step': step,
+            'model': unwrap_model(self.model).state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scaler': self.scaler.state_dict(),
+        }
+        if hasattr(self.scheduler, 'state_dict'):
+            state['scheduler'] = self.scheduler.state_dict()
+        if self.ema is not None:
+            state['ema'] = self.ema.state_dict()
+
+        dataset = self.train_loader.dataset
+        if isinstance(dataset, ShardIterableDataset):
+            # At the end of an epoch the cursor points to the next one
+            cursor = dataset.state_dict(num_batches, self.train_loader.batch_size)
+            state['dataset'] = {**cursor, 'epoch': epoch}
+
+        return state
+
+    def load_state_dict(self, state: Dict) -> None:
+        """Resume from a checkpoint, :meth:`train` then continues after it
+
+        Loaders of :class:`ShardIterableDataset` resume at the saved batch
+        through their cursor, map-style loaders skip the batches of the
+        saved epoch already consumed, see :func:`skip_batches`.
+        """
+        unwrap_model(self.model).load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scaler.load_state_dict(state['scaler'])
+        if 'scheduler' in state and self.scheduler is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        if 'ema' in state and self.ema is not None:
+            self.ema.load_state_dict(state['ema'])
+        if 'dataset' in state:
+            self.train_loader.dataset.load_state_dict(state['dataset'])
+
+        self.start_epoch = state['epoch']
+        self.start_batches = state['num_batches']
+        self.global_step = state['step']
+
+    def save_checkpoint(self, epoch: int, num_batches: int, step: int) -> None:
+        if is_main_process():
+            self.checkpoint.save(self.state_dict(epoch, num_batches, step), step)
+
+    def resume(self, path: Optional[str] = None) -> bool:
+        """Load a checkpoint, the latest one of the manager if `path` is
+        `None`. Returns `False` if there is none."""
+        state = self.checkpoint.load(path, map_location=self.device)
+        if state is None:
+            return False
+
+        self.load_state_dict(state)
+        return True
+
+    def train_one_step(
+        self,
+        images: Union[Tensor, List[Tensor]],
+        targets: List[Dict[str, Tensor]],
+        sync: bool = True
+    ) -> Tuple[Dict[str, Tensor], bool]:
+        """Forward and backward passes of one loader batch in `micro_batches`
+        chunks, gradients are accumulated without an optimizer step
+
+        Returns:
+            losses (:obj:`Dict[str, Tensor]`): detached losses of the batch
+            restarted (:obj:`bool`): an out of memory error cleared the
+                gradients accumulated from previous batches
+        """
+        restarted = False
+        while True:
+            try:
+                return self._forward_backward(images, targets, sync), restarted
+            except RuntimeError as e:
+                if not self.auto_split or not _is_out_of_memory(e) \
+                        or self.micro_batches >= len(images):
+                    raise
+                if self.distributed and self._in_synced_chunk:
+                    # The reducer may have launched part of the all-reduce
+                    raise
+
+            # Outside of the except block, so the frames of the error no
+            # longer hold the activations
+            self.optimizer.zero_grad(set_to_none=True)
+            if self.device_type == 'cuda':
+                torch.cuda.empty_cache()
+            self.micro_batches = min(self.micro_batches * 2, len(images))
+            restarted = True
+            print(f'Out of memory, retrying with {self.micro_batches} micro-batches '
+                  f'of {math.ceil(len(images) / self.micro_batches)} images')
+
+    def _forward_backward(self, images, targets, sync: bool) -> Dict[str, Tensor]:
+        batch_size = len(images)
+        num_chunks = min(self.micro_batches, batch_size)
+        bounds = np.linspace(0, batch_size, num_chunks + 1).round().astype(int).tolist()
+
+        total_losses = {}
+        for j, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            self._in_synced_chunk = sync and j == num_chunks - 1
+            if self.distributed and not self._in_synced_chunk:
+                context = self.model.no_sync()
+            else:
+                context = contextlib.nullcontext()
+
+            with context:
+                with autocast(self.precision, self.device_type):
+                    outputs = self.model(images[start:end])
+                    losses = self.criterion(outputs, targets[start:end])
+
+                # Each chunk is weighted by its share of the images of the step
+                weight = (end - start) / batch_size
+                loss = sum(value.float() for value in losses.values())
+                self.scaler.scale(loss * (weight / self.accumulation_steps)).backward()
+
+            for k, v in losses.items():
+                v = v.detach().float() * weight
+                total_losses[k] = total_losses[k] + v if k in total_losses else v
+
+        return total_losses
 
     def train_one_epoch(self):
         raise NotImplementedError
 
-    def valid(self):
-        with torch.no_grad():
-            self.model.eval()
-            for i, (images, targets, h, w) in self.valid_loader:
-                images = [image.to(self.device) for image in images]
-                targets = [{k: v.to(self.device) for k, v in t.items()} for t in targets]
-
-                outputs = self.model(images)
-
-#     def compute_map(self, outputs, targets, h, w):
-#         true_boxes = targets['boxes']
-#         true_boxes[:, [0, 2]] *= w
-#         true_boxes[:, [1, 3]] *= h
-#         true_labels = targets['labels']
-        
-#         iou_thresholds = [x / 100 for x in range(50, 100, 5)]
-        
-#         pred_labels
-#         true_labels
-#         iou_types = [
-#             ('box',  lambda i,j: bbox_iou_cache[i, j].item(),
-#                      lambda i,j: crowd_bbox_iou_cache[i,j].item(),
-#                      lambda i: box_scores[i], box_indices),
-#             ('mask', lambda i,j: mask_iou_cache[i, j].item(),
-#                      lambda i,j: crowd_mask_iou_cache[i,j].item(),
-#                      lambda i: mask_scores[i], mask_indices)
-#         ]
-
-#         for _class in set(pred_labels + true_labels):
-#             ap_per_iou = []
-#             num_true_for_class = sum([1 for x in true_labels if x == _class])
-            
-#             for iouIdx in range(len(iou_thresholds)):
-#                 iou_threshold = iou_thresholds[iouIdx]
-
-#                 for iou_type, iou_func, crowd_func, score_func, indices in iou_types:
-#                     gt_used = [False] * len(true_labels)
-                    
-#                     ap_obj = ap_data[iou_type][iouIdx][_class]
-#                     ap_obj.add_gt_positives(num_true_for_class)
-
-#                     for i in indices:
-#                         if classes[i] != _class:
-#                             continue
-                        
-#                         max_iou_found = iou_threshold
-#                         max_match_idx = -1
-#                         for j in range(num_gt):
-#                             if gt_used[j] or gt_classes[j] != _class:
-#                                 continue
-                                
-#                             iou = iou_func(i, j)
-
-#                             if iou > max_iou_found:
-#                                 max_iou_found = iou
-#                                 max_match_idx = j
-                        
-#                         if max_match_idx >= 0:
-#                             gt_used[max_match_idx] = True
-#                             ap_obj.push(score_func(i), True)
-#                         else:
-#                             # If the detection matches a crowd, we can just ignore it
-#                             matched_crowd = False
-
-#                             if num_crowd > 0:
-#                                 for j in range(len(crowd_classes)):
-#                                     if crowd_classes[j] != _class:
-#                                         continue
-                                    
-#                                     iou = crowd_func(i, j)
-
-#                                     if iou > iou_threshold:
-#                                         matched_crowd = True
-#                                         break
-
-#                             # All this crowd code so that we can make sure that our eval code gives the
-#                             # same result as COCOEval. There aren't even that many crowd annotations to
-#                             # begin with, but accuracy is of the utmost importance.
-#                             if not matched_crowd:
-#                                 ap_obj.push(score_func(i), False)
+    def valid(self) -> Dict[str, float]:
+        """Evaluate on the validation loader, only rank 0 runs it under DDP,
+        see :func:`evaluate_model`"""
+        # The DDP wrapper would wait for other ranks to broadcast buffers
+        model = unwrap_model(self.model)
+        model.eval()
+        try:
+            return evaluate_model(
+                model, self.valid_loader, self.evaluator, self.postprocess,
+                self.device, self.precision)
+        finally:
+            model.train()
+            set_frozen_batch_norm_eval(model)
 
 
 # def postprocess(det_output, w, h, batch_idx=0, interpolation_mode='bilinear',
@@ -318,91 +576,6 @@ class Trainer:
 #     return classes, scores, boxes, masks
 
 
-# class APDataObject:
-#     """
-#     Stores all the information necessary to calculate the AP for one IoU and one class.
-#     Note: I type annotated this because why not.
-#     """
-#     def __init__(self):
-#         self.data_points = []
-#         self.num_gt_positives = 0
-
-#     def push(self, score: float, is_true: bool):
-#         self.data_points.append((score, is_true))
-    
-#     def add_gt_positives(self, num_positives: int):
-#         """ Call this once per image. """
-#         self.num_gt_positives += num_positives
-
-#     def is_empty(self) -> bool:
-#         return len(self.data_points) == 0 and self.num_gt_positives == 0
-
-#     def get_ap(self) -> float:
-#         """ Warning: result not cached. """
-
-#         if self.num_gt_positives == 0:
-#             return 0
-
-#         # Sort descending by score
-#         self.data_points.sort(key=lambda x: -x[0])
-
-#         precisions = []
-#         recalls = []
-#         num_true = 0
-#         num_false = 0
-
-#         # Compute the precision-recall curve. The x axis is recalls and the y axis precisions.
-#         for datum in self.data_points:
-#             # datum[1] is whether the detection a true or false positive
-#             if datum[1]:
-#                 num_true += 1
-#             else:
-#                 num_false += 1
-
-#             precision = num_true / (num_true + num_false)
-#             recall = num_true / self.num_gt_positives
-
-#             precisions.append(precision)
-#             recalls.append(recall)
-
-#         # Smooth the curve by computing [max(precisions[i:]) for i in range(len(precisions))]
-#         # Basically, remove any temporary dips from the curve.
-#         # At least that's what I think, idk. COCOEval did it so I do too.
-#         for i in range(len(precisions)-1, 0, -1):
-#             if precisions[i] > precisions[i-1]:
-#                 precisions[i-1] = precisions[i]
-
-#         # Compute the integral of precision(recall) d_recall from recall=0->1 using fixed-length riemann summation with 101 bars.
-#         y_range = [0] * 101 # idx 0 is recall == 0.0 and idx 100 is recall == 1.00
-#         x_range = np.array([x / 100 for x in range(101)])
-#         recalls = np.array(recalls)
-
-#         # I realize this is weird, but all it does is find the nearest precision(x) for a given x in x_range.
-#         # Basically, if the closest recall we have to 0.01 is 0.009 this sets precision(0.01) = precision(0.009).
-#         # I approximate the integral this way, because that's how COCOEval does it.
-#         indices = np.searchsorted(recalls, x_range, side='left')
-#         for bar_idx, precision_idx in enumerate(indices):
-#             if precision_idx < len(precisions):
-#                 y_range[bar_idx] = precisions[precision_idx]
-
-#         # Finally compute the riemann sum to get our integral.
-#         # avg([precision(x) for x in 0:0.01:1])
-#         return sum(y_range) / len(y_range)
-
-
-# class Evaluation:
-#     def __init__(self):
-#         pass
-
-#     def evaluate(self):
-#         return
-
-#     def postprocess(self):
-#         pass
-
-
-
-
 # class Detection:
 #     def __init__(self) -> None:
 #         self.boxes = []
@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import argparse
+from typing import Tuple
+
+import cv2
+import numpy as np
+from pycocotools import mask as mask_utils
+from torch.utils.data import Dataset, DataLoader
+
+from .dataset import CocoDataset
+from .masks import decode_segmentation_mask
+
+
+CACHE_VERSION = 2
+MASK_FORMATS = ('bits', 'rle')
+
+
+class _CacheSource(Dataset):
+    """Loads, resizes and encodes one image and its targets"""
+    def __init__(self, dataset: CocoDataset, size: Tuple[int, int], mask_format: str) -> None:
+        self.dataset = dataset
+        self.size = size
+        self.mask_format = mask_format
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        dataset = self.dataset
+        image_id = dataset.image_ids[index]
+        h, w = self.size
+
+        image = dataset.load_image(image_id)
+        image = cv2.resize(image, (w, h), interpolation=cv2.INTER_LINEAR)
+
+        original_h, original_w = dataset.coco.get_image_size(image_id)
+        annots = dataset.coco.get_annot_arrays(image_id)
+        boxes = np.array(annots['boxes'], dtype=np.float32).reshape(-1, 4)
+        boxes[:, 2:] += boxes[:, :2]
+        boxes *= np.asarray(
+            [w / original_w, h / original_h, w / original_w, h / original_h], dtype=np.float32)
+        labels = dataset.label_lookup[annots['category_ids']] - 1
+        crowds = annots['iscrowd'].astype(np.uint8)
+
+        masks = []
+        for segment in dataset.coco.get_segmentations(image_id):
+            if segment is None:
+                mask = np.zeros((h, w), dtype=np.uint8)
+            else:
+                mask = decode_segmentation_mask(segment, original_h, original_w, (h, w))
+
+            if self.mask_format == 'bits':
+                masks.append(np.packbits(mask.reshape(-1)))
+            else:
+                masks.append(mask_utils.encode(np.asfortranarray(mask))['counts'])
+
+        return index, image, (original_h, original_w), boxes, labels, crowds, masks
+
+
+def _no_collate(sample):
+    return sample
+
+
+def build_training_cache(
+    image_dir: str,
+    info_file: str,
+    output_dir: str,
+    size: Tuple[int, int] = (550, 550),
+    mask_format: str = 'bits',
+    label_map=None,
+    num_workers: int = 4,
+    log_interval: int = 1000
+) -> None:
+    """Store images and targets at the training resolution
+
+    Writes to `output_dir`:
+
+    - `images.npy`: :obj:`uint8[N, H, W, 3]`, memory-mapped by the reader
+    - `image_ids.npy`, `image_sizes.npy`: ids and original sizes of the source
+      images, as given in the annotation file
+    - `annot_offsets.npy`: targets of the i-th image are rows `offsets[i]:offsets[i+1]`
+    - `boxes.npy` (x1, y1, x2, y2 at the training resolution), `labels.npy`, `crowds.npy`
+    - `masks.npy`: bit-packed masks, or `mask_data.bin` and
+      `mask_offsets.npy` with compressed COCO RLE counts
+    - `meta.json`
+
+    Args:
+        image_dir (:obj:`str`):
+        info_file (:obj:`str`):
+        output_dir (:obj:`str`):
+        size (:obj:`Tuple[int, int]`): training height and width
+        mask_format (:obj:`str`): `bits` decodes faster, `rle` is smaller
+        label_map (:obj:`Dict[int, int]`): see :class:`CocoDataset`
+        num_workers (:obj:`int`): processes decoding the source images
+        log_interval (:obj:`int`): images between progress reports
+    """
+    if mask_format not in MASK_FORMATS:
+        raise ValueError(f'mask_format must be one of {MASK_FORMATS}, got {mask_format}.')
+
+    size = tuple(size)
+    h, w = size
+    dataset = CocoDataset(image_dir, info_file, label_map=label_map)
+    store = dataset.coco.store
+    num_images = store.num_images
+    num_annots = store.num_annots
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    def open_array(name, dtype, shape):
+        return np.lib.format.open_memmap(
+            os.path.join(output_dir, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+
+    images = open_array('images', np.uint8, (num_images, h, w, 3))
+    image_sizes = open_array('image_sizes', np.int32, (num_images, 2))
+    boxes = open_array('boxes', np.float32, (num_annots, 4))
+    labels = open_array('labels', np.int64, (num_annots,))
+    crowds = open_array('crowds', np.uint8, (num_annots,))
+    if mask_format == 'bits':
+        masks = open_array('masks', np.uint8, (num_annots, (h * w + 7) // 8))
+    else:
+        mask_lengths = np.zeros(num_annots, dtype=np.int64)
+        mask_file = open(os.path.join(output_dir, 'mask_data.bin'), 'wb')
+
+    annot_offsets = np.asarray(store.annot_offsets)
+    loader = DataLoader(
+        _CacheSource(dataset, size, mask_format),
+        batch_size=None, shuffle=False, num_workers=num_workers, collate_fn=_no_collate)
+
+    start_time = time.time()
+    for index, image, image_size, _boxes, _labels, _crowds, _masks in loader:
+        images[index] = image
+        image_sizes[index] = image_size
+        start, end = annot_offsets[index], annot_offsets[index + 1]
+        boxes[start:end] = _boxes
+        labels[start:end] = _labels
+        crowds[start:end] = _crowds
+
+        if mask_format == 'bits':
+            if end > start:
+                masks[start:end] = np.stack(_masks)
+        else:
+            for i, counts in enumerate(_masks):
+                mask_lengths[start + i] = len(counts)
+                mask_file.write(counts)
+
+        if (index + 1) % log_interval == 0:
+            print(f'Cached {index + 1:,}/{num_images:,} images ({time.time() - start_time:.1f}s)')
+
+    for array in (images, image_sizes, boxes, labels, crowds):
+        array.flush()
+
+    if mask_format == 'bits':
+        masks.flush()
+    else:
+        mask_file.close()
+        mask_offsets = np.zeros(num_annots + 1, dtype=np.int64)
+        np.cumsum(mask_lengths, out=mask_offsets[1:])
+        np.save(os.path.join(output_dir, 'mask_offsets.npy'), mask_offsets)
+    np.save(os.path.join(output_dir, 'image_ids.npy'), np.asarray(store.image_ids))
+    np.save(os.path.join(output_dir, 'annot_offsets.npy'), annot_offsets)
+
+    with open(os.path.join(output_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'version': CACHE_VERSION,
+            'size': list(size),
+            'mask_format': mask_format,
+            'info_file': os.path.abspath(info_file),
+            'label_map': {str(k): v for k, v in dataset.label_map.items()},
+            'categories': dataset.coco.category_info,
+        }, f, indent=4)
+
+    print(f'Cached {num_images:,} images and {num_annots:,} annotations '
+          f'({time.time() - start_time:.1f}s)')
+
+
+class CachedCocoDataset(Dataset):
+    """Reads the cache written by :func:`build_training_cache`
+
+    Images and bit-packed masks are memory-mapped, so a sample costs a copy
+    at the training resolution and no decoding or resizing. Returns the same
+    targets as :class:`CocoDataset`.
+
+    Args:
+        cache_dir (:obj:`str`):
+        mode (:obj:`str`): `train` returns image and targets, otherwise
+            the height and width of the original image are returned too
+        use_mask (:obj:`bool`):
+        transforms (:obj:`Callable`):
+    """
+    def __init__(self, cache_dir, mode: str = 'train', use_mask: bool = True, transforms=None):
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.use_mask = use_mask
+        self.transforms = transforms
+
+        with open(os.path.join(cache_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != CACHE_VERSION:
+            raise ValueError(f'{cache_dir} was written by another version of the cache.')
+
+        self.size = tuple(self.meta['size'])
+        self.mask_format = self.meta['mask_format']
+        self.label_map = {int(k): v for k, v in self.meta['label_map'].items()}
+
+        def load(name):
+            return np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode='r')
+
+        self.image_ids = load('image_ids')
+        self.image_sizes = load('image_sizes')
+        self.annot_offsets = load('annot_offsets')
+        self.images = load('images')
+        self.boxes = load('boxes')
+        self.labels = load('labels')
+        self.crowds = load('crowds')
+        if self.mask_format == 'bits':
+            self.masks = load('masks')
+        else:
+            self.mask_offsets = load('mask_offsets')
+            self.mask_data = np.memmap(
+                os.path.join(cache_dir, 'mask_data.bin'), dtype=np.uint8, mode='r') \
+                if self.mask_offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def get_masks(self, start: int, end: int) -> np.ndarray:
+        h, w = self.size
+        if self.mask_format == 'bits':
+            masks = np.unpackbits(self.masks[start:end], axis=1, count=h * w)
+            return masks.reshape(-1, h, w)
+
+        rles = [{
+            'size': [h, w],
+            'counts': self.mask_data[self.mask_offsets[i]:self.mask_offsets[i + 1]].tobytes()
+        } for i in range(start, end)]
+        if len(rles) == 0:
+            return np.zeros((0, h, w), dtype=np.uint8)
+
+        return mask_utils.decode(rles).transpose(2, 0, 1)
+
+    def __getitem__(self, index):
+        start, end = int(self.annot_offsets[index]), int(self.annot_offsets[index + 1])
+
+        image = np.array(self.images[index])
+        targets = {
+            'boxes': np.array(self.boxes[start:end]),
+            'labels': np.array(self.labels[start:end]),
+            'crowds': self.crowds[start:end].astype(np.int64),
+        }
+        if self.use_mask:
+            targets['masks'] = np.ascontiguousarray(self.get_masks(start, end))
+
+        if self.transforms is not None:
+            image, targets = self.transforms(image, targets)
+
+        if self.mode == 'train':
+            return image, targets
+        else:
+            # Predictions are evaluated at the size of the annotations
+            h, w = self.image_sizes[index]
+            return image, targets, int(h), int(w)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Store a COCO dataset at the training resolution')
+    parser.add_argument('--image-dir', required=True)
+    parser.add_argument('--info-file', required=True)
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--size', type=int, nargs='+', default=[550],
+                        help='height and width, or one value for both')
+    parser.add_argument('--mask-format', choices=MASK_FORMATS, default='bits')
+    parser.add_argument('--num-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    size = args.size * 2 if len(args.size) == 1 else args.size[:2]
+    build_training_cache(
+        args.image_dir, args.info_file, args.output_dir, size,
+        args.mask_format, num_workers=args.num_workers)
+
+
+if __name__ == '__main__':
+    main()
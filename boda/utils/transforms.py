@@ -1,12 +1,8 @@
-import math
 from typing import Tuple, List, Dict, Callable, Optional
 
 import cv2
-from numpy.core.fromnumeric import _resize_dispatcher, mean
-import pycocotools
 import torch
-import torch.nn.functional as F
-from torch import dtype, nn, Tensor
+from torch import Tensor
 from torchvision import transforms
 import numpy as np
 from numpy import ndarray
@@ -176,18 +172,202 @@ from numpy import ndarray
 #         return batched_imgs
 
 
+def _translation(tx: float, ty: float) -> ndarray:
+    return np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]], dtype=np.float64)
+
+
+def _scaling(sx: float, sy: float) -> ndarray:
+    return np.array([[sx, 0, 0], [0, sy, 0], [0, 0, 1]], dtype=np.float64)
+
+
+def warp_affine(
+    image: ndarray,
+    targets: Dict[str, ndarray],
+    matrix: ndarray,
+    size: Tuple[int, int],
+    border_value=None
+) -> Tuple[ndarray, Dict[str, ndarray]]:
+    """Apply an affine transform to an image, its boxes and its masks at once
+
+    `matrix` maps continuous coordinates, where pixel `i` covers `[i, i+1)`,
+    so flips and rotations by 90 degrees are exact for both pixels and boxes.
+
+    Args:
+        image (:obj:`ndarray[H, W, C]`):
+        targets (:obj:`Dict[str, ndarray]`): `boxes` (:obj:`ndarray[N, 4]`) in
+            x1, y1, x2, y2 and `masks`, `proto_masks` (:obj:`ndarray[N, H, W]`)
+            covering the whole image at any resolution
+        matrix (:obj:`ndarray[3, 3]`):
+        size (:obj:`Tuple[int, int]`): output height and width
+        border_value: fill value of the image outside of the source, the
+            edge pixels are repeated if `None`
+    """
+    in_h, in_w = image.shape[:2]
+    out_h, out_w = size
+
+    # Pixel centers are at i + 0.5 in continuous coordinates
+    pixel_matrix = _translation(-0.5, -0.5) @ matrix @ _translation(0.5, 0.5)
+    if border_value is None:
+        image = cv2.warpAffine(
+            image, pixel_matrix[:2], (out_w, out_h), flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_REPLICATE)
+    else:
+        if np.ndim(border_value) > 0:
+            border_value = tuple(float(v) for v in border_value)
+        image = cv2.warpAffine(
+            image, pixel_matrix[:2], (out_w, out_h), flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
+
+    if targets is None:
+        return image, targets
+
+    for key in ('masks', 'proto_masks'):
+        if targets.get(key) is not None:
+            targets[key] = _warp_masks(targets[key], matrix, (in_h, in_w), (out_h, out_w))
+
+    boxes = targets.get('boxes')
+    if boxes is not None and len(boxes) > 0:
+        # Corners of every box, [N, 4, 2]
+        corners = boxes[:, [[0, 1], [2, 1], [0, 3], [2, 3]]]
+        corners = corners @ matrix[:2, :2].T.astype(boxes.dtype) + matrix[:2, 2].astype(boxes.dtype)
+        boxes[:, :2] = corners.min(axis=1)
+        boxes[:, 2:] = corners.max(axis=1)
+        np.clip(boxes[:, 0::2], 0, out_w, out=boxes[:, 0::2])
+        np.clip(boxes[:, 1::2], 0, out_h, out=boxes[:, 1::2])
+
+    return image, targets
+
+
+def _warp_masks(
+    masks: ndarray,
+    matrix: ndarray,
+    image_size: Tuple[int, int],
+    out_image_size: Tuple[int, int],
+    max_channels: int = 4
+) -> ndarray:
+    """Warp a binary mask stack with one `cv2.warpAffine` call
+
+    Eight masks are packed into the bits of one channel. Nearest neighbour
+    sampling copies whole bytes, so the bits survive the warp and N masks
+    cost N / 8 channels instead of N calls.
+
+    Masks at the image resolution follow the output image size, masks at
+    another resolution, e.g. prototype masks, keep their resolution.
+    Channels are warped `max_channels` at a time: OpenCV 5 rejects more than
+    128 channels, and above 4 it rounds nearest neighbour coordinates
+    differently than for the 3 channel image.
+    """
+    num_masks, mask_h, mask_w = masks.shape
+    if (mask_h, mask_w) == tuple(image_size):
+        out_h, out_w = out_image_size
+    else:
+        out_h, out_w = mask_h, mask_w
+
+    if num_masks == 0:
+        return np.zeros((0, out_h, out_w), dtype=masks.dtype)
+
+    # Map mask coordinates to image coordinates and back
+    matrix = _scaling(out_w / out_image_size[1], out_h / out_image_size[0]) @ matrix @ \
+        _scaling(image_size[1] / mask_w, image_size[0] / mask_h)
+    pixel_matrix = (_translation(-0.5, -0.5) @ matrix @ _translation(0.5, 0.5))[:2]
+
+    num_channels = (num_masks + 7) // 8
+    packed = np.zeros((num_channels, mask_h, mask_w), dtype=np.uint8)
+    for bit in range(min(8, num_masks)):
+        selected = masks[bit::8]
+        packed[:len(selected)] |= (selected != 0).view(np.uint8) << bit
+    packed = packed.transpose(1, 2, 0)
+
+    outputs = []
+    for i in range(0, num_channels, max_channels):
+        output = cv2.warpAffine(
+            np.ascontiguousarray(packed[:, :, i:i+max_channels]), pixel_matrix, (out_w, out_h),
+            flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        outputs.append(output.reshape(out_h, out_w, -1))
+    packed = np.ascontiguousarray(np.concatenate(outputs, axis=2).transpose(2, 0, 1))
+
+    outputs = np.empty((num_masks, out_h, out_w), dtype=masks.dtype)
+    for bit in range(min(8, num_masks)):
+        selected = outputs[bit::8]
+        np.bitwise_and(packed[:len(selected)] >> bit, 1, out=selected, casting='unsafe')
+
+    return outputs
+
+
+class GeometricTransform:
+    """Transform that can be expressed as an affine matrix
+
+    Subclasses implement `get_matrix`. Successive geometric transforms in
+    :class:`Compose` are multiplied into one matrix and applied with one
+    `cv2.warpAffine` for the image and one for the bit-packed masks.
+    """
+    border_value = None
+
+    def get_matrix(self, height: int, width: int) -> Optional[Tuple[ndarray, Tuple[int, int]]]:
+        """
+        Returns:
+            matrix (:obj:`ndarray[3, 3]`): in continuous coordinates
+            size (:obj:`Tuple[int, int]`): output height and width
+            or `None` if the transform is skipped
+        """
+        raise NotImplementedError
+
+    def __call__(
+        self,
+        image: ndarray,
+        targets: Dict[str, ndarray]
+    ) -> Tuple[ndarray, Dict[str, ndarray]]:
+        h, w = image.shape[:2]
+        params = self.get_matrix(h, w)
+        if params is None:
+            return image, targets
+
+        matrix, size = params
+        return warp_affine(image, targets, matrix, size, self.border_value)
+
+
 class Compose:
-    def __init__(self, transforms: List[Callable]) -> None:
+    """
+    Args:
+        transforms (:obj:`List[Callable]`):
+        fuse (:obj:`bool`): apply successive :class:`GeometricTransform` as one warp
+    """
+    def __init__(self, transforms: List[Callable], fuse: bool = True) -> None:
         self.transforms = transforms
+        self.fuse = fuse
 
     def __call__(
         self,
         image: ndarray,
         targets: Dict[str, ndarray]
     ) -> Tuple[ndarray, Dict[str, ndarray]]:
+        matrix = None
+        size = None
+        border_value = None
         for t in self.transforms:
+            if self.fuse and isinstance(t, GeometricTransform):
+                h, w = image.shape[:2] if size is None else size
+                params = t.get_matrix(h, w)
+                if params is None:
+                    continue
+
+                matrix = params[0] if matrix is None else params[0] @ matrix
+                size = params[1]
+                if t.border_value is not None:
+                    border_value = t.border_value
+                continue
+
+            if matrix is not None:
+                image, targets = warp_affine(image, targets, matrix, size, border_value)
+                matrix = None
+                size = None
+                border_value = None
+
             image, targets = t(image, targets)
 
+        if matrix is not None:
+            image, targets = warp_affine(image, targets, matrix, size, border_value)
+
         return image, targets
 
 
@@ -218,63 +398,74 @@ class ToTensor:
         image: ndarray,
         targets: Dict[str, ndarray]
     ) -> Tuple[ndarray, Dict[str, Tensor]]:
-        image = torch.as_tensor(image.transpose((2, 0, 1)), dtype=torch.float32)
+        image = torch.as_tensor(
+            np.ascontiguousarray(image.transpose((2, 0, 1))), dtype=torch.float32)
         for key, value in targets.items():
-            targets[key] = torch.as_tensor(value)
+            targets[key] = torch.as_tensor(np.ascontiguousarray(value))
 
         return image, targets
 
 
-class RandomFlip:
-    def __init__(self, p: float = 0.2):
-        self.p = p
+class Resize(GeometricTransform):
+    """Resize to a fixed height and width, e.g. 550 x 550 of YOLACT
 
-    def __call__(
-        self,
-        image: np.ndarray,
-        targets: Dict[str, np.ndarray]
-    ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
-        h, _, _ = image.shape
-        if np.random.random() < self.p:
-            image = image[::-1, :]
-            targets['masks'] = targets['masks'][:, ::-1, :]
-            boxes = targets['boxes'].copy()
-            targets['boxes'][:, 1::2] = h - boxes[:, 3::-2]
+    Masks take the source pixel nearest to each output pixel center, as
+    `cv2.INTER_NEAREST_EXACT` and the `nearest-exact` mode of
+    :class:`BatchResize`, so they stay aligned with the image and boxes.
+    """
+    def __init__(self, width: int, height: int) -> None:
+        self.width = width
+        self.height = height
 
-        return image, targets
+    def get_matrix(self, height, width):
+        if (height, width) == (self.height, self.width):
+            return None
 
+        return _scaling(self.width / width, self.height / height), (self.height, self.width)
 
-class RandomRotation:
-    def __init__(self, p: float = 0.2):
+
+class RandomFlip(GeometricTransform):
+    """
+    Args:
+        p (:obj:`float`):
+        horizontal (:obj:`bool`): flips upside down by default
+    """
+    def __init__(self, p: float = 0.2, horizontal: bool = False):
         self.p = p
+        self.horizontal = horizontal
 
-    def __call__(
-        self,
-        image: np.ndarray,
-        targets: Dict[str, np.ndarray]
-    ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
-        if np.random.random() < self.p:
-            old_height, old_width, _ = image.shape
-            k = np.random.randint(4)
-            image = np.rot90(image, k)
+    def get_matrix(self, height, width):
+        if np.random.random() >= self.p:
+            return None
 
-            if targets['boxes'] is not None:
-                boxes = targets['boxes'].copy()
-                for _ in range(k):
-                    boxes = np.array([[
-                        box[1], old_width - 1 - box[2],
-                        box[3], old_width - 1 - box[0]] for box in boxes])
+        if self.horizontal:
+            matrix = np.array([[-1, 0, width], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
+        else:
+            matrix = np.array([[1, 0, 0], [0, -1, height], [0, 0, 1]], dtype=np.float64)
 
-                    old_width, old_height = old_height, old_width
+        return matrix, (height, width)
 
-            if targets['masks'] is not None:
-                targets['masks'] = np.array(
-                    [np.rot90(mask, k) for mask in targets['masks']])
 
-        return image, targets
+class RandomRotation(GeometricTransform):
+    """Rotate counterclockwise by a random multiple of 90 degrees, as `np.rot90`"""
+    def __init__(self, p: float = 0.2):
+        self.p = p
+
+    def get_matrix(self, height, width):
+        if np.random.random() >= self.p:
+            return None
+
+        k = np.random.randint(4)
+        matrix = np.eye(3, dtype=np.float64)
+        for _ in range(k):
+            # (x, y) -> (y, W - x), then the width and height are swapped
+            matrix = np.array([[0, 1, 0], [-1, 0, width], [0, 0, 1]], dtype=np.float64) @ matrix
+            height, width = width, height
+
+        return matrix, (height, width)
 
 
-class Pad:
+class Pad(GeometricTransform):
     """
     Pads the image to the input width and height, filling the
     background with mean and putting the image in the top-left.
@@ -284,37 +475,50 @@ class Pad:
         self.mean = mean
         self.width = width
         self.height = height
+        self.p = p
+        self.border_value = 0 if mean is None else mean
+
+    def get_matrix(self, height, width):
+        if np.random.random() >= self.p or (height, width) == (self.height, self.width):
+            return None
+
+        return np.eye(3, dtype=np.float64), (self.height, self.width)
+
 
+class ConvertFromInts:
     def __call__(
         self,
-        image: np.ndarray,
-        targets: Dict[str, np.ndarray]
-    ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
-        im_h, im_w, depth = image.shape
+        image: ndarray,
+        targets: Dict[str, ndarray]
+    ) -> Tuple[ndarray, Dict[str, ndarray]]:
+        return image.astype(np.float32), targets
 
-        expand_image = np.zeros(
-            (self.height, self.width, depth),
-            dtype=image.dtype)
-        expand_image[:, :, :] = self.mean
-        expand_image[:im_h, :im_w] = image
-        if targets['boxes'] is not None:
-            expand_boxes = np.zeros_like(targets['boxes'])
-            targets['boxes'] = expand_boxes
 
-        if targets['masks'] is not None:
-            expand_masks = np.zeros(
-                (targets['masks'].shape[0], self.height, self.width),
-                dtype=targets['masks'].dtype)
-            expand_masks[:, :im_h, :im_w] = targets['masks']
-            targets['masks'] = expand_masks
+class ConvertColor:
+    """Convert a float image between BGR and HSV for the hue and saturation
+    transforms"""
+    def __init__(self, current: str = 'BGR', transform: str = 'HSV'):
+        self.code = {
+            ('BGR', 'HSV'): cv2.COLOR_BGR2HSV,
+            ('HSV', 'BGR'): cv2.COLOR_HSV2BGR,
+            ('RGB', 'HSV'): cv2.COLOR_RGB2HSV,
+            ('HSV', 'RGB'): cv2.COLOR_HSV2RGB,
+        }[(current, transform)]
 
-        return expand_image, targets
+    def __call__(
+        self,
+        image: ndarray,
+        targets: Dict[str, ndarray]
+    ) -> Tuple[ndarray, Dict[str, ndarray]]:
+        return cv2.cvtColor(image, self.code), targets
 
 
 class RandomSaturation:
+    """Expects a float HSV image"""
     def __init__(self, lower=0.5, upper=1.5, p=0.2):
         self.lower = lower
         self.upper = upper
+        self.p = p
         assert self.upper >= self.lower, "contrast upper must be >= lower."
         assert self.lower >= 0, "contrast lower must be non-negative."
 
@@ -323,26 +527,29 @@ class RandomSaturation:
         image: np.ndarray,
         targets: Dict[str, np.ndarray]
     ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
-        if random.randint(2):
-            image[:, :, 1] *= random.uniform(self.lower, self.upper)
+        if np.random.random() < self.p:
+            image[:, :, 1] *= np.random.uniform(self.lower, self.upper)
 
         return image, targets
 
 
 class RandomHue:
-    def __init__(self, delta=18.0):
+    """Expects a float HSV image"""
+    def __init__(self, delta=18.0, p=0.5):
         assert delta >= 0.0 and delta <= 360.0
         self.delta = delta
+        self.p = p
 
     def __call__(
         self,
         image: np.ndarray,
         targets: Dict[str, np.ndarray]
     ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
-        if np.random.randint(2):
-            image[:, :, 0] += np.random.uniform(-self.delta, self.delta)
-            image[:, :, 0][image[:, :, 0] > 360.0] -= 360.0
-            image[:, :, 0][image[:, :, 0] < 0.0] += 360.0
+        if np.random.random() < self.p:
+            hue = image[:, :, 0]
+            hue += np.random.uniform(-self.delta, self.delta)
+            # Wrap around in place instead of two masked assignments
+            np.mod(hue, 360.0, out=hue)
 
         return image, targets
 
@@ -360,27 +567,26 @@ class RandomContrast:
         image: np.ndarray,
         targets: Dict[str, np.ndarray]
     ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
-        if np.random.randint(2):
-            alpha = np.random.uniform(self.lower, self.upper)
-            image *= alpha
+        if np.random.random() < self.p:
+            image *= np.random.uniform(self.lower, self.upper)
 
         return image, targets
 
 
 class RandomBrightness:
-    def __init__(self, delta=32):
+    def __init__(self, delta=32, p=0.5):
         assert delta >= 0.0
         assert delta <= 255.0
         self.delta = delta
+        self.p = p
 
     def __call__(
         self,
         image: np.ndarray,
         targets: Dict[str, np.ndarray]
     ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
-        if np.random.randint(2):
-            delta = np.random.uniform(-self.delta, self.delta)
-            image += delta
+        if np.random.random() < self.p:
+            image += np.random.uniform(-self.delta, self.delta)
 
         return image, targets
 
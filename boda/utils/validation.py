@@ -0,0 +1,249 @@
+import os
+import queue
+import traceback
+from copy import deepcopy
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+import torch
+import torch.multiprocessing as mp
+from torch import nn
+from torch.utils.data import DataLoader
+
+from .dataset import DevicePrefetcher
+from .evaluation import CocoEvaluator
+from .checkpoint import snapshot_to_cpu
+from .misc import autocast
+from .distributed import unwrap_model
+
+
+def evaluate_model(
+    model: nn.Module,
+    loader: DataLoader,
+    evaluator: CocoEvaluator,
+    postprocess: Optional[Callable] = None,
+    device: Union[str, torch.device] = 'cpu',
+    precision: str = 'fp32'
+) -> Dict[str, float]:
+    """mAP of a model in eval mode on a validation loader
+
+    Images are expected at their original size, as :class:`CocoDataset`
+    returns them without resizing transforms. :class:`DetectionCollate`
+    pads them to the largest image of the batch, so the model gets views
+    without the padding and resizes each image by itself, as it would one
+    image at a time. Each batch is reduced to boxes and RLE masks by the
+    evaluator as soon as it is predicted, so memory does not grow with the
+    predictions of the validation set.
+    """
+    device_type = torch.device(device).type
+    evaluator.reset()
+    with torch.no_grad():
+        for images, targets, h, w in DevicePrefetcher(loader, device):
+            image_sizes = list(zip(torch.as_tensor(h).tolist(), torch.as_tensor(w).tolist()))
+            images = [
+                image[:, :height, :width] for image, (height, width) in zip(images, image_sizes)]
+            with autocast(precision, device_type):
+                outputs = model(images)
+            preds = postprocess(outputs, image_sizes) if postprocess else outputs
+            del outputs
+
+            for pred, target, (height, width) in zip(preds, targets, image_sizes):
+                if 'masks' in target:
+                    # Masks of the collate are padded to the batch
+                    target = {**target, 'masks': target['masks'][:, :height, :width]}
+                evaluator.add(pred, target)
+            del images, targets, preds
+
+    return evaluator.summarize(verbose=False)
+
+
+def _validation_worker(
+    model, loader, evaluator, postprocess, device, precision, cores, requests, results, cancelled
+) -> None:
+    if cores is not None:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+
+    model.to(device).eval()
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        if cancelled.is_set():
+            continue
+
+        tag, state = request
+        try:
+            if isinstance(state, str):
+                state = torch.load(state, map_location='cpu', weights_only=False)['model']
+            model.load_state_dict(state)
+            del state
+            stats = evaluate_model(model, loader, evaluator, postprocess, device, precision)
+            results.put((tag, stats))
+        except Exception:
+            results.put((tag, traceback.format_exc()))
+    evaluator.close()
+
+
+class BackgroundValidator:
+    """Validation in a separate process while training goes on
+
+    :meth:`submit` hands a CPU snapshot of the weights, or the path of a
+    checkpoint, to the process, which loads them into its own copy of the
+    model, runs :func:`evaluate_model` and puts the stats in a queue read
+    by :meth:`poll`. Give the process cores that training does not use, or
+    another GPU, so training throughput does not change.
+
+    The loader, evaluator and postprocess are pickled into the process, so
+    they must not be lambdas, and the script needs a `__main__` guard as the
+    process is spawned. Errors of the process, and its exit, are raised by
+    :meth:`poll` and :meth:`wait`.
+
+    Args:
+        valid_loader (:obj:`DataLoader`): of :class:`CocoDataset` in the
+            validation mode
+        evaluator (:obj:`CocoEvaluator`):
+        postprocess (:obj:`Callable`): see :class:`Trainer`
+        device (:obj:`str`): device of the validation model
+        cores (:obj:`Sequence[int]`): CPU cores the process is pinned to,
+            all if `None`
+        precision (:obj:`str`): autocast policy of the validation model
+        max_pending (:obj:`int`): snapshots queued or being evaluated, more
+            are skipped so a slow validation does not pile up weights
+
+    Examples::
+        >>> validator = BackgroundValidator(
+        >>>     valid_loader, CocoEvaluator(80), YolactInference(81), device='cuda:1')
+        >>> trainer = Trainer(..., validator=validator)
+    """
+    def __init__(
+        self,
+        valid_loader: DataLoader,
+        evaluator: CocoEvaluator,
+        postprocess: Optional[Callable] = None,
+        device: str = 'cpu',
+        cores: Optional[Sequence[int]] = None,
+        precision: str = 'fp32',
+        max_pending: int = 2
+    ) -> None:
+        self.valid_loader = valid_loader
+        self.evaluator = evaluator
+        self.postprocess = postprocess
+        self.device = device
+        self.cores = None if cores is None else list(cores)
+        self.precision = precision
+        self.max_pending = max_pending
+        self.process = None
+        self.requests = None
+        self.results = None
+        self.cancelled = None
+        self.num_pending = 0
+        # Records received by a blocking submit, returned by the next poll
+        self.finished = []
+
+    def __enter__(self) -> 'BackgroundValidator':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def start(self, model: nn.Module) -> None:
+        """Start the process with a CPU copy of `model`, done by the first :meth:`submit`"""
+        if self.process is not None:
+            return
+
+        # spawn, as a forked process can not initialize CUDA
+        context = mp.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.cancelled = context.Event()
+        self.process = context.Process(
+            target=_validation_worker,
+            args=(deepcopy(unwrap_model(model)).cpu(), self.valid_loader, self.evaluator,
+                  self.postprocess, self.device, self.precision, self.cores,
+                  self.requests, self.results, self.cancelled))
+        self.process.start()
+
+    def submit(
+        self,
+        model: nn.Module,
+        tag: Dict[str, Any],
+        path: Optional[str] = None,
+        block: bool = False
+    ) -> bool:
+        """Queue the current weights of `model`, or the `model` of the
+        checkpoint at `path` saved by :class:`Trainer`
+
+        Returns `False` if the snapshot was skipped because the process is
+        still busy with the previous ones, or waits for it if `block`.
+        """
+        self.start(model)
+        while self.num_pending >= self.max_pending:
+            if not block:
+                return False
+            self.finished.append(self._get(block=True))
+
+        state = path if path is not None else snapshot_to_cpu(unwrap_model(model).state_dict())
+        self.requests.put((tag, state))
+        self.num_pending += 1
+
+        return True
+
+    def _get(self, block: bool) -> Optional[Dict[str, Any]]:
+        while True:
+            try:
+                tag, stats = self.results.get(block=block, timeout=1.0 if block else None)
+                break
+            except queue.Empty:
+                # Without a timeout a killed process, e.g. by the OOM killer,
+                # would leave training waiting forever
+                if not self.process.is_alive():
+                    raise RuntimeError(
+                        f'The validation process exited with code {self.process.exitcode}.')
+                if not block:
+                    return None
+
+        self.num_pending -= 1
+        if isinstance(stats, str):
+            # The traceback of the worker
+            raise RuntimeError(f'Validation of {tag} failed.\n{stats}')
+
+        return {**tag, **stats}
+
+    def poll(self) -> List[Dict[str, Any]]:
+        """Records of the validations finished since the last call, `tag`
+        merged with the stats, without waiting"""
+        records, self.finished = self.finished, []
+        while self.num_pending > 0:
+            record = self._get(block=False)
+            if record is None:
+                break
+            records.append(record)
+
+        return records
+
+    def wait(self) -> List[Dict[str, Any]]:
+        """Records of every submitted snapshot, waiting for the process"""
+        records, self.finished = self.finished, []
+        while self.num_pending > 0:
+            records.append(self._get(block=True))
+
+        return records
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Stop the process, snapshots not evaluated yet are dropped
+
+        A validation still running after `timeout` seconds is terminated.
+        """
+        if self.process is None:
+            return
+
+        # Queued snapshots are skipped up to the sentinel
+        self.cancelled.set()
+        self.requests.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.process = None
+        self.num_pending = 0